@@ -15,11 +15,11 @@ import numpy as np
 from multiprocessing import Pool
 import pathlib
 import shapely
-from netCDF4 import Dataset
 from cartopy.mpl.gridliner import LONGITUDE_FORMATTER, LATITUDE_FORMATTER
 
 from marine_boundaries import read_shapefile, get_eez_region
 from shared import eez_names
+from grid import get_grid_metrics
 from project_paths import marine_boundaries_data_dir
 
 
@@ -122,12 +122,9 @@ def flag_elements_multiprocessing(lons, lats, country_geometry, valid_elements,
 
 # Read in grid data
 # -----------------
-grid_metrics_file_name = '../Inputs/grid_metrics/grid_metrics_surface_ocean.nc'
-grid_metrics = Dataset(grid_metrics_file_name)
-lons = grid_metrics['longitude_c'][:]
-lats = grid_metrics['latitude_c'][:]
-mask = grid_metrics['mask_c'][:]
-ocean_elements = np.asarray(mask==0).nonzero()[0]
+grid_metrics = get_grid_metrics()
+lons = np.asarray(grid_metrics.lons)
+lats = np.asarray(grid_metrics.lats)
 
 # Limit the countries/regions we will look at
 na_countries = eez_names.keys()
@@ -137,9 +134,7 @@ na_countries = eez_names.keys()
 # ------------------------------------------------
 valid_elements = {}
 for country in na_countries:
-    northern_hemisphere_elements = np.asarray(lats>0.0).nonzero()[0]
-    valid_elements[country] = np.intersect1d(ocean_elements,
-                                             northern_hemisphere_elements)
+    valid_elements[country] = grid_metrics.get_hemisphere_elements('north')
 
 # Select boundary types
 # ---------------------
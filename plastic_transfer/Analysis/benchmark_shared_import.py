@@ -0,0 +1,54 @@
+""" Benchmark the time taken to import `shared`
+
+Each measurement starts a fresh interpreter, as the array jobs do, and
+times the import itself. Importing `shared` is compared with importing it
+and then accessing `data_crs` and `canada_outline_poly`, which triggers the
+cartopy and shapely imports that `shared` used to make at module load.
+
+Usage
+-----
+python benchmark_shared_import.py [-n <repeats>]
+"""
+import sys
+import argparse
+import subprocess
+
+import numpy as np
+
+
+def time_statement(statement, n_repeats):
+    """ Time `statement` in `n_repeats` fresh interpreters
+
+    Returns
+    -------
+     : 1D NumPy array
+        The time taken in each interpreter (s).
+    """
+    code = ('import time; start = time.perf_counter(); '
+            f'{statement}; print(time.perf_counter() - start)')
+
+    times = []
+    for _ in range(n_repeats):
+        output = subprocess.run([sys.executable, '-c', code], check=True,
+                                capture_output=True, text=True).stdout
+        times.append(float(output.strip().splitlines()[-1]))
+
+    return np.array(times)
+
+
+statements = {'Names only': 'import shared; shared.na_countries',
+              'With geometry and CRS': 'import shared; shared.data_crs; '
+                                       'shared.canada_outline_poly'}
+
+
+if __name__ == "__main__":
+    # Parse command line agruments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--repeats', help='Number of repeats', type=int,
+                        default=10, metavar='')
+    parsed_args = parser.parse_args(sys.argv[1:])
+
+    for name, statement in statements.items():
+        times = time_statement(statement, parsed_args.repeats)
+        print(f'{name}: median {np.median(times)*1.e3:.1f} ms, '
+              f'min {times.min()*1.e3:.1f} ms over {times.shape[0]} imports')
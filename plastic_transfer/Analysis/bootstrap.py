@@ -0,0 +1,107 @@
+""" Bootstrap resampling of particles
+
+Stocks are estimated from a finite number of particles per river release
+zone (group), so they are subject to sampling error. This is estimated by
+resampling particles with replacement within each group, and recomputing
+stocks for each resample (replicate).
+
+A replicate is described by the number of times each particle is drawn,
+which is a multinomial sample within each group. Stocks for all replicates
+are computed in a single pass by weighting each particle's contribution by
+its counts (see `cython_helpers.accumulate_region_mass_replicates`).
+
+Particles must be resampled in the same way on every day and in every month,
+so that replicate stocks can be averaged over time. Counts for a release are
+therefore generated from a seed derived from the release itself, rather than
+being stored.
+"""
+import functools
+import zlib
+
+import numpy as np
+
+
+# The number of releases for which counts are cached
+counts_cache_size = 2
+
+
+@functools.lru_cache(maxsize=counts_cache_size)
+def get_bootstrap_counts(release_key, n_groups, n_particles_prz, n_replicates,
+                         seed=0):
+    """ Return bootstrap counts for the particles in one release
+
+    Parameters
+    ----------
+    release_key : str
+        A string identifying the release (e.g. the path to the PyLag output
+        file relative to the root simulations directory). Together with
+        `seed`, it determines the counts.
+
+    n_groups : int
+        The number of release zones (groups).
+
+    n_particles_prz : int
+        The number of particles released per release zone.
+
+    n_replicates : int
+        The number of replicates.
+
+    seed : int, optional
+        Base random seed. Default: 0.
+
+    Returns
+    -------
+     : 2D NumPy array
+        Counts with dimensions (particles, replicate), as uint8. Counts for
+        each group and replicate sum to `n_particles_prz`. The array is read
+        only.
+    """
+    if n_particles_prz > np.iinfo(np.uint8).max:
+        raise ValueError(f'Bootstrap counts are stored as uint8, so at most '
+                         f'{np.iinfo(np.uint8).max} particles per release zone '
+                         f'are supported.')
+
+    rng = np.random.default_rng([seed, zlib.crc32(release_key.encode('utf-8'))])
+
+    # Draw particle indices within each group, then count how many times
+    # each particle was drawn. Replicates are drawn one at a time to limit
+    # memory use.
+    n_particles = n_groups * n_particles_prz
+    group_offsets = np.arange(n_groups)[:, np.newaxis] * n_particles_prz
+    counts = np.empty((n_particles, n_replicates), dtype=np.uint8)
+    for replicate_idx in range(n_replicates):
+        draws = rng.integers(0, n_particles_prz, size=(n_groups, n_particles_prz))
+        counts[:, replicate_idx] = np.bincount((group_offsets + draws).reshape(-1),
+                                               minlength=n_particles)
+    counts.setflags(write=False)
+
+    return counts
+
+
+def summarise_replicates(estimate, replicates, confidence_level=95.):
+    """ Summarise bootstrap replicates of an estimate
+
+    Parameters
+    ----------
+    estimate : ND NumPy array
+        The estimate from the full set of particles.
+
+    replicates : ND NumPy array
+        Replicate estimates, with replicates along the last axis.
+
+    confidence_level : float, optional
+        Confidence level for the percentile interval (%). Default: 95.
+
+    Returns
+    -------
+     : dict
+        The estimate, the standard error and the lower and upper bounds of
+        the confidence interval.
+    """
+    alpha = (100. - confidence_level) / 2.
+    lower, upper = np.percentile(replicates, [alpha, 100. - alpha], axis=-1)
+
+    return {'Mean': estimate,
+            'Standard error': replicates.std(axis=-1, ddof=1),
+            'CI lower': lower,
+            'CI upper': upper}
@@ -0,0 +1,251 @@
+""" Build annual mean plastic stock matrices from monthly stock files
+
+Consume the monthly stock files written by `compute_plastic_stock_in_eezs.py`
+as they complete, and keep running statistics of the daily stocks for each
+receiving region and emitting country (see `running_stats.py`). Each run
+only reads the months that have completed since the last run, so the script
+can be rerun (or left to poll with `-w`) while stock jobs are still running.
+With `-f zarr`, months are read from the stock store (see `zarr_store.py`)
+instead.
+
+Once all months for all regions have been consumed, the annual mean stock
+matrix is saved in `../Results/plastic_stocks`, with the existing layout:
+rows give the receiving country (summed over its regions, see
+`region_labels.aggregate_to_countries`) and columns give the emitting
+country, plus a column summing over all countries. The matrix for each
+receiving region is saved alongside it, in files named
+`annual_mean_plastic_stock_by_region_<year>.csv`. Until then, partial
+matrices are saved, along with a table giving the months that have been
+consumed for each region. The means, variances, minima and maxima, and the
+months consumed, are also saved in a compact binary (npz) file, which is
+used to resume.
+
+A month's stocks that change after they have been consumed (e.g. because
+a job was rerun) cannot be removed from the running statistics. Such
+months are reported, and the statistics should be rebuilt with `--rebuild`.
+
+Usage
+-----
+python build_annual_stock_matrices.py -y <year> [-f <format>] [-w <interval_seconds>] [--rebuild]
+"""
+import os
+import sys
+import time
+import zlib
+import argparse
+import pathlib
+
+import numpy as np
+import pandas
+
+from shared import na_countries, eez_names
+from running_stats import RunningStats
+from region_labels import build_region_country_map, aggregate_to_countries
+from zarr_store import read_stock_month
+
+
+def get_stock_file_name(region, year, month):
+    return (f"{stock_dir}/{region}/{year}/{month:02}/"
+            f"plastic_stock_in_{region}_{year}_{month:02}.pkl")
+
+
+def get_stats_file_name(year):
+    return f'{out_dir}/annual_plastic_stock_statistics_{year}.npz'
+
+
+def read_stock_store_month(region, year, month):
+    """ Read one month of stocks for `region` from the stock store
+
+    Returns
+    -------
+    key : float
+        The CRC32 checksum of the stocks, which identifies the version
+        consumed, or None if the month has not been written.
+
+    pdf : pandas.DataFrame
+        The stocks, with the same columns as the monthly stock files, or
+        None if the month has not been written.
+    """
+    if not os.path.isdir(stock_store_path):
+        return None, None
+
+    stock, emitters = read_stock_month(stock_store_path, region, year, month)
+    if stock is None:
+        return None, None
+
+    pdf = pandas.DataFrame(stock, columns=emitters)
+    pdf['All countries'] = pdf.sum(axis=1)
+
+    return float(zlib.crc32(np.ascontiguousarray(stock).tobytes())), pdf
+
+
+def consume_completed_months(stats, year, output_format='pickle'):
+    """ Update `stats` with monthly stocks that have completed
+
+    Monthly stock files are identified by their modification time, and
+    months in the stock store (`output_format` 'zarr') by a checksum of
+    their stocks.
+
+    Returns
+    -------
+     : int
+        The number of months consumed.
+    """
+    n_consumed = 0
+    for region_idx, region in enumerate(stats.regions):
+        for month in range(1, 13):
+            if output_format == 'zarr':
+                key, pdf = read_stock_store_month(region, year, month)
+                if key is None:
+                    continue
+            else:
+                file_name = get_stock_file_name(region, year, month)
+                if not os.path.isfile(file_name):
+                    continue
+                key, pdf = os.path.getmtime(file_name), None
+
+            consumed_key = stats.consumed[region_idx, month - 1]
+            if not np.isnan(consumed_key):
+                if key != consumed_key:
+                    print(f' ... stocks for {region} in month {month:02} have '
+                          f'changed since they were consumed. Rerun with '
+                          f'--rebuild to include the changes.')
+                continue
+
+            # The file may still be being written
+            if pdf is None:
+                try:
+                    pdf = pandas.read_pickle(file_name)
+                except Exception:
+                    print(f' ... stocks for {region} in month {month:02} could '
+                          f'not be read, skipping for now')
+                    continue
+
+            values = pdf.reindex(columns=stats.emitters).values.astype(np.float64)
+            stats.update(region, values)
+            stats.consumed[region_idx, month - 1] = key
+            n_consumed += 1
+
+    return n_consumed
+
+
+def save_annual_stock_matrices(stats, year):
+    """ Save the annual mean stock matrices and the running statistics
+
+    The mean stock in each receiving country is the sum of the means in its
+    regions, as all regions span the same days once the year is complete.
+
+    Returns
+    -------
+     : bool
+        True if all months for all regions have been consumed.
+    """
+    pathlib.Path(out_dir).mkdir(parents=True, exist_ok=True)
+
+    stats.save(get_stats_file_name(year))
+
+    consumed = ~np.isnan(stats.consumed)
+    is_complete = bool(np.all(consumed))
+
+    region_means = stats.get_statistic('mean')
+    region_countries, country_keys = build_region_country_map(stats.regions)
+    country_means = aggregate_to_countries(region_means, region_countries,
+                                           len(country_keys), axis=0)
+
+    matrices = {'annual_mean_plastic_stock':
+                pandas.DataFrame(country_means, index=country_keys,
+                                 columns=stats.emitters),
+                'annual_mean_plastic_stock_by_region':
+                pandas.DataFrame(region_means, index=stats.regions,
+                                 columns=stats.emitters)}
+
+    if is_complete:
+        for stem, matrix in matrices.items():
+            matrix.to_csv(f'{out_dir}/{stem}_{year}.csv')
+            pathlib.Path(f'{out_dir}/{stem}_{year}_partial.csv').unlink(missing_ok=True)
+        coverage_file = f'{out_dir}/annual_mean_plastic_stock_{year}_coverage.csv'
+        pathlib.Path(coverage_file).unlink(missing_ok=True)
+        print(f'Saved annual mean stock matrices for year {year}')
+    else:
+        for stem, matrix in matrices.items():
+            matrix.to_csv(f'{out_dir}/{stem}_{year}_partial.csv')
+        coverage = pandas.DataFrame(consumed, index=stats.regions,
+                                    columns=[f'{month:02}' for month in range(1, 13)])
+        coverage.to_csv(f'{out_dir}/annual_mean_plastic_stock_{year}_coverage.csv')
+        print(f'Saved partial stock matrices for year {year} '
+              f'({consumed.sum()} of {consumed.size} region months)')
+
+    return is_complete
+
+
+def build_annual_stock_matrices(year, watch_interval=None, rebuild=False,
+                                output_format='pickle'):
+    """ Build the annual mean stock matrices for `year`
+
+    Parameters
+    ----------
+    year : int
+        The year.
+
+    watch_interval : float, optional
+        If given, poll for newly completed months at this interval (in
+        seconds) until the year is complete. Default: None.
+
+    rebuild : bool, optional
+        If True, discard any saved statistics and consume all months again.
+        Default: False.
+
+    output_format : str, optional
+        The format stock jobs were run with: 'pickle', to read monthly stock
+        files, or 'zarr', to read the stock store. Default: 'pickle'.
+
+    Returns
+    -------
+     : RunningStats
+        The statistics.
+    """
+    stats_file_name = get_stats_file_name(year)
+    if os.path.isfile(stats_file_name) and not rebuild:
+        stats = RunningStats.load(stats_file_name)
+    else:
+        stats = RunningStats(eez_names.keys(), na_countries + ['All countries'])
+
+    while True:
+        n_consumed = consume_completed_months(stats, year, output_format)
+        print(f'Consumed {n_consumed} new month(s) of stocks for year {year}')
+
+        is_complete = save_annual_stock_matrices(stats, year)
+        if is_complete or watch_interval is None:
+            break
+
+        time.sleep(watch_interval)
+
+    return stats
+
+
+# Location of the monthly stock files and the stock store
+stock_dir = '../Derived_data/plastic_stock'
+stock_store_path = f'{stock_dir}/plastic_stock.zarr'
+
+# Location of the annual matrices
+out_dir = '../Results/plastic_stocks'
+
+
+if __name__ == "__main__":
+    # Parse command line agruments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-y', '--year', help='Target year', metavar='')
+    parser.add_argument('-f', '--format', help='Format of the stock outputs '
+                                               '(pickle or zarr)',
+                        choices=['pickle', 'zarr'], default='pickle',
+                        metavar='')
+    parser.add_argument('-w', '--watch', help='Poll for completed months at '
+                                              'this interval (seconds) until '
+                                              'the year is complete',
+                        type=float, default=None, metavar='')
+    parser.add_argument('--rebuild', help='Discard saved statistics',
+                        action='store_true')
+    parsed_args = parser.parse_args(sys.argv[1:])
+
+    build_annual_stock_matrices(int(parsed_args.year), parsed_args.watch,
+                                parsed_args.rebuild, parsed_args.format)
@@ -0,0 +1,138 @@
+""" Build annual plastic stock matrices with bootstrap confidence intervals
+
+Combine the monthly bootstrap replicates saved by
+`compute_plastic_stock_in_eezs.py -b <n_replicates>` into annual mean
+stocks for each emitting country and receiving region, along with their
+standard errors and percentile confidence intervals. Replicates for each
+month must have been computed with the same number of replicates and the
+same seed, so that the same particles are resampled in every month.
+
+A long table, with one row per receiving region and emitter, is saved
+along with matrices giving the lower and upper bounds of the confidence
+intervals. The matrices have the same layout as the annual mean stock
+matrices in `../Results/plastic_stocks`, with rows giving the receiving
+region and columns giving the emitting country, plus a column summing over
+all countries.
+
+Regions for which any month is missing are left out.
+
+Usage
+-----
+python build_bootstrap_stock_matrices.py -y <year> [-c <confidence_level>]
+"""
+import os
+import sys
+import argparse
+import pathlib
+
+import numpy as np
+import pandas
+
+from shared import eez_names
+from bootstrap import summarise_replicates
+
+
+def read_annual_replicates(region, year):
+    """ Compute annual mean stocks and replicates for `region`
+
+    Returns
+    -------
+     : tuple or None
+        The emitting countries, the annual mean stocks with dimensions
+        (emitter) and the replicate annual mean stocks with dimensions
+        (emitter, replicate). None if any month is missing.
+    """
+    emitters = None
+    stock_sums = None
+    replicate_sums = None
+    n_days = 0
+    for month in range(1, 13):
+        in_dir = f"../Derived_data/plastic_stock_bootstrap/{region}/{year}/{month:02}"
+        in_file = f"{in_dir}/plastic_stock_bootstrap_{region}_{year}_{month:02}.npz"
+        if not os.path.isfile(in_file):
+            print(f' ... bootstrap replicates for {region} in month {month:02} '
+                  f'of year {year} are missing')
+            return None
+
+        data = np.load(in_file)
+        if emitters is None:
+            emitters = data['emitters'].tolist()
+            stock_sums = np.zeros_like(data['stock_sums'])
+            replicate_sums = np.zeros_like(data['replicate_sums'])
+        elif data['emitters'].tolist() != emitters or \
+                data['replicate_sums'].shape != replicate_sums.shape:
+            raise RuntimeError(f'Bootstrap replicates for {region} in month '
+                               f'{month:02} of year {year} are inconsistent '
+                               f'with those for earlier months')
+
+        stock_sums += data['stock_sums']
+        replicate_sums += data['replicate_sums']
+        n_days += int(data['n_days'])
+
+    # Add the total over all countries
+    emitters = emitters + ['All countries']
+    stocks = np.append(stock_sums, stock_sums.sum()) / n_days
+    replicates = np.vstack([replicate_sums,
+                            replicate_sums.sum(axis=0, keepdims=True)]) / n_days
+
+    return emitters, stocks, replicates
+
+
+def build_bootstrap_stock_matrices(year, confidence_level=95.):
+    """ Build bootstrap summaries of annual mean stocks for `year`
+
+    Returns
+    -------
+     : pandas.DataFrame
+        Summary statistics for each receiving region and emitter.
+    """
+    print(f'Building bootstrap stock matrices for year {year}')
+
+    pdfs = []
+    for region in eez_names.keys():
+        replicates = read_annual_replicates(region, year)
+        if replicates is None:
+            continue
+
+        emitters, stocks, replicates = replicates
+        pdf = pandas.DataFrame(summarise_replicates(stocks, replicates,
+                                                    confidence_level),
+                               index=pandas.Index(emitters, name='Emitter')).reset_index()
+        pdf.insert(0, 'Receiving region', region)
+        pdfs.append(pdf)
+
+    if not pdfs:
+        print(' ... no regions to process')
+        return None
+
+    pdf = pandas.concat(pdfs, ignore_index=True)
+
+    out_dir = '../Results/plastic_stocks/bootstrap'
+    pathlib.Path(out_dir).mkdir(parents=True, exist_ok=True)
+    pdf.to_csv(f'{out_dir}/annual_mean_plastic_stock_bootstrap_{year}.csv',
+               index=False)
+
+    for column in ['CI lower', 'CI upper']:
+        matrix = pdf.pivot(index='Receiving region', columns='Emitter',
+                           values=column)
+        matrix = matrix.reindex(index=[region for region in eez_names.keys()
+                                       if region in matrix.index],
+                                columns=pdf['Emitter'].unique())
+        matrix.index.name = None
+        matrix.columns.name = None
+        file_stem = column.lower().replace(' ', '_')
+        matrix.to_csv(f'{out_dir}/annual_mean_plastic_stock_{file_stem}_{year}.csv')
+
+    return pdf
+
+
+if __name__ == "__main__":
+    # Parse command line agruments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-y', '--year', help='Target year', metavar='')
+    parser.add_argument('-c', '--confidence-level', help='Confidence level (%%)',
+                        type=float, default=95., metavar='')
+    parsed_args = parser.parse_args(sys.argv[1:])
+
+    build_bootstrap_stock_matrices(int(parsed_args.year),
+                                   parsed_args.confidence_level)
@@ -1,11 +1,16 @@
-from setuptools import setup
+from setuptools import setup, Extension
 from Cython.Build import cythonize
 import numpy
 
+# The helpers are parallelised with OpenMP
+extensions = [Extension('cython_helpers',
+                        ['cython_helpers.pyx'],
+                        extra_compile_args=['-fopenmp', '-O3'],
+                        extra_link_args=['-fopenmp'])]
+
 setup(
     name='EMPP Cython helpers',
-    ext_modules=cythonize("cython_helpers.pyx"),
+    ext_modules=cythonize(extensions),
     include_dirs=[numpy.get_include()],
     zip_safe=False,
 )
-
@@ -0,0 +1,35 @@
+""" Build maps from ocean grid elements to output grid cells
+
+Assign each element of the ocean grid to the output grid cell its centre
+lies in, for each output grid resolution (see `grid_cell_mapping.py`). The
+maps are used by `compute_plastic_concentrations.py -g elements`.
+
+Usage
+-----
+python build_element_cell_maps.py [-s <spacing> [<spacing> ...]]
+"""
+import sys
+import argparse
+
+import numpy as np
+
+from grid_cell_mapping import build_element_cell_map
+
+
+# Parse command line agruments
+parser = argparse.ArgumentParser()
+parser.add_argument('-s',
+                    '--spacing',
+                    help='Output grid spacing(s) in decimal degrees',
+                    nargs='+',
+                    type=float,
+                    default=[1.0, 0.5, 0.25],
+                    metavar='')
+parsed_args = parser.parse_args(sys.argv[1:])
+
+for spacing in parsed_args.spacing:
+    file_name = build_element_cell_map(spacing)
+    element_cells = np.load(file_name, mmap_mode='r')
+    print(f'Saved map for a spacing of {spacing:g} degrees to {file_name} '
+          f'({np.count_nonzero(element_cells >= 0)} of '
+          f'{element_cells.shape[0]} elements mapped)')
@@ -0,0 +1,89 @@
+""" Build annual residence time matrices
+
+Combine the monthly residence times saved by
+`compute_plastic_stock_in_eezs.py` into annual matrices, giving the
+particle-days each emitting country's plastic spent within each EEZ during
+the year. Rows give the receiving region and columns give the emitting
+country, with an extra column summing over all countries. Decay-adjusted
+mass-days are the sum of the daily stocks, so can be found from the stock
+files.
+
+Regions for which any month is missing are left empty.
+
+Usage
+-----
+python build_residence_time_matrices.py -y <year>
+"""
+import os
+import sys
+import argparse
+import pathlib
+
+import numpy as np
+import pandas
+
+from shared import eez_names
+
+
+def read_annual_residence_time(region, year):
+    """ Sum monthly residence times for `region` over `year`
+
+    Returns None if any month is missing.
+    """
+    residence = None
+    for month in range(1, 13):
+        in_dir = f"../Derived_data/residence_time/{region}/{year}/{month:02}"
+        in_file = f"{in_dir}/residence_time_in_{region}_{year}_{month:02}.pkl"
+        if not os.path.isfile(in_file):
+            print(f' ... residence time for {region} in month {month:02} '
+                  f'of year {year} is missing')
+            return None
+
+        month_residence = pandas.read_pickle(in_file)
+        if residence is None:
+            residence = month_residence
+        else:
+            residence = residence.add(month_residence, fill_value=0.0)
+
+    return residence
+
+
+def build_residence_time_matrices(year):
+    """ Build residence time matrices for `year`
+
+    Returns
+    -------
+     : dict
+        The matrices, as pandas DataFrames, keyed by quantity.
+    """
+    print(f'Building residence time matrices for year {year}')
+
+    matrices = {}
+    for region in eez_names.keys():
+        residence = read_annual_residence_time(region, year)
+        if residence is None:
+            continue
+
+        for quantity in residence.columns:
+            matrix = matrices.setdefault(quantity,
+                                         pandas.DataFrame(index=list(eez_names.keys()),
+                                                          columns=residence.index,
+                                                          dtype=np.float64))
+            matrix.loc[region, residence.index] = residence[quantity].values
+
+    out_dir = '../Results/residence_times'
+    pathlib.Path(out_dir).mkdir(parents=True, exist_ok=True)
+    for quantity, matrix in matrices.items():
+        file_stem = quantity.lower().replace(' ', '_')
+        matrix.to_csv(f'{out_dir}/annual_residence_time_{file_stem}_{year}.csv')
+
+    return matrices
+
+
+if __name__ == "__main__":
+    # Parse command line agruments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-y', '--year', help='Target year', metavar='')
+    parsed_args = parser.parse_args(sys.argv[1:])
+
+    build_residence_time_matrices(int(parsed_args.year))
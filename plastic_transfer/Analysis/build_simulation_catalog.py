@@ -0,0 +1,41 @@
+""" Build the simulation catalog
+
+Scan the Simulations tree and record the particle counts and time axes
+of all PyLag output files in a SQLite database. The catalog is used by
+the analysis scripts to look up releases and time indices without
+opening netCDF files. Rerunning the script only rescans files that are
+new or have changed since the catalog was last built.
+
+Usage
+-----
+python build_simulation_catalog.py [-s <scenario>]
+"""
+import sys
+import argparse
+
+from simulation_catalog import build_catalog, get_catalog_file_name
+from project_paths import simulations_dir
+
+
+# Parse command line agruments
+parser = argparse.ArgumentParser()
+parser.add_argument('-s',
+                    '--scenario',
+                    help='Run scenario (e.g. ocean_leeway). If not given, '
+                         'the root simulations directory is scanned.',
+                    metavar='')
+parsed_args = parser.parse_args(sys.argv[1:])
+
+# The number of partcles released per release zone
+n_particles_prz = 100
+
+# Location where simulation outputs are stored
+if parsed_args.scenario is not None:
+    root_dir = f'{simulations_dir}/{parsed_args.scenario}'
+else:
+    root_dir = simulations_dir
+
+n_updated = build_catalog(root_dir, n_particles_prz)
+
+print(f'Added or updated {n_updated} records in '
+      f'{get_catalog_file_name(root_dir)}')
@@ -0,0 +1,62 @@
+""" Build memory-mapped caches of PyLag trajectory variables
+
+Extract `host_arakawa_a` (and, optionally, particle positions) from each
+PyLag output file into uncompressed `.npy` files that can be memory mapped
+by the analysis scripts. The simulation catalog is refreshed first, and
+caches that are still fresh are not rebuilt.
+
+Usage
+-----
+python build_trajectory_cache.py [-s <scenario>] [-c <country>] [--positions]
+"""
+import sys
+import argparse
+
+from simulation_catalog import build_catalog, open_catalog
+from trajectory_cache import cache_release
+from project_paths import simulations_dir
+
+
+# Parse command line agruments
+parser = argparse.ArgumentParser()
+parser.add_argument('-s',
+                    '--scenario',
+                    help='Run scenario (e.g. ocean_leeway). If not given, '
+                         'the root simulations directory is used.',
+                    metavar='')
+parser.add_argument('-c',
+                    '--country',
+                    help='Only cache releases for this emitting country',
+                    metavar='')
+parser.add_argument('--positions',
+                    help='Also cache particle longitudes and latitudes',
+                    action='store_true')
+parsed_args = parser.parse_args(sys.argv[1:])
+
+# The number of partcles released per release zone
+n_particles_prz = 100
+
+# The number of time points to copy at once
+time_block_size = 100
+
+# Location where simulation outputs are stored
+if parsed_args.scenario is not None:
+    root_dir = f'{simulations_dir}/{parsed_args.scenario}'
+else:
+    root_dir = simulations_dir
+
+# Variables to cache
+var_names = ['host_arakawa_a']
+if parsed_args.positions:
+    var_names += ['longitude', 'latitude']
+
+# Make sure the catalog is up to date
+build_catalog(root_dir, n_particles_prz)
+catalog = open_catalog(root_dir)
+
+for file_path in catalog:
+    if parsed_args.country is not None and \
+            catalog[file_path].emitter != parsed_args.country:
+        continue
+
+    cache_release(catalog, file_path, var_names, time_block_size)
@@ -0,0 +1,49 @@
+""" Build a region-to-region transition (Markov) model
+
+Estimate monthly transition matrices between the receiving regions (plus
+"Other Waters") from the connectivity data generated by
+`compute_connectivity_metrics.py`, and save the model for use by
+`project_plastic_stocks.py`. See `markov_model.py`.
+
+Usage
+-----
+python build_transition_model.py [-f <format>]
+"""
+import sys
+import argparse
+import pathlib
+
+from markov_model import estimate_transition_model
+from shared import na_countries
+
+
+# Parse command line agruments
+parser = argparse.ArgumentParser()
+parser.add_argument('-f', '--format', help='Connectivity data format (netcdf or zarr)',
+                    choices=['netcdf', 'zarr'], default='netcdf', metavar='')
+parsed_args = parser.parse_args(sys.argv[1:])
+
+# The run scenario
+scenario = 'ocean_leeway'
+
+# Location where connectivity data are stored
+connectivity_root_dir = f'../Derived_data/connectivity/{scenario}'
+
+# The number of partcles released per release zone
+n_particles_prz = 100
+
+# Releases to process
+release_day = 1
+release_hour = 12
+first_release_year = 2000
+last_release_year = 2014
+
+model = estimate_transition_model(na_countries, connectivity_root_dir,
+                                  n_particles_prz, first_release_year,
+                                  last_release_year, release_day,
+                                  release_hour, parsed_args.format)
+
+# Save the model to file
+out_dir = f'../Derived_data/markov_model/{scenario}'
+pathlib.Path(out_dir).mkdir(parents=True, exist_ok=True)
+model.save(f'{out_dir}/transition_model.npz')
@@ -0,0 +1,34 @@
+""" Build the binary particle weights store
+
+Convert the particle weights CSV files and the weights decay coefficients
+table into a single binary file that is memory mapped by the analysis
+scripts (see `weights_store.py`). Rerun the script whenever the weights or
+decay coefficients are regenerated.
+
+Usage
+-----
+python build_weights_store.py [-n <n_particles_prz>]
+"""
+import sys
+import argparse
+
+from weights_store import convert_weights, WeightsStore
+from shared import na_countries
+
+
+# Parse command line agruments
+parser = argparse.ArgumentParser()
+parser.add_argument('-n',
+                    '--n-particles',
+                    help='Number of particles released per release zone',
+                    type=int,
+                    default=100,
+                    metavar='')
+parsed_args = parser.parse_args(sys.argv[1:])
+
+file_name = convert_weights(parsed_args.n_particles, na_countries)
+
+# Check the store can be read back
+store = WeightsStore(file_name, verify=True)
+print(f'Saved weights for {len(store.emitters)} emitting countries to '
+      f'{file_name}')
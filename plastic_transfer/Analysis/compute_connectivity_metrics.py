@@ -2,11 +2,38 @@
 
 This script computes connectivity metrics for each run. It does this
 by flagging whether whether or not particles lie within the EEZ of
-each receiving country. The output is written to a netCDF file.
+each receiving country. The output is written to a netCDF file or,
+optionally, to a Zarr store shared by all releases from the emitting
+country (see `zarr_store.py`).
+
+By default, each receiving region is processed in turn, with one pass over
+the particle data per region. With `-a`, all regions are processed in a
+single pass. The region each particle lies in is updated from the region it
+was in at the previous time point, by testing that region and the regions
+bordering it first (see `region_labels.build_region_neighbour_table`). The
+flags written are unchanged.
+
+With `-g` (which implies `-a`), flags are also written for countries with
+more than one region (e.g. Portugal, with the Azores and Madeira), and for
+international waters. Country flags are formed by mapping region labels to
+country labels (see `region_labels.build_region_country_map`). Particles
+are in international waters if their host is an ocean element outside all
+receiving regions (see `region_labels.build_budget_label_table`), so
+particles on land or on invalid hosts are not flagged. These are only
+written to netCDF files.
+
+Several run scenarios can be given with `-s`, in which case they are
+processed in turn in the same job, sharing region lookup tables.
+
+Usage
+-----
+python compute_connectivity_metrics.py -c <country> -y <year> -m <month> [-f <format>] [-a] [-g] [-s <scenario> [<scenario> ...]]
 """
 
 import sys
 import os
+import functools
+import datetime
 import numpy as np
 import pathlib
 from cftime import date2num
@@ -14,117 +41,435 @@ import argparse
 
 from pylag.processing.ncview import Viewer
 
-from netcdf_utils import NetCDFFileCreator
+from netcdf_utils import NetCDFFileCreator, AsyncNetCDFWriter
+from netcdf_utils import get_compression_options, netcdf_lock
+from simulation_catalog import open_catalog
+from trajectory_cache import open_variable
+from prefetch import prefetch
+from zarr_store import ZarrConnectivityOutput, get_release_dates
+from region_labels import get_region_bitset, build_region_label_table
+from region_labels import build_region_bitsets, build_region_neighbour_table
+from region_labels import build_region_country_map, get_country_label_table
+from region_labels import build_budget_label_table
+from region_labels import outside_regions_budget_label
+from grid import get_grid_metrics
 from shared import na_countries, connectivity_netcdf_names
+from shared import international_waters_netcdf_var_name
+from shared import international_waters_netcdf_var_attrs
+from regions import countries
 from project_paths import simulations_dir
 
 import cython_helpers
 
 
-def process_emitting_country(emitting_country, year_str, month_str):
+class NetCDFConnectivityOutput(object):
+    """ Write connectivity flags for one release to a netCDF file
+
+    Flags are compressed and written on a background thread. Variables are
+    marked as incomplete until their last block has been written.
+    """
+
+    def __init__(self, file_name, emitting_country, dates, n_particles):
+        self.file_name = file_name
+        n_time_indices = len(dates)
+
+        # Create the file if it has not been created already
+        if not os.path.isfile(file_name):
+            title = f'Connectivity data for {emitting_country} river plastic emissions'
+            nc_file = NetCDFFileCreator(file_name, title)
+
+            # Add dimension data
+            nc_file.create_dimension('time', n_time_indices)
+            nc_file.create_dimension('particles', n_particles)
+
+            # Add time variable
+            time_attrs = {'units': 'seconds since 1990-01-01 00:00:00',
+                          'calendar': 'standard',
+                          'long_name': 'Time'}
+            time = date2num(dates, units=time_attrs['units'], calendar=time_attrs['calendar'])
+            nc_file.create_variable('time', time, ('time',), dtype=time.dtype, attrs=time_attrs)
+
+        else:
+            nc_file = NetCDFFileCreator(file_name)
+
+        self.nc_file = nc_file
+        self.chunksizes = (min(time_block_size, n_time_indices),
+                           min(particle_chunk_size, n_particles))
+
+        # Compress and write flags on a background thread
+        self.writer = AsyncNetCDFWriter(nc_file, queue_depth=writer_queue_depth)
+
+    def is_complete(self, var_name):
+        with netcdf_lock:
+            if var_name not in self.nc_file.ncfile.variables.keys():
+                return False
+            status = getattr(self.nc_file.ncfile.variables[var_name], 'status', '')
+
+        return status != 'incomplete'
+
+    def start_variable(self, var_name, var_attrs):
+        with netcdf_lock:
+            var_exists = var_name in self.nc_file.ncfile.variables.keys()
+
+        # Partially written variables are simply overwritten
+        if not var_exists:
+            self.writer.submit(self.nc_file.create_variable,
+                               var_name,
+                               None,
+                               ('time', 'particles',),
+                               flag_dtype,
+                               attrs=dict(var_attrs, status='incomplete'),
+                               chunksizes=self.chunksizes,
+                               ncopts=flag_ncopts)
+
+    def write_block(self, var_name, block, start):
+        self.writer.write_block(var_name, block, start=start)
+
+    def mark_complete(self, var_name):
+        self.writer.submit(self._remove_status, var_name)
+
+    def _remove_status(self, var_name):
+        self.nc_file.ncfile.variables[var_name].delncattr('status')
+
+    def close(self):
+        print(f'\nClosing file {self.file_name}')
+        self.writer.close_file()
+
+
+def get_var_name(receiving_region):
+    """ Return the name of the flag variable for `receiving_region` """
+    netcdf_region_name = connectivity_netcdf_names[receiving_region]
+    return f'is_present_in_waters_of_{netcdf_region_name}'
+
+
+def get_country_var_name(country):
+    """ Return the name of the flag variable for all regions of `country`
+
+    Countries are named after their first (main) region.
+    """
+    netcdf_region_name = connectivity_netcdf_names[countries[country].regions[0]]
+    return f'is_present_in_all_waters_of_{netcdf_region_name}'
+
+
+# Attributes of flag variables
+var_attrs = {'units': 'n/a',
+             'long_name': 'Binary flag indicating presence (=1) and absence (=0)'}
+
+
+@functools.lru_cache(maxsize=None)
+def get_region_lookups(regions):
+    """ Return lookup tables for processing `regions` in a single pass
+
+    Lookups are cached, so they are shared by all releases and scenarios
+    processed in a job.
+
+    Parameters
+    ----------
+    regions : tuple
+        The receiving regions.
+
+    Returns
+    -------
+    region_labels : 1D NumPy array
+        Region labels for each element (see
+        `region_labels.build_region_label_table`).
+
+    region_bitsets : 2D NumPy array
+        Bitsets of the elements in each region.
+
+    region_neighbours : 2D NumPy array
+        The neighbours of each region.
+
+    region_countries : 1D NumPy array
+        The country index of each region.
+
+    country_keys : list
+        The countries.
+    """
+    region_labels = build_region_label_table(list(regions))
+    region_bitsets = build_region_bitsets(list(regions), region_labels.shape[0])
+    region_neighbours = build_region_neighbour_table(list(regions))
+    region_countries, country_keys = build_region_country_map(list(regions))
+
+    return (region_labels, region_bitsets, region_neighbours,
+            region_countries, country_keys)
+
+
+@functools.lru_cache(maxsize=None)
+def get_budget_label_table():
+    """ Return the budget label of each element
+
+    The table is cached, so it is shared by all releases and scenarios
+    processed in a job (see `region_labels.build_budget_label_table`).
+    """
+    return build_budget_label_table(get_grid_metrics().mask)
+
+
+def process_emitting_country(emitting_country, year_str, month_str,
+                             output_format='netcdf', use_adjacency=False,
+                             aggregate=False, scenario=None):
+    if scenario is None:
+        scenario = default_scenario
+
     print(f'Processing data for emitting country {emitting_country} and '
-          f'month {month_str}')
+          f'month {month_str} in scenario {scenario}')
 
     # Path to the run output file
     pylag_data_dir = f'{root_dir}/{scenario}/{emitting_country}/{year_str}/{month_str}/output'
     pylag_data = f'{pylag_data_dir}/pylag_1.nc'
 
-    # Open the output file for reading
-    pylag_viewer = Viewer(pylag_data, time_rounding=3600)
+    # Use the simulation catalog for dimension sizes and dates if possible
+    pylag_viewer = None
+    catalog = open_catalog(f'{root_dir}/{scenario}')
+    if catalog is not None and pylag_data in catalog:
+        n_dates = catalog[pylag_data].n_times
+        n_particles = catalog[pylag_data].n_particles
 
-    # Get dimension sizes (workaround as can't access dimensions directly)
-    n_dates = pylag_viewer._ds.dimensions['time'].size
-    n_particles = pylag_viewer._ds.dimensions['particles'].size
+        # The set of time indices to process
+        time_indices = np.arange(0, n_dates, time_step)
 
-    # Extract dates
-    pylag_dates = pylag_viewer.date
+        dates = np.array(catalog.get_dates(pylag_data, time_indices))
+    else:
+        # Open the output file for reading
+        pylag_viewer = Viewer(pylag_data, time_rounding=3600)
 
-    # The set of time indices to process
-    time_indices = np.arange(0, n_dates, time_step)
+        # Get dimension sizes (workaround as can't access dimensions directly)
+        n_dates = pylag_viewer._ds.dimensions['time'].size
+        n_particles = pylag_viewer._ds.dimensions['particles'].size
+
+        # The set of time indices to process
+        time_indices = np.arange(0, n_dates, time_step)
+
+        # Extract dates
+        dates = pylag_viewer.date[time_indices]
 
     # The total number of time indices to process
     n_time_indices = time_indices.shape[0]
     print(f'Processing data for {n_time_indices} time points between '
-          f'{pylag_dates[0]} and {pylag_dates[-1]}')
+          f'{dates[0]} and {dates[-1]}')
+
+    # Host elements, read from the trajectory cache if there is one
+    host_var = open_variable(pylag_data, 'host_arakawa_a', catalog,
+                             pylag_viewer)
 
-    dates = pylag_dates[time_indices]
+    if aggregate:
+        if output_format != 'netcdf':
+            raise ValueError('Country and international waters flags can '
+                             'only be written to netCDF files')
+        use_adjacency = True
 
     # Output file
     # -----------
     root_out_dir = f'../Derived_data/connectivity/{scenario}'
-    year_out_dir = f'{root_out_dir}/{year_str}'
-    month_out_dir = f'{year_out_dir}/{month_str}'
-    pathlib.Path(month_out_dir).mkdir(parents=True, exist_ok=True)
-    file_name = f'{month_out_dir}/{emitting_country}_connectivity_{year_str}_{month_str}.nc'
-    # Create the file if it has not been created already
-    if not os.path.isfile(file_name):
-        title = f'Connectivity data for {emitting_country} river plastic emissions'
-        nc_file = NetCDFFileCreator(file_name, title)
-
-        # Add dimension data
-        nc_file.create_dimension('time', n_time_indices)
-        nc_file.create_dimension('particles', n_particles)
-
-        # Add time variable
-        time_attrs = {'units': 'seconds since 1990-01-01 00:00:00',
-                      'calendar': 'standard',
-                      'long_name': 'Time'}
-        time = date2num(dates, units=time_attrs['units'], calendar=time_attrs['calendar'])
-        nc_file.create_variable('time', time, ('time',), dtype=time.dtype, attrs=time_attrs)
-
+    if output_format == 'zarr':
+        release_date = datetime.datetime(int(year_str), int(month_str),
+                                         release_day, release_hour)
+        store_path = f'{root_out_dir}/zarr/{emitting_country}_connectivity.zarr'
+        output = ZarrConnectivityOutput(store_path,
+                                        get_release_dates(first_release_year,
+                                                          last_release_year,
+                                                          release_day,
+                                                          release_hour),
+                                        release_date, dates, n_particles,
+                                        max_n_times,
+                                        time_chunk_size=time_block_size,
+                                        particle_chunk_size=particle_chunk_size)
     else:
-        nc_file = NetCDFFileCreator(file_name)
-   
+        year_out_dir = f'{root_out_dir}/{year_str}'
+        month_out_dir = f'{year_out_dir}/{month_str}'
+        pathlib.Path(month_out_dir).mkdir(parents=True, exist_ok=True)
+        file_name = f'{month_out_dir}/{emitting_country}_connectivity_{year_str}_{month_str}.nc'
+        output = NetCDFConnectivityOutput(file_name, emitting_country, dates,
+                                          n_particles)
+
+    def read_hosts(tidx_new):
+        if isinstance(host_var, np.ndarray):
+            # Memory-mapped cache
+            return np.asarray(host_var[time_indices[tidx_new], :], dtype=np.int32)
+
+        with netcdf_lock:
+            return np.asarray(host_var[time_indices[tidx_new], :], dtype=np.int32)
+
     # Process all receiving countries
     # -------------------------------
 
+    if use_adjacency:
+        process_regions_by_adjacency(output, read_hosts, n_time_indices,
+                                     n_particles, aggregate)
+        output.close()
+        return
+
     # Compute connectivity metrics
     for receiving_region in receiving_regions:
         
         print(f'\nComputing connectivity metrics for receiving region {receiving_region}')
 
-        # Generate variable name and attributes
-        netcdf_region_name = connectivity_netcdf_names[receiving_region]
-        var_name = f'is_present_in_waters_of_{netcdf_region_name}'
-        var_attrs = {'units': 'n/a',
-                     'long_name': 'Binary flag indicating presence (=1) and absence (=0)'}
-        
-        # Check to see if the country has been processed already
-        if var_name in nc_file.ncfile.variables.keys():
+        # Generate variable name
+        var_name = get_var_name(receiving_region)
+
+        # Check to see if the country has been processed already. Flags are
+        # written in blocks and variables are only marked as complete once
+        # the last block has been written, so partially written variables
+        # are redone.
+        if output.is_complete(var_name):
             print(f'\n ... data for receiving region {receiving_region} '
                   f'has been processed already')
-            continue 
-
-        # Read in valid boundary elements for the receiving country
-        bdy_dir = '../Derived_data/grid_elements/EEZ'
-        bdy_file_name = f'{bdy_dir}/grid_elements_for_{receiving_region}_EEZ_boundary.csv'
-        bdy_elements = np.fromfile(bdy_file_name, sep=',')
-        bdy_elements = np.sort(np.array(bdy_elements, dtype=np.int32))
-       
-        # Array in which to store in/out flags
-        within = np.zeros((n_time_indices, n_particles), dtype=int)
-        
-        # Loop over all time points and compute how many host elements match those
-        # that lie within the specified area
-        for tidx_new, tidx_old in enumerate(time_indices):
-            hosts = pylag_viewer('host_arakawa_a')[tidx_old, :].astype(np.int32)
-            within[tidx_new, :] = cython_helpers.match_elements(hosts, bdy_elements, num_threads=8)
+            continue
 
-        nc_file.create_variable(var_name,
-                                within,
-                                ('time', 'particles',),
-                                within.dtype,
-                                attrs=var_attrs)
+        output.start_variable(var_name, var_attrs)
 
-    print(f'\nClosing file {file_name}')
-    nc_file.close_file()
+        # Bitset of valid boundary elements for the receiving country
+        bdy_bitset = get_region_bitset(receiving_region)
+
+        # Array in which to store in/out flags for a block of time points
+        within = np.zeros((time_block_size, n_particles), dtype=flag_dtype)
+
+        # Loop over all time points and compute how many host elements match those
+        # that lie within the specified area. Host elements are read on a
+        # background thread while earlier time points are processed. Flags
+        # are written to file each time a block of time points is complete.
+        for tidx_new, hosts in prefetch(read_hosts, range(n_time_indices),
+                                        queue_depth=prefetch_queue_depth,
+                                        max_bytes=prefetch_max_bytes,
+                                        num_workers=num_io_threads):
+            block_idx = tidx_new % time_block_size
+            cython_helpers.match_elements_bitset(hosts, bdy_bitset,
+                                                 num_threads=8,
+                                                 out=within[block_idx, :])
+
+            if block_idx == time_block_size - 1 or tidx_new == n_time_indices - 1:
+                block_start = tidx_new - block_idx
+                output.write_block(var_name, within[:block_idx + 1, :], block_start)
+
+        output.mark_complete(var_name)
+
+    output.close()
+
+
+def process_regions_by_adjacency(output, read_hosts, n_time_indices,
+                                 n_particles, aggregate=False):
+    """ Compute flags for all receiving regions in a single pass
+
+    The region each particle lies in is tracked through time with
+    `cython_helpers.update_region_labels`, and flags for each region are
+    formed from the labels when a block of time points is complete.
+    Receiving regions must not overlap.
+
+    Parameters
+    ----------
+    output : NetCDFConnectivityOutput or zarr_store.ZarrConnectivityOutput
+        The output to which flags are written.
+
+    read_hosts : callable
+        Returns the host elements at a given time index.
+
+    n_time_indices, n_particles : int
+        The number of time points and particles.
+
+    aggregate : bool, optional
+        If True, flags are also written for countries with more than one
+        region, and for international waters. Default: False.
+    """
+    regions = list(receiving_regions)
+    region_labels, region_bitsets, region_neighbours, region_countries, \
+        country_keys = get_region_lookups(tuple(regions))
+
+    # Flag variables and the labels they correspond to: region labels, then
+    # country labels and, for international waters, the budget label of
+    # ocean elements outside all regions
+    candidates = [('region', region_idx, receiving_region,
+                   get_var_name(receiving_region), var_attrs)
+                  for region_idx, receiving_region in enumerate(regions)]
+    if aggregate:
+        candidates += [('country', country_idx, country,
+                        get_country_var_name(country), var_attrs)
+                       for country_idx, country in enumerate(country_keys)
+                       if len(countries[country].regions) > 1]
+        candidates.append(('budget', outside_regions_budget_label,
+                           'international waters',
+                           international_waters_netcdf_var_name,
+                           international_waters_netcdf_var_attrs))
+
+    # Only variables that have not been processed already are written
+    pending = []
+    for kind, label, name, var_name, attrs in candidates:
+        if output.is_complete(var_name):
+            print(f'\n ... data for {name} has been processed already')
+            continue
+        pending.append((kind, label, var_name, attrs))
+
+    if len(pending) == 0:
+        return
+
+    print(f'\nComputing connectivity metrics for {len(pending)} regions '
+          f'in a single pass')
+
+    for _, _, var_name, attrs in pending:
+        output.start_variable(var_name, attrs)
+
+    country_label_table = get_country_label_table(region_countries)
+
+    # Budget labels are only needed for international waters
+    use_budget_labels = any(kind == 'budget' for kind, _, _, _ in pending)
+    if use_budget_labels:
+        budget_label_table = get_budget_label_table()
+        budget_labels_block = np.empty((time_block_size, n_particles),
+                                       dtype=np.int16)
+
+    # The region each particle lies in, and labels for a block of time points
+    labels = np.full(n_particles, -1, dtype=np.int16)
+    labels_block = np.empty((time_block_size, n_particles), dtype=np.int16)
+    within = np.zeros((time_block_size, n_particles), dtype=flag_dtype)
+
+    n_full_tests = 0
+    for tidx_new, hosts in prefetch(read_hosts, range(n_time_indices),
+                                    queue_depth=prefetch_queue_depth,
+                                    max_bytes=prefetch_max_bytes,
+                                    num_workers=num_io_threads):
+        block_idx = tidx_new % time_block_size
+        n_full_tests += cython_helpers.update_region_labels(hosts, labels,
+                                                            region_labels,
+                                                            region_bitsets,
+                                                            region_neighbours,
+                                                            num_threads=8)
+        labels_block[block_idx, :] = labels
+
+        if use_budget_labels:
+            # Hosts outside the grid are given the label -1
+            valid_hosts = (hosts >= 0) & (hosts < budget_label_table.shape[0])
+            budget_labels_block[block_idx, :] = -1
+            budget_labels_block[block_idx, valid_hosts] = \
+                budget_label_table[hosts[valid_hosts]]
+
+        if block_idx == time_block_size - 1 or tidx_new == n_time_indices - 1:
+            block_start = tidx_new - block_idx
+            block_labels = {'region': labels_block[:block_idx + 1, :]}
+            if aggregate:
+                block_labels['country'] = country_label_table[block_labels['region']]
+            if use_budget_labels:
+                block_labels['budget'] = budget_labels_block[:block_idx + 1, :]
+
+            for kind, label, var_name, _ in pending:
+                np.equal(block_labels[kind], label,
+                         out=within[:block_idx + 1, :])
+                output.write_block(var_name, within[:block_idx + 1, :],
+                                   block_start)
+
+    for _, _, var_name, _ in pending:
+        output.mark_complete(var_name)
+
+    n_tests = n_time_indices * n_particles
+    if n_tests > 0:
+        print(f'Full region re-tests were needed for {n_full_tests} of '
+              f'{n_tests} particle positions '
+              f'({100. * n_full_tests / n_tests:.1f}%)')
 
 
 # Directory where simulation results can be found
 root_dir = simulations_dir
 
-# The run scenario
-scenario = 'ocean_leeway'
+# The default run scenario
+default_scenario = 'ocean_leeway'
 
 # The months that were run
 months = range(1, 13)
@@ -136,6 +481,38 @@ time_step = 1
 # The list of receiving countries
 receiving_regions = connectivity_netcdf_names.keys()
 
+# Flags are computed and written in blocks of time points, which are also
+# used as the chunk size along the time dimension. Chunks span a limited
+# number of particles so that both time series and snapshots can be read
+# efficiently. Binary flags are stored as int8, as in the Zarr stores, and
+# compress well at a low compression level, which is much faster than the
+# default.
+time_block_size = 32
+particle_chunk_size = 8192
+flag_dtype = np.int8
+flag_ncopts = get_compression_options(zlib=True, complevel=1, shuffle=True)
+
+# The number of blocks that can be waiting to be written to file
+writer_queue_depth = 4
+
+# Parameters for Zarr output. All releases for an emitter are held in a
+# single store, which spans releases made between the first and last release
+# years. Runs are padded to the length of the longest run (2000-01-01 to
+# 2015-01-01, saved daily).
+release_day = 1
+release_hour = 12
+first_release_year = 2000
+last_release_year = 2014
+max_n_times = 5480
+
+# Parameters for prefetching host elements: the number of I/O threads, the
+# maximum number of time points read ahead and a cap on the memory they use.
+# Only use more than one I/O thread if HDF5 is thread safe, or the release
+# has been cached with `build_trajectory_cache.py`.
+num_io_threads = 1
+prefetch_queue_depth = 8
+prefetch_max_bytes = 1024**3
+
 
 if __name__ == "__main__":
     # Parse command line agruments
@@ -143,8 +520,23 @@ if __name__ == "__main__":
     parser.add_argument('-c', '--country', help='Name of emitting country',  metavar='')
     parser.add_argument('-y', '--year', help='Year',  metavar='')
     parser.add_argument('-m', '--month', help='Month number',  metavar='')
+    parser.add_argument('-f', '--format', help='Output format (netcdf or zarr)',
+                        choices=['netcdf', 'zarr'], default='netcdf', metavar='')
+    parser.add_argument('-a', '--adjacency', help='Process all receiving '
+                        'regions in a single pass, testing the previous '
+                        'region of each particle and its neighbours first',
+                        action='store_true')
+    parser.add_argument('-g', '--aggregate', help='Also write flags for '
+                        'countries with several regions and for '
+                        'international waters (ocean outside all '
+                        'regions; implies -a)',
+                        action='store_true')
+    parser.add_argument('-s', '--scenario', help='Run scenario(s). Default: '
+                        f'{default_scenario}', nargs='+',
+                        default=[default_scenario], metavar='')
     parsed_args = parser.parse_args(sys.argv[1:])
 
+
     # Check country    
     country = parsed_args.country
     if country not in na_countries:
@@ -159,5 +551,8 @@ if __name__ == "__main__":
     if month_str_in not in valid_month_strs:
         raise RuntimeError(f'Invalid month {month}')
 
-    # Run the job
-    process_emitting_country(country, year_str_in, month_str_in)
+    # Run the job for each scenario
+    for scenario in parsed_args.scenario:
+        process_emitting_country(country, year_str_in, month_str_in,
+                                 parsed_args.format, parsed_args.adjacency,
+                                 parsed_args.aggregate, scenario)
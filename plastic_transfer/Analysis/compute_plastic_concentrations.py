@@ -0,0 +1,292 @@
+""" Compute gridded plastic mass concentrations
+
+This script bins the decay-adjusted masses of all particles onto a regular
+lat/lon grid for each day in a given month, and divides by the area of
+each grid cell to give the mass concentration. To do this, it:
+
+1) Cycles over the days in the month.
+2) For each day, cycles over the emitting countries and all releases that
+precede that day.
+3) Reads particle positions for the day from each release, and adds the
+decay-adjusted particle masses to the grid (see `utils.grid_masses`).
+Alternatively, with `-g elements`, only host elements are read, and masses
+are gridded using a precomputed map from elements to grid cells (see
+`grid_cell_mapping.py`). This is much faster, but places particles at the
+centre of their host element.
+4) Divides the gridded masses by the cell areas, and writes the day's
+concentrations to file.
+
+Only one day's grid is held in memory at a time, with each day written to
+the output file on a background thread as soon as it is complete. Positions
+are read through the trajectory cache when one exists (see
+`build_trajectory_cache.py`, with `--positions` when gridding by position),
+and are read ahead on background threads. HDF5 is not always thread safe,
+so reads from and writes to netCDF files are made while holding
+`netcdf_lock`.
+
+Usage
+-----
+python compute_plastic_concentrations.py -y <year> -m <month> [-c <country>] [-g <gridding>]
+"""
+import sys
+import argparse
+import pathlib
+import datetime
+from calendar import monthrange
+
+import numpy as np
+
+from pylag.processing.ncview import Viewer
+
+from shared import na_countries
+from utils import generate_grid, grid_masses, get_release_file_list
+from utils import get_weights
+from decay_models import get_default_decay_model
+from grid_cell_mapping import get_element_cell_map, grid_host_masses
+from netcdf_utils import MassConcNetCDFFileCreator, AsyncNetCDFWriter
+from netcdf_utils import disclaimer, netcdf_lock
+from simulation_catalog import open_catalog
+from trajectory_cache import open_variable
+from prefetch import prefetch
+from project_paths import simulations_dir
+
+
+def read_particle_data(file_path, current_date, var_names, catalog=None):
+    """ Read particle data on `current_date` from a PyLag output file
+
+    Parameters
+    ----------
+    file_path : str
+        Path to the PyLag output file.
+
+    current_date : datetime.datetime
+        The date for which data are read.
+
+    var_names : tuple
+        The variables to read.
+
+    catalog : simulation_catalog.SimulationCatalog, optional
+        The simulation catalog. Default: None.
+
+    Returns
+    -------
+    n_groups : int
+        The number of release zones (groups) in the file.
+
+    tidx : int
+        The time index of `current_date`.
+
+    data : list
+        1D NumPy arrays holding the data for each variable.
+    """
+    # Output files are written on another thread, so netCDF files are only
+    # accessed while holding the lock
+    with netcdf_lock:
+        pylag_viewer = None
+        if catalog is not None:
+            n_groups = catalog[file_path].n_groups
+            tidx = catalog.get_time_index(file_path, current_date)
+        else:
+            pylag_viewer = Viewer(file_path, time_rounding=3600)
+            n_groups = int(pylag_viewer._ds.dimensions['particles'].size / n_particles_prz)
+            tidx = pylag_viewer.date.tolist().index(current_date)
+
+        data = [np.asarray(open_variable(file_path, var_name, catalog,
+                                         pylag_viewer)[tidx])
+                for var_name in var_names]
+
+    return n_groups, tidx, data
+
+
+def process_month(year, month, emitters, label, gridding='positions'):
+    """ Compute gridded mass concentrations for each day in a month
+
+    Parameters
+    ----------
+    year, month : int
+        The year and month.
+
+    emitters : list
+        The emitting countries whose plastic is included.
+
+    label : str
+        Label used in the output file name.
+
+    gridding : str, optional
+        How particles are assigned to grid cells: 'positions', using
+        particle positions, or 'elements', using host elements and a
+        precomputed map from elements to grid cells. Default: 'positions'.
+
+    Returns
+    -------
+     : str
+        Path to the output file.
+    """
+    print(f'Computing plastic concentrations for {label} in month '
+          f'{month:02} of year {year}')
+
+    # Read weights. Decay coefficients are evaluated by the decay model.
+    weights, _ = get_weights(n_particles_prz, emitters, read_decay_coefs=False)
+
+    lons_grid, lats_grid, lon_bin_edges, lat_bin_edges, land_mask, areas = \
+        generate_grid(grid_spacing, use_global_land_mask)
+
+    if gridding == 'positions':
+        var_names = ('longitude', 'latitude')
+    elif gridding == 'elements':
+        var_names = ('host_arakawa_a',)
+        element_cells = get_element_cell_map(grid_spacing)
+    else:
+        raise ValueError(f'Unknown gridding method {gridding}')
+
+    # Open the simulation catalog, if one has been built
+    catalog = open_catalog(pylag_root_dir)
+
+    # Form the list of (day, emitter, file) tasks, ordered by day
+    dates = [datetime.datetime(year, month, day, release_hour)
+             for day in range(1, monthrange(year, month)[1] + 1)]
+    tasks = []
+    for day_idx, current_date in enumerate(dates):
+        for emitting_country in emitters:
+            file_paths = get_release_file_list(pylag_root_dir,
+                                               emissions_start_date,
+                                               current_date,
+                                               emitting_country,
+                                               catalog=catalog)
+
+            for file_path in file_paths:
+                tasks.append((day_idx, emitting_country, current_date, file_path))
+
+    # Create the output file
+    out_dir = f'../Derived_data/plastic_concentration/{label}/{year}/{month:02}'
+    pathlib.Path(out_dir).mkdir(parents=True, exist_ok=True)
+    file_name = f'{out_dir}/plastic_concentration_{label}_{year}_{month:02}.nc'
+
+    nc_file = MassConcNetCDFFileCreator(file_name)
+    nc_file.create_time(dates)
+    nc_file.create_latitude(lats_grid)
+    nc_file.create_longitude(lons_grid)
+    nc_file.create_variable(var_name, None, 'f4', fill_value, fill_value,
+                            {'standard_name': 'plastic_mass_concentration',
+                             'long_name': 'Mass concentration of floating '
+                                          'plastic',
+                             'units': 'g km-2'},
+                            n_dims=3)
+    nc_file.set_global_attributes({'title': 'Floating plastic mass concentrations',
+                                   'emitters': ', '.join(emitters),
+                                   'grid_spacing': grid_spacing,
+                                   'gridding': gridding,
+                                   'disclaimer': disclaimer})
+
+    # Compress and write days on a background thread
+    writer = AsyncNetCDFWriter(nc_file, queue_depth=writer_queue_depth)
+
+    # Conversion from tonnes per m^2 to g km^-2
+    conversion_factors = 1.e12 / areas
+
+    def write_day(day_idx, masses):
+        concentrations = masses * conversion_factors
+        if land_mask is not None:
+            concentrations[land_mask] = fill_value
+        writer.write_block(var_name, concentrations[np.newaxis, :, :], day_idx)
+
+    # Gridded masses for the current day
+    masses = np.zeros(areas.shape, dtype=np.float64)
+    current_day_idx = 0
+
+    # Read particle data on background threads while masses are gridded
+    for task, (n_groups, tidx, data) in prefetch(
+            lambda task: read_particle_data(task[3], task[2], var_names,
+                                            catalog), tasks,
+            queue_depth=prefetch_queue_depth, max_bytes=prefetch_max_bytes,
+            num_workers=num_io_threads):
+        day_idx, emitting_country = task[0], task[1]
+
+        # Write out the previous day once all its releases are gridded
+        while current_day_idx < day_idx:
+            print(f'Writing data for day {dates[current_day_idx].day}')
+            write_day(current_day_idx, masses)
+            masses[:] = 0.0
+            current_day_idx += 1
+
+        decay_coefs = decay_model.get_tiled_coefficients(int(tidx), n_groups)
+        decayed_weights = weights[emitting_country] * decay_coefs
+
+        if gridding == 'positions':
+            grid_masses(data[0], data[1], decayed_weights, lon_bin_edges,
+                        lat_bin_edges, out=masses)
+        else:
+            grid_host_masses(data[0], decayed_weights, element_cells,
+                             masses.shape, out=masses)
+
+    # Write out the remaining days
+    while current_day_idx < len(dates):
+        print(f'Writing data for day {dates[current_day_idx].day}')
+        write_day(current_day_idx, masses)
+        masses[:] = 0.0
+        current_day_idx += 1
+
+    writer.close_file()
+
+    return file_name
+
+
+# Grid spacing in decimal degrees
+grid_spacing = 0.25
+
+# Mask cells on land, using the global_land_mask package
+use_global_land_mask = True
+
+# Output variable name and fill value
+var_name = 'plastic_conc'
+fill_value = -999.
+
+# The number of days that can be waiting to be written to file
+writer_queue_depth = 2
+
+# Parameters for prefetching particle data (see compute_plastic_stock_in_eezs.py)
+num_io_threads = 1
+prefetch_queue_depth = 4
+prefetch_max_bytes = 2 * 1024**3
+
+# Location where simulation outputs are stored
+pylag_root_dir = simulations_dir
+
+# The number of partcles released per release zone
+n_particles_prz = 100
+
+# Model for the loss of plastic from the surface ocean
+decay_model = get_default_decay_model(n_particles_prz)
+
+# The date when monthly emissions started
+release_day = 1
+release_hour = 12
+emissions_start_date = datetime.datetime(2000, 1, release_day, release_hour)
+
+
+if __name__ == "__main__":
+    # Parse command line agruments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-y', '--year', help='Target year', metavar='')
+    parser.add_argument('-m', '--month', help='Target month', metavar='')
+    parser.add_argument('-c', '--country', help='Name of emitting country. '
+                                                'Default: all countries',
+                        default=None, metavar='')
+    parser.add_argument('-g', '--gridding', help='Grid particles by position '
+                                                 '(positions) or host element '
+                                                 '(elements)',
+                        choices=['positions', 'elements'], default='positions',
+                        metavar='')
+    parsed_args = parser.parse_args(sys.argv[1:])
+
+    if parsed_args.country is None:
+        target_emitters = list(na_countries)
+        target_label = 'All_countries'
+    else:
+        if parsed_args.country not in na_countries:
+            raise RuntimeError(f'Invalid country name {parsed_args.country}')
+        target_emitters = [parsed_args.country]
+        target_label = parsed_args.country
+
+    process_month(int(parsed_args.year), int(parsed_args.month),
+                  target_emitters, target_label, parsed_args.gridding)
@@ -2,19 +2,65 @@
 
 To do this, it:
 
-1) For a given receiving region, cycles over all emitting countries.
+1) For the given receiving regions, cycles over all emitting countries.
 2) For a given emitting country, cycles over all releases for that year and
 before.
 3) Sums the mass of plastic in each element that lies within the EEZ
-of the receiving country.
+of each receiving country, in a single pass over the particles.
 4) This operation is repeated for each day in the year.
 5) The output of the previous step is saved to file. From this, the
 annual mean is calculated.
 
+In the same pass, the number of particles in each EEZ is counted. Summed
+over the days of the month, these give the residence time of each emitting
+country's plastic within the EEZ as particle-days. These are saved
+alongside the stock, and are combined into annual matrices by
+`build_residence_time_matrices.py`. Decay-adjusted mass-days (tonne-days)
+are the sum of the daily stocks, so are not saved separately.
+
+A mass budget is also computed in the same pass, for each day and emitting
+country: the mass emitted, the mass remaining after decay, and how the
+remaining mass is split between the regions (all EEZs in `shared.eez_names`),
+other waters (ocean outside all regions, including the EEZs of other
+countries) and invalid (land or out of range) host elements (see
+`region_labels.build_budget_label_table`). The total after decay is
+computed from the mass emitted in each decay class and the decay
+coefficients, independently of the particles, and the sum of the three
+parts is checked against it. An error is raised if the budget does not
+close. The budget does not depend on the regions processed, and is saved to
+`../Derived_data/mass_budget`.
+
+With `-s`, one or more run scenarios (subdirectories of the simulations
+directory, e.g. `ocean_leeway` or `wind_factor/3_percent`) are processed in
+the same job. Region and budget label tables and particle weights are
+built once and shared by all scenarios (see `StockLookups`), as are the
+cached decay coefficients. Outputs for each scenario are saved with the
+usual layout under `../Derived_data/scenarios/<scenario>`. Monthly mean
+stock matrices for each scenario, less those for the first scenario, are
+saved to `../Results/plastic_stocks/scenario_differences`.
+
+Optionally, stocks can also be computed for a sweep over alternative decay
+parameters (see `decay_models.py`). All parameter sets are evaluated in the
+same pass over the trajectories. Sampling uncertainty can be estimated by
+bootstrap resampling of particles (see `bootstrap.py`), again in the same
+pass.
+
+With `-g`, stocks, residence times and any sweep or bootstrap outputs are
+also aggregated to countries (e.g. Portugal, with the Azores and Madeira)
+and to Other Waters, from the same region labels. Country totals are
+formed from region totals with a region-to-country index map (see
+`region_labels.build_region_country_map`), and are saved under
+directories ending in `_country`. Only countries whose regions are all
+being processed are included. Other Waters is the mass on ocean elements
+outside all regions, i.e. with the other waters budget label (see
+`region_labels.build_budget_label_table`), whichever regions are
+processed. Mass on land and on invalid hosts is not included.
+
 Usage
 -----
-python compute_plastic_stock_in_eezs.py -r <region> -y <year> -m <month>
+python compute_plastic_stock_in_eezs.py -r <region> [<region> ...] -y <year> -m <month> [-f <format>] [-d <decay_sweep_csv>] [-b <n_replicates>] [-g] [-s <scenario> [<scenario> ...]]
 """
+import os
 import sys
 import numpy as np
 import argparse
@@ -27,25 +73,146 @@ from collections import OrderedDict
 
 from pylag.processing.ncview import Viewer
 
-from shared import na_countries
-from utils import get_pylag_file_list
+from shared import na_countries, eez_names
+from regions import other_waters
+from utils import get_release_file_list
 from utils import get_weights
+from decay_models import get_default_decay_model, read_decay_sweep
+from bootstrap import get_bootstrap_counts
+from simulation_catalog import open_catalog
+from trajectory_cache import open_variable
+from prefetch import prefetch
+from region_labels import build_region_label_table
+from region_labels import build_region_country_map, aggregate_to_countries
+from region_labels import build_budget_label_table, budget_labels
+from region_labels import outside_regions_budget_label
+from grid import get_grid_metrics
+from zarr_store import require_stock_store, write_stock
 from project_paths import simulations_dir
 
 import cython_helpers
 
 
-def process_receiving_region(region, year, month, num_threads=8):
-    """ Process data for the the receiving region `region`
+def read_hosts(file_path, current_date, catalog=None):
+    """ Read host elements for `current_date` from a single release file
+
+    Parameters
+    ----------
+    file_path : str
+        Path to the PyLag output file.
+
+    current_date : datetime.datetime
+        The date for which host elements are read.
+
+    catalog : simulation_catalog.SimulationCatalog, optional
+        The simulation catalog. Default: None.
+
+    Returns
+    -------
+    n_groups : int
+        The number of release zones (groups) in the file.
+
+    tidx : int
+        The time index of `current_date`.
+
+    hosts : 1D NumPy array
+        The host elements of all particles, as int32.
+    """
+    pylag_viewer = None
+    if catalog is not None:
+        # Look up the number of groups and the index of the
+        # current date without reading the file's time array
+        n_groups = catalog[file_path].n_groups
+        tidx = catalog.get_time_index(file_path, current_date)
+    else:
+        # Open the output file for reading
+        pylag_viewer = Viewer(file_path, time_rounding=3600)
+
+        n_groups = int(pylag_viewer._ds.dimensions['particles'].size / n_particles_prz)
 
-    Stocks are estimated for each year, and are broken down
-    by contributing country. Outputs are saved as pickle
-    files.
+        # Extract dates
+        pylag_dates = pylag_viewer.date
+
+        # Get the index of the current date
+        tidx = pylag_dates.tolist().index(current_date)
+
+    # Get host elems, reading from the trajectory cache if there is one
+    host_var = open_variable(file_path, 'host_arakawa_a', catalog,
+                             pylag_viewer)
+    hosts = np.asarray(host_var[tidx], dtype=np.int32)
+
+    return n_groups, tidx, hosts
+
+
+class StockLookups(object):
+    """ Lookup tables used when computing stocks
+
+    Lookups only depend on the regions being processed, so are shared by
+    all scenarios processed in a job.
 
     Parameters
     ----------
-    region : str
-        The region (EEZ) for which stocks are to be computed.
+    regions : list
+        The regions (EEZs) for which stocks are to be computed.
+    """
+
+    def __init__(self, regions):
+        self.regions = list(regions)
+
+        # Read weights. Decay coefficients are evaluated by the decay model.
+        self.weights, _ = get_weights(n_particles_prz, na_countries,
+                                      read_decay_coefs=False)
+        self.weight_sums = {emitting_country: self.weights[emitting_country].sum()
+                            for emitting_country in na_countries}
+
+        # The mass emitted in each decay class, used to compute the total
+        # after decay in the mass budget
+        self.class_weight_sums = {
+            emitting_country: self.weights[emitting_country].reshape(
+                -1, n_particles_prz).sum(axis=0)
+            for emitting_country in na_countries}
+
+        # Build the table giving the index of the region each element lies in
+        self.region_labels = build_region_label_table(self.regions)
+
+        # Budget labels for each element, and a label table selecting ocean
+        # elements outside all regions (Other Waters)
+        self.budget_label_table = build_budget_label_table(get_grid_metrics().mask)
+        self.other_waters_labels = np.where(
+            self.budget_label_table == outside_regions_budget_label,
+            0, -1).astype(np.int16)
+
+
+def get_scenario_dirs(scenario):
+    """ Return the simulations and output directories for `scenario`
+
+    If `scenario` is None, simulations are read from `pylag_root_dir` and
+    outputs are saved to `../Derived_data`.
+    """
+    if scenario is None:
+        return pylag_root_dir, '../Derived_data'
+
+    return f'{pylag_root_dir}/{scenario}', f'../Derived_data/scenarios/{scenario}'
+
+
+def process_receiving_regions(regions, year, month, num_threads=8,
+                              output_format='pickle', decay_sweep=None,
+                              n_bootstrap=0, aggregate=False, scenario=None, lookups=None):
+    """ Process data for the the receiving regions `regions`
+
+    Stocks are estimated for each day in the month, and are broken down
+    by contributing country. All regions are processed in a single pass
+    over the particle data: the host element of each particle is looked
+    up in a region label table, and particle masses are summed into the
+    region in which they lie. Outputs are saved as pickle files, with one
+    file per region. Monthly residence times (particle-days) are computed
+    in the same pass, and are always saved as pickle files.
+
+    Parameters
+    ----------
+    regions : list
+        The regions (EEZs) for which stocks are to be computed. Regions must
+        not overlap.
 
     year : int
         The year in which stocks will be computed.
@@ -55,108 +222,509 @@ def process_receiving_region(region, year, month, num_threads=8):
 
     num_threads : int
         The number of threads to use in support of the calculation.
+
+    output_format : str, optional
+        Either 'pickle', to save outputs as pickle files, or 'zarr', to
+        save them in the shared stock store (see `zarr_store.py`). Default:
+        'pickle'.
+
+    decay_sweep : decay_models.DecaySweep, optional
+        Additional sets of decay parameters for which stocks are computed
+        in the same pass. Stocks for each parameter set are saved as pickle
+        files, with the same layout as the main outputs, under a directory
+        named after the parameter set. Default: None.
+
+    n_bootstrap : int, optional
+        The number of bootstrap replicates, in which particles are
+        resampled within each release zone (see `bootstrap.py`). Replicate
+        stocks, summed over the days of the month, are saved for each
+        region and are combined into annual confidence intervals by
+        `build_bootstrap_stock_matrices.py`. Default: 0, meaning no
+        bootstrap.
+
+    aggregate : bool, optional
+        If True, outputs are also saved for each country whose regions are
+        all in `regions`, and for Other Waters, the ocean outside all
+        regions. Default: False.
+
+    scenario : str, optional
+        The run scenario, as the subdirectory of `pylag_root_dir` holding
+        its simulations. Outputs are saved under
+        `../Derived_data/scenarios/<scenario>`. Default: None, meaning
+        simulations are read from `pylag_root_dir` itself.
+
+    lookups : StockLookups, optional
+        Lookup tables for `regions`, shared with other scenarios. Default:
+        None, meaning they are built here.
+
+    Returns
+    -------
+     : dict
+        Stocks for each region, as pandas DataFrames.
     """
     assert month in [m for m in range(1, 13)], \
         f"Must provide a valid month. Received `{month}`."
 
-    print(f'Computing plastic stock for {region} in month {month:02} of year '
-          f'{year}')
+    scenario_str = f' for scenario {scenario}' if scenario is not None else ''
+    print(f'Computing plastic stock for {", ".join(regions)} in month '
+          f'{month:02} of year {year}{scenario_str}')
 
-    # Read weights
-    weights, weights_decay_coefs = get_weights(n_particles_prz, na_countries)
+    # Lookup tables, including particle weights and region labels
+    if lookups is None or lookups.regions != list(regions):
+        lookups = StockLookups(regions)
+    weights = lookups.weights
+    region_labels = lookups.region_labels
+    n_regions = len(regions)
 
-    # Read in valid boundary elements for the receiving region
-    bdy_dir = '../Derived_data/grid_elements/EEZ'
-    bdy_file_name = f'{bdy_dir}/grid_elements_for_{region}_EEZ_boundary.csv'
-    bdy_elements = np.fromfile(bdy_file_name, sep=',')
-    bdy_elements = np.sort(np.array(bdy_elements, dtype=np.int32))
+    # Directories from which simulations are read and to which outputs are
+    # saved
+    scenario_root_dir, out_root = get_scenario_dirs(scenario)
 
-    # Create data structure in which to store masses
-    data = OrderedDict()
-    data['Date'] = []
-    for country in na_countries:
-        data[country] = []
+    # Open the simulation catalog, if one has been built
+    catalog = open_catalog(scenario_root_dir)
 
     # Compute the number of days we will need to cycle over
     days_in_month = monthrange(target_year, month)[1]
 
-    # Loop over all days in the month
+    # Form the list of (day, emitter, file) tasks. Each task involves
+    # reading the host elements for one day from one release file.
+    tasks = []
+    dates = []
     days = [day for day in range(1, days_in_month+1)]
     for day_idx, day in enumerate(days):
-        print(f'Processing data for day {day}')
-
         # The hour on which particles were released
         current_date = datetime.datetime(target_year, month, day,
                                          release_hour)
 
         # Save the current date
-        data['Date'].append(current_date)
+        dates.append(current_date)
 
         # Cycle over all emitting countries
-        for emitting_country in na_countries:
-            print(f'Processing data for emitter {emitting_country}')
-            # Set masses for this time point to 0.0, then sum over all runs
-            data[emitting_country].append(0.0)
-
+        for emitter_idx, emitting_country in enumerate(na_countries):
             # Get a list of all paths
-            file_paths = get_pylag_file_list(pylag_root_dir,
-                                             emissions_start_date,
-                                             current_date,
-                                             emitting_country)
+            file_paths = get_release_file_list(scenario_root_dir,
+                                               emissions_start_date,
+                                               current_date,
+                                               emitting_country,
+                                               catalog=catalog)
 
             for file_path in file_paths:
-                # Open the output file for reading
-                pylag_viewer = Viewer(file_path, time_rounding=3600)
-
-                n_groups = int(pylag_viewer._ds.dimensions['particles'].size / n_particles_prz)
-
-                # Extract dates
-                pylag_dates = pylag_viewer.date
-
-                # Get the index of the current date
-                tidx = pylag_dates.tolist().index(current_date)
-
-                # Compute the weights, noting:
-                #   - we account for decay as a function of time
-                #   - time is given by tidx, the day number, as the outputs
-                #     were saved every day
-                #   - decay coeffs are per river, so we tile this array by
-                #     the number of rivers
-                decay_coefs = np.tile(weights_decay_coefs.loc[tidx].values,
-                                      n_groups)
-                decayed_weights = weights[emitting_country] * decay_coefs
-
-                # Get host elems
-                hosts = pylag_viewer('host_arakawa_a')[tidx].astype(np.int32)
-                within = cython_helpers.match_elements(hosts,
-                                                       bdy_elements,
-                                                       num_threads=num_threads)
-                # Compute particle masses
-                particle_masses = within * decayed_weights
-
-                # Add this mass to the total inventory
-                data[emitting_country][-1] += particle_masses.sum()
-
-    # Save the data to file
-    pdf = pandas.DataFrame(data)
-
-    # Sum across all countries
-    pdf['All countries'] = pdf.sum(axis=1, numeric_only=True)
-
-    # Create a directory in which to save the outputs
-    out_dir = f"../Derived_data/plastic_stock/{region}/{year}/{month:02}"
+                tasks.append((day_idx, emitter_idx, current_date, file_path))
+
+    # Masses and particle counts summed over all runs, with dimensions
+    # (day, emitter, region)
+    stocks = np.zeros((len(days), len(na_countries), n_regions),
+                      dtype=np.float64)
+    counts = np.zeros((len(days), len(na_countries), n_regions),
+                      dtype=np.int64)
+
+    # When bootstrapping, process all days for one release before moving on
+    # to the next, so that bootstrap counts are only drawn once per release
+    if n_bootstrap > 0:
+        tasks.sort(key=lambda task: (task[1], task[3], task[0]))
+
+        # Replicate masses summed over all runs and days, with dimensions
+        # (emitter, region, replicate)
+        bootstrap_stocks = np.zeros((len(na_countries), n_regions, n_bootstrap),
+                                    dtype=np.float64)
+
+    # Masses for each set of decay parameters in the sweep, with dimensions
+    # (day, emitter, region, parameter set)
+    if decay_sweep is not None:
+        sweep_stocks = np.zeros((len(days), len(na_countries), n_regions,
+                                 len(decay_sweep)), dtype=np.float64)
+
+    # Mass budget: emitted masses and totals after decay, and masses and
+    # particle counts with each budget label plus those on hosts outside the
+    # grid, with dimensions (day, emitter) and (day, emitter, budget label).
+    # Masses and counts with the other waters label give Other Waters when
+    # aggregating.
+    budget_label_table = lookups.budget_label_table
+    emitted_masses = np.zeros((len(days), len(na_countries)), dtype=np.float64)
+    decayed_masses = np.zeros((len(days), len(na_countries)), dtype=np.float64)
+    budget_masses = np.zeros((len(days), len(na_countries), len(budget_labels)),
+                             dtype=np.float64)
+    budget_counts = np.zeros((len(days), len(na_countries), len(budget_labels)),
+                             dtype=np.int64)
+    weight_sums = lookups.weight_sums
+
+    # Other Waters masses for each set of decay parameters and each
+    # bootstrap replicate, with the same dimensions as for the regions less
+    # the region
+    if aggregate:
+        other_waters_labels = lookups.other_waters_labels
+        if decay_sweep is not None:
+            other_sweep_stocks = np.zeros((len(days), len(na_countries),
+                                           len(decay_sweep)), dtype=np.float64)
+        if n_bootstrap > 0:
+            other_bootstrap_stocks = np.zeros((len(na_countries), n_bootstrap),
+                                              dtype=np.float64)
+
+    # Read host elements on background threads while masses are summed
+    current_day_idx = None
+    for task, (n_groups, tidx, hosts) in prefetch(
+            lambda task: read_hosts(task[3], task[2], catalog), tasks,
+            queue_depth=prefetch_queue_depth, max_bytes=prefetch_max_bytes,
+            num_workers=num_io_threads):
+        day_idx, emitter_idx = task[0], task[1]
+        if day_idx != current_day_idx and n_bootstrap == 0:
+            print(f'Processing data for day {days[day_idx]}')
+            current_day_idx = day_idx
+
+        # Compute the weights, noting:
+        #   - we account for decay as a function of time
+        #   - time is given by tidx, the day number, as the outputs
+        #     were saved every day
+        #   - decay coeffs are per river, so they are tiled by the
+        #     number of rivers (coefficients for each day are cached)
+        decay_coefs = decay_model.get_tiled_coefficients(int(tidx), n_groups)
+        decayed_weights = weights[na_countries[emitter_idx]] * decay_coefs
+
+        # Add particle masses to the inventory of the region they lie in,
+        # and count the particles in each region
+        cython_helpers.accumulate_region_masses(hosts, region_labels,
+                                                decayed_weights, n_regions,
+                                                num_threads=num_threads,
+                                                out=stocks[day_idx, emitter_idx, :],
+                                                counts_out=counts[day_idx, emitter_idx, :])
+
+        # Repeat for all sets of decay parameters in the sweep, using a
+        # (particles x parameter sets) weight matrix
+        if decay_sweep is not None:
+            sweep_weights = weights[na_countries[emitter_idx]][:, np.newaxis] * \
+                decay_sweep.get_tiled_coefficients(int(tidx), n_groups)
+            cython_helpers.accumulate_region_mass_sets(hosts, region_labels,
+                                                       sweep_weights, n_regions,
+                                                       num_threads=num_threads,
+                                                       out=sweep_stocks[day_idx, emitter_idx, :, :])
+
+        # Repeat for all bootstrap replicates, weighting particles by the
+        # number of times they are drawn in each replicate
+        if n_bootstrap > 0:
+            bootstrap_counts = get_bootstrap_counts(
+                os.path.relpath(task[3], scenario_root_dir), n_groups,
+                n_particles_prz, n_bootstrap, bootstrap_seed)
+            cython_helpers.accumulate_region_mass_replicates(hosts, region_labels,
+                                                             decayed_weights,
+                                                             bootstrap_counts,
+                                                             n_regions,
+                                                             num_threads=num_threads,
+                                                             out=bootstrap_stocks[emitter_idx, :, :])
+
+        # Add to the mass budget. The total after decay is computed from the
+        # mass emitted in each decay class, rather than from the particles.
+        # Masses on hosts outside the grid are added to those on land.
+        emitted_masses[day_idx, emitter_idx] += weight_sums[na_countries[emitter_idx]]
+        decayed_masses[day_idx, emitter_idx] += \
+            lookups.class_weight_sums[na_countries[emitter_idx]] @ \
+            decay_model.get_day_coefficients(int(tidx))
+        cython_helpers.accumulate_region_masses(hosts, budget_label_table,
+                                                decayed_weights,
+                                                len(budget_labels),
+                                                num_threads=num_threads,
+                                                out=budget_masses[day_idx, emitter_idx, :],
+                                                counts_out=budget_counts[day_idx, emitter_idx, :])
+        outside_grid = (hosts < 0) | (hosts >= budget_label_table.shape[0])
+        budget_masses[day_idx, emitter_idx, -1] += decayed_weights[outside_grid].sum()
+        budget_counts[day_idx, emitter_idx, -1] += np.count_nonzero(outside_grid)
+
+        # Other Waters masses for the sweep and bootstrap replicates
+        if aggregate:
+            if decay_sweep is not None:
+                cython_helpers.accumulate_region_mass_sets(hosts, other_waters_labels,
+                                                           sweep_weights, 1,
+                                                           num_threads=num_threads,
+                                                           out=other_sweep_stocks[day_idx, emitter_idx, np.newaxis, :])
+            if n_bootstrap > 0:
+                cython_helpers.accumulate_region_mass_replicates(hosts, other_waters_labels,
+                                                                 decayed_weights,
+                                                                 bootstrap_counts, 1,
+                                                                 num_threads=num_threads,
+                                                                 out=other_bootstrap_stocks[emitter_idx, np.newaxis, :])
+
+    def save_outputs(area, area_stocks, area_counts, area_sweep_stocks=None,
+                     area_bootstrap_stocks=None, suffix=''):
+        """ Save outputs for one region, country or Other Waters
+
+        Stocks and counts have dimensions (day, emitter). Aggregates are
+        saved under directories ending in `suffix`.
+        """
+        # Save the data to file
+        data = OrderedDict()
+        data['Date'] = dates
+        for emitter_idx, country in enumerate(na_countries):
+            data[country] = area_stocks[:, emitter_idx]
+        pdf = pandas.DataFrame(data)
+
+        # Sum across all countries
+        pdf['All countries'] = pdf.sum(axis=1, numeric_only=True)
+
+        # Create a directory in which to save the outputs
+        if output_format == 'zarr' and area in regions:
+            # Write to the shared stock store
+            store_path = stock_store_path if scenario is None else \
+                f'{out_root}/plastic_stock/plastic_stock.zarr'
+            store = require_stock_store(store_path, stock_store_years)
+            write_stock(store, area, year, month, pdf)
+        else:
+            out_dir = f"{out_root}/plastic_stock{suffix}/{area}/{year}/{month:02}"
+            pathlib.Path(out_dir).mkdir(parents=True, exist_ok=True)
+            out_file = f"{out_dir}/plastic_stock_in_{area}_{year}_{month:02}.pkl"
+            pdf.to_pickle(out_file)
+
+        # Residence times for the month. Outputs are daily, so each day
+        # spent in the region contributes one day.
+        residence = pandas.DataFrame(
+            {'Particle days': area_counts.sum(axis=0) * output_interval_days},
+            index=pandas.Index(na_countries, name='Emitter'))
+        residence.loc['All countries'] = residence.sum(axis=0)
+
+        out_dir = f"{out_root}/residence_time{suffix}/{area}/{year}/{month:02}"
+        pathlib.Path(out_dir).mkdir(parents=True, exist_ok=True)
+        out_file = f"{out_dir}/residence_time_in_{area}_{year}_{month:02}.pkl"
+        residence.to_pickle(out_file)
+
+        # Stocks for each set of decay parameters in the sweep
+        if area_sweep_stocks is not None:
+            for set_idx, set_name in enumerate(decay_sweep.names):
+                data = OrderedDict()
+                data['Date'] = dates
+                for emitter_idx, country in enumerate(na_countries):
+                    data[country] = area_sweep_stocks[:, emitter_idx, set_idx]
+                sweep_pdf = pandas.DataFrame(data)
+                sweep_pdf['All countries'] = sweep_pdf.sum(axis=1, numeric_only=True)
+
+                out_dir = (f"{out_root}/plastic_stock_sweep{suffix}/{set_name}/"
+                           f"{area}/{year}/{month:02}")
+                pathlib.Path(out_dir).mkdir(parents=True, exist_ok=True)
+                out_file = f"{out_dir}/plastic_stock_in_{area}_{year}_{month:02}.pkl"
+                sweep_pdf.to_pickle(out_file)
+
+        # Bootstrap replicates, summed over the days of the month
+        if area_bootstrap_stocks is not None:
+            out_dir = f"{out_root}/plastic_stock_bootstrap{suffix}/{area}/{year}/{month:02}"
+            pathlib.Path(out_dir).mkdir(parents=True, exist_ok=True)
+            out_file = f"{out_dir}/plastic_stock_bootstrap_{area}_{year}_{month:02}.npz"
+            np.savez(out_file, emitters=np.array(na_countries),
+                     n_days=len(days),
+                     stock_sums=area_stocks.sum(axis=0),
+                     replicate_sums=area_bootstrap_stocks)
+
+        return pdf
+
+    pdfs = OrderedDict()
+    for region_idx, region in enumerate(regions):
+        pdfs[region] = save_outputs(
+            region, stocks[:, :, region_idx], counts[:, :, region_idx],
+            sweep_stocks[:, :, region_idx, :] if decay_sweep is not None else None,
+            bootstrap_stocks[:, region_idx, :] if n_bootstrap > 0 else None)
+
+    if aggregate:
+        # Country totals, summed over the regions in each country
+        region_countries, country_keys = build_region_country_map(regions)
+        n_countries = len(country_keys)
+        country_stocks = aggregate_to_countries(stocks, region_countries,
+                                                n_countries, axis=2)
+        country_counts = aggregate_to_countries(counts, region_countries,
+                                                n_countries, axis=2)
+        if decay_sweep is not None:
+            country_sweep_stocks = aggregate_to_countries(sweep_stocks,
+                                                          region_countries,
+                                                          n_countries, axis=2)
+        if n_bootstrap > 0:
+            country_bootstrap_stocks = aggregate_to_countries(bootstrap_stocks,
+                                                              region_countries,
+                                                              n_countries,
+                                                              axis=1)
+
+        for country_idx, country in enumerate(country_keys):
+            save_outputs(
+                country, country_stocks[:, :, country_idx],
+                country_counts[:, :, country_idx],
+                country_sweep_stocks[:, :, country_idx, :] if decay_sweep is not None else None,
+                country_bootstrap_stocks[:, country_idx, :] if n_bootstrap > 0 else None,
+                suffix='_country')
+
+        # Other Waters, the ocean outside all regions
+        save_outputs(
+            other_waters,
+            budget_masses[:, :, outside_regions_budget_label],
+            budget_counts[:, :, outside_regions_budget_label],
+            other_sweep_stocks if decay_sweep is not None else None,
+            other_bootstrap_stocks if n_bootstrap > 0 else None)
+
+    save_mass_budget(year, month, dates, decayed_masses, emitted_masses,
+                     budget_masses, out_root)
+
+    return pdfs
+
+
+def save_mass_budget(year, month, dates, decayed_masses, emitted_masses,
+                     budget_masses, out_root='../Derived_data'):
+    """ Save and check the mass budget for a month
+
+    The budget is saved before it is checked, so that a budget that does
+    not close can be inspected.
+
+    Parameters
+    ----------
+    year, month : int
+        The year and month.
+
+    dates : list
+        The date of each day.
+
+    decayed_masses, emitted_masses : 2D NumPy array
+        Masses after decay, computed from the mass emitted in each decay
+        class, and emitted masses, with dimensions (day, emitter).
+
+    budget_masses : 3D NumPy array
+        Masses with each budget label (see `region_labels.budget_labels`),
+        with dimensions (day, emitter, budget label).
+
+    out_root : str, optional
+        Directory under which the budget is saved. Default:
+        '../Derived_data'.
+
+    Returns
+    -------
+     : pandas.DataFrame
+        The budget, with one row for each day and emitter.
+
+    Raises
+    ------
+    RuntimeError
+        If the parts of the budget do not sum to the total after decay.
+    """
+    n_days, n_emitters = decayed_masses.shape
+    budget = pandas.DataFrame(
+        {'Date': np.repeat(dates, n_emitters),
+         'Emitter': np.tile(na_countries, n_days),
+         'Emitted': emitted_masses.ravel(),
+         'Total after decay': decayed_masses.ravel()})
+    for label_idx, label in enumerate(budget_labels):
+        budget[label] = budget_masses[:, :, label_idx].ravel()
+
+    # Stock jobs for different regions write the same budget, so write to a
+    # temporary file first
+    out_dir = f"{out_root}/mass_budget/{year}/{month:02}"
+    pathlib.Path(out_dir).mkdir(parents=True, exist_ok=True)
+    out_file = f"{out_dir}/mass_budget_{year}_{month:02}.pkl"
+    tmp_out_file = f"{out_file}.{os.getpid()}.tmp"
+    budget.to_pickle(tmp_out_file)
+    os.replace(tmp_out_file, out_file)
+
+    # Check that the parts of the budget sum to the total after decay
+    imbalance = np.abs(budget_masses.sum(axis=2) - decayed_masses)
+    max_rel_imbalance = np.max(imbalance / np.maximum(decayed_masses, 1.e-300),
+                               initial=0.)
+    print(f'Mass budget maximum relative imbalance: {max_rel_imbalance:.2e}')
+    if max_rel_imbalance > mass_budget_rtol:
+        raise RuntimeError(f'The mass budget for month {month:02} of year '
+                           f'{year} is not closed (maximum relative imbalance '
+                           f'{max_rel_imbalance:.2e}). See {out_file}.')
+
+    return budget
+
+
+def process_receiving_region(region, year, month, num_threads=8,
+                             output_format='pickle'):
+    """ Process data for the the receiving region `region`
+
+    See `process_receiving_regions`.
+    """
+    return process_receiving_regions([region], year, month, num_threads,
+                                     output_format)[region]
+
+
+def process_scenarios(scenarios, regions, year, month, num_threads=8,
+                      output_format='pickle', decay_sweep=None, n_bootstrap=0,
+                      aggregate=False):
+    """ Process data for the receiving regions `regions` in several scenarios
+
+    Lookup tables are built once and shared by all scenarios. Monthly mean
+    stocks for each scenario, less those for the first, are saved as
+    matrices (see `save_scenario_differences`).
+
+    Parameters
+    ----------
+    scenarios : list
+        The run scenarios (see `process_receiving_regions`). The first is
+        the baseline.
+
+    Other parameters are as for `process_receiving_regions`.
+
+    Returns
+    -------
+     : dict
+        Stocks for each region, keyed by scenario.
+    """
+    for scenario in scenarios:
+        if not os.path.isdir(get_scenario_dirs(scenario)[0]):
+            raise RuntimeError(f'No simulations found for scenario {scenario}')
+
+    lookups = StockLookups(regions)
+
+    scenario_pdfs = OrderedDict()
+    for scenario in scenarios:
+        scenario_pdfs[scenario] = process_receiving_regions(
+            regions, year, month, num_threads, output_format, decay_sweep,
+            n_bootstrap, aggregate, scenario, lookups)
+
+    save_scenario_differences(scenario_pdfs, year, month)
+
+    return scenario_pdfs
+
+
+def get_monthly_mean_matrix(pdfs):
+    """ Return the monthly mean stock matrix for one scenario
+
+    Rows give the receiving region and columns give the emitting country,
+    plus a column for all countries.
+    """
+    return pandas.DataFrame({region: pdf.drop(columns='Date').mean(axis=0)
+                             for region, pdf in pdfs.items()}).T
+
+
+def save_scenario_differences(scenario_pdfs, year, month):
+    """ Save monthly mean stocks in each scenario less those in the first
+
+    Parameters
+    ----------
+    scenario_pdfs : dict
+        Stocks for each region, keyed by scenario (see `process_scenarios`).
+
+    year, month : int
+        The year and month.
+    """
+    scenarios = list(scenario_pdfs.keys())
+    if len(scenarios) < 2:
+        return
+
+    baseline = scenarios[0]
+    baseline_matrix = get_monthly_mean_matrix(scenario_pdfs[baseline])
+
+    out_dir = f'../Results/plastic_stocks/scenario_differences/{year}'
     pathlib.Path(out_dir).mkdir(parents=True, exist_ok=True)
-    out_file = f"{out_dir}/plastic_stock_in_{region}_{year}_{month:02}.pkl"
-    pdf.to_pickle(out_file)
+    for scenario in scenarios[1:]:
+        difference = get_monthly_mean_matrix(scenario_pdfs[scenario]) - \
+            baseline_matrix
 
-    return pdf
+        # Nested scenarios (e.g. wind_factor/3_percent) are flattened
+        file_stem = f'{scenario}_minus_{baseline}'.replace('/', '_')
+        out_file = (f'{out_dir}/monthly_mean_plastic_stock_difference_'
+                    f'{file_stem}_{year}_{month:02}.csv')
+        difference.to_csv(out_file)
+        print(f'Saved differences between scenarios {scenario} and '
+              f'{baseline} to {out_file}')
 
 
 # Parse command line agruments
 parser = argparse.ArgumentParser()
 parser.add_argument('-r',
                     '--region',
-                    help='EEZ region key (see shared.py)',
+                    help='EEZ region key(s) (see shared.py), or `all`',
+                    nargs='+',
                     metavar='')
 parser.add_argument('-y',
                     '--year',
@@ -166,16 +734,59 @@ parser.add_argument('-m',
                     '--month',
                     help='Target month',
                     metavar='')
+parser.add_argument('-f',
+                    '--format',
+                    help='Output format (pickle or zarr)',
+                    choices=['pickle', 'zarr'],
+                    default='pickle',
+                    metavar='')
+parser.add_argument('-d',
+                    '--decay-sweep',
+                    help='CSV file of decay parameter sets (see '
+                         'decay_models.read_decay_sweep)',
+                    metavar='')
+parser.add_argument('-b',
+                    '--bootstrap',
+                    help='Number of bootstrap replicates',
+                    type=int,
+                    default=0,
+                    metavar='')
+parser.add_argument('-g',
+                    '--aggregate',
+                    help='Also save outputs for countries and Other Waters',
+                    action='store_true')
+parser.add_argument('-s',
+                    '--scenario',
+                    help='Run scenario(s), as subdirectories of the '
+                         'simulations directory. The first is the baseline '
+                         'for scenario differences',
+                    nargs='+',
+                    metavar='')
 
 parsed_args = parser.parse_args(sys.argv[1:])
 
 # Save args
-target_region = parsed_args.region
+if parsed_args.region == ['all']:
+    target_regions = list(eez_names.keys())
+else:
+    target_regions = parsed_args.region
 target_year = int(parsed_args.year)
 target_month = int(parsed_args.month)
 
 num_threads = 8
 
+# Parameters for prefetching host elements: the number of I/O threads, the
+# maximum number of blocks read ahead and a cap on the memory they use.
+# Only use more than one I/O thread if HDF5 is thread safe, or all releases
+# have been cached with `build_trajectory_cache.py`.
+num_io_threads = 1
+prefetch_queue_depth = 4
+prefetch_max_bytes = 2 * 1024**3
+
+# Zarr stock store, and the years it spans
+stock_store_path = '../Derived_data/plastic_stock/plastic_stock.zarr'
+stock_store_years = list(range(2000, 2015))
+
 # Scenario (only ocean_leeway available, given current runs)
 scenario = 'ocean_leeway'
 
@@ -185,6 +796,24 @@ pylag_root_dir = simulations_dir
 # The number of partcles released per release zone
 n_particles_prz = 100
 
+# The interval between model outputs in days
+output_interval_days = 1
+
+# Model for the loss of plastic from the surface ocean
+decay_model = get_default_decay_model(n_particles_prz)
+
+# Relative tolerance when checking that the mass budget is closed
+mass_budget_rtol = 1.e-9
+
+# Base random seed for bootstrap resampling. Replicates are only consistent
+# across months if the same seed and number of replicates are used.
+bootstrap_seed = 0
+
+# Optional decay parameter sweep
+decay_sweep = None
+if parsed_args.decay_sweep is not None:
+    decay_sweep = read_decay_sweep(parsed_args.decay_sweep, n_particles_prz)
+
 # The date when monthly emissions started
 release_day = 1
 release_hour = 12
@@ -194,5 +823,13 @@ emissions_start_date = datetime.datetime(2000, 1, release_day, release_hour)
 na_countries = ['Belgium']
 
 # Get masses
-pdf = process_receiving_region(target_region, target_year, target_month,
-                               num_threads)
+if parsed_args.scenario is None:
+    pdfs = process_receiving_regions(target_regions, target_year, target_month,
+                                     num_threads, parsed_args.format, decay_sweep,
+                                     parsed_args.bootstrap, parsed_args.aggregate)
+else:
+    scenario_pdfs = process_scenarios(parsed_args.scenario, target_regions,
+                                      target_year, target_month, num_threads,
+                                      parsed_args.format, decay_sweep,
+                                      parsed_args.bootstrap,
+                                      parsed_args.aggregate)
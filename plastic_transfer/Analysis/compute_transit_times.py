@@ -0,0 +1,371 @@
+""" Compute transit times from emitting countries to receiving regions
+
+This script uses the connectivity data generated by
+`compute_connectivity_metrics.py` to compute the time particles take to
+first arrive in the waters of each receiving region. For each emitting
+country, release and receiving region it computes the fraction of
+particles (and of the emitted mass) that arrived before the end of the
+run, along with the mean and percentiles of first arrival times. Arrival
+time statistics are weighted by particle mass, and ignore the particles
+that never arrived.
+
+First arrivals are found in a single pass over the connectivity flags for
+each release and region, with flags read in blocks of time points and
+processed in parallel across particles.
+
+Per-release statistics are saved in a table for each emitting country.
+Mass-weighted histograms of arrival days, summed over all releases, are
+also saved. These are used to build emitter-to-region transit time
+matrices, with rows giving the receiving region and columns giving the
+emitting country. Outputs are daily, so each histogram bin holds a single
+arrival day, and the matrices use the same arrival days as the per-release
+statistics.
+
+Usage
+-----
+python compute_transit_times.py -c <country> [-f <format>]
+python compute_transit_times.py --matrices
+"""
+import os
+import sys
+import argparse
+import pathlib
+from collections import OrderedDict
+
+import numpy as np
+import pandas
+
+from netcdf_utils import netcdf_lock
+from zarr_store import get_release_dates
+from shared import na_countries, connectivity_netcdf_names
+from utils import get_weights, open_connectivity_release
+
+import cython_helpers
+
+
+def read_first_arrivals(flags_var, n_times, n_particles,
+                        num_threads=8):
+    """ Find the time index at which each particle first arrived
+
+    Parameters
+    ----------
+    flags_var : netCDF4.Variable or zarr_store.ReleaseView
+        Flags with dimensions (time, particles).
+
+    n_times : int
+        The number of valid time points.
+
+    n_particles : int
+        The number of particles.
+
+    num_threads : int, optional
+        The number of OpenMP threads to use. Default: 8.
+
+    Returns
+    -------
+     : 1D NumPy array
+        The index of the first time point at which each particle was
+        flagged as present, or -1 if it never was.
+    """
+    first_arrivals = np.full(n_particles, -1, dtype=np.int32)
+
+    for t_start in range(0, n_times, time_block_size):
+        t_end = min(t_start + time_block_size, n_times)
+        with netcdf_lock:
+            flags = np.asarray(flags_var[t_start:t_end, :])
+
+        cython_helpers.update_first_arrivals(flags, t_start, first_arrivals,
+                                             num_threads=num_threads)
+
+        # Stop early once all particles have arrived
+        if np.all(first_arrivals >= 0):
+            break
+
+    return first_arrivals
+
+
+def weighted_percentiles(values, weights, percentiles):
+    """ Compute weighted percentiles of `values`
+
+    Percentiles are given by the smallest value at which the cumulative
+    weight reaches the requested fraction of the total weight.
+
+    Parameters
+    ----------
+    values : 1D NumPy array
+        The values.
+
+    weights : 1D NumPy array
+        The weight of each value.
+
+    percentiles : list
+        Percentiles in the range [0, 100].
+
+    Returns
+    -------
+     : 1D NumPy array
+        The percentiles, or NaNs if the total weight is zero.
+    """
+    total_weight = weights.sum()
+    if values.shape[0] == 0 or total_weight <= 0.0:
+        return np.full(len(percentiles), np.nan)
+
+    order = np.argsort(values, kind='stable')
+    cum_weights = np.cumsum(weights[order])
+    indices = np.searchsorted(cum_weights,
+                              np.array(percentiles) / 100. * total_weight,
+                              side='left')
+    indices = np.minimum(indices, values.shape[0] - 1)
+
+    return values[order][indices]
+
+
+def summarise_arrivals(arrival_days, weights):
+    """ Compute summary statistics for a set of first arrival times
+
+    Parameters
+    ----------
+    arrival_days : 1D NumPy array
+        Arrival time of each particle in days, or NaN if the particle
+        never arrived.
+
+    weights : 1D NumPy array
+        The mass of each particle.
+
+    Returns
+    -------
+     : OrderedDict
+        Summary statistics.
+    """
+    arrived = ~np.isnan(arrival_days)
+    arrived_weights = weights[arrived]
+    arrived_days = arrival_days[arrived]
+
+    total_weight = weights.sum()
+    arrived_weight = arrived_weights.sum()
+
+    stats = OrderedDict()
+    stats['Fraction arrived'] = arrived.mean() if arrived.shape[0] > 0 else np.nan
+    stats['Mass fraction arrived'] = arrived_weight / total_weight \
+        if total_weight > 0.0 else np.nan
+    stats['Mean (days)'] = np.average(arrived_days, weights=arrived_weights) \
+        if arrived_weight > 0.0 else np.nan
+
+    for percentile, value in zip(percentiles,
+                                 weighted_percentiles(arrived_days,
+                                                      arrived_weights,
+                                                      percentiles)):
+        stats[f'P{percentile} (days)'] = value
+
+    return stats
+
+
+def process_emitting_country(emitting_country, input_format='netcdf',
+                             num_threads=8):
+    """ Compute transit times for all releases from `emitting_country`
+
+    Parameters
+    ----------
+    emitting_country : str
+        The emitting country.
+
+    input_format : str, optional
+        The format of the connectivity data (netcdf or zarr). Default:
+        'netcdf'.
+
+    num_threads : int, optional
+        The number of OpenMP threads to use. Default: 8.
+
+    Returns
+    -------
+     : pandas.DataFrame
+        Transit time statistics for each release and receiving region.
+    """
+    print(f'Computing transit times for emitting country {emitting_country}')
+
+    # Particle masses, which are the same for all releases
+    weights, _ = get_weights(n_particles_prz, [emitting_country])
+    particle_weights = weights[emitting_country]
+
+    # Mass-weighted histograms of arrival days, summed over all releases,
+    # and the total mass released
+    regions = list(receiving_regions)
+    histograms = np.zeros((len(regions), max_n_days), dtype=np.float64)
+    total_mass = np.zeros(len(regions), dtype=np.float64)
+
+    rows = []
+    for release_date in get_release_dates(first_release_year,
+                                          last_release_year,
+                                          release_day, release_hour):
+        release = open_connectivity_release(connectivity_root_dir,
+                                            emitting_country, release_date,
+                                            input_format)
+        if release is None:
+            print(f' ... no connectivity data for release {release_date}')
+            continue
+
+        get_flags, time_days, close = release
+        print(f'Processing release {release_date}')
+
+        for region_idx, region in enumerate(regions):
+            flags_var = get_flags(region)
+            if flags_var is None:
+                print(f' ... data for receiving region {region} are missing '
+                      f'or incomplete')
+                continue
+
+            n_particles = flags_var.shape[1]
+            first_arrivals = read_first_arrivals(flags_var, len(time_days),
+                                                 n_particles, num_threads)
+
+            arrived = first_arrivals >= 0
+            arrival_days = np.full(n_particles, np.nan)
+            arrival_days[arrived] = time_days[first_arrivals[arrived]]
+
+            row = OrderedDict()
+            row['Emitter'] = emitting_country
+            row['Release date'] = release_date
+            row['Receiving region'] = region
+            row['Number of particles'] = n_particles
+            row.update(summarise_arrivals(arrival_days, particle_weights))
+            rows.append(row)
+
+            # Arrival days are whole numbers of days, so each bin holds one
+            # arrival day
+            bins = np.minimum(np.rint(arrival_days[arrived]).astype(np.int64),
+                              max_n_days - 1)
+            histograms[region_idx, :] += np.bincount(bins,
+                                                     weights=particle_weights[arrived],
+                                                     minlength=max_n_days)
+            total_mass[region_idx] += particle_weights.sum()
+
+        close()
+
+    pdf = pandas.DataFrame(rows)
+
+    # Save the data to file
+    out_dir = f'../Derived_data/transit_times/{scenario}'
+    pathlib.Path(out_dir).mkdir(parents=True, exist_ok=True)
+    pdf.to_csv(f'{out_dir}/{emitting_country}_transit_times.csv', index=False)
+    np.savez(f'{out_dir}/{emitting_country}_arrival_histograms.npz',
+             regions=np.array(regions), histograms=histograms,
+             total_mass=total_mass)
+
+    return pdf
+
+
+def build_transit_time_matrices():
+    """ Build emitter-to-region transit time matrices
+
+    Statistics are computed from the arrival day histograms saved by
+    `process_emitting_country`, pooling all releases. One table is saved
+    for each statistic, with rows giving the receiving region and columns
+    giving the emitting country. Emitters that have not been processed are
+    skipped.
+
+    Returns
+    -------
+     : dict
+        The matrices, as pandas DataFrames, keyed by statistic.
+    """
+    in_dir = f'../Derived_data/transit_times/{scenario}'
+
+    regions = list(receiving_regions)
+    matrices = OrderedDict()
+    for emitting_country in na_countries:
+        file_name = f'{in_dir}/{emitting_country}_arrival_histograms.npz'
+        if not os.path.isfile(file_name):
+            print(f' ... no transit times for emitter {emitting_country}')
+            continue
+
+        data = np.load(file_name)
+        histograms = data['histograms']
+        total_mass = data['total_mass']
+
+        # The arrival day of each bin
+        days = np.arange(histograms.shape[1], dtype=np.float64)
+
+        for region_idx, region in enumerate(regions):
+            stats = summarise_histogram(days, histograms[region_idx, :],
+                                        total_mass[region_idx])
+            for name, value in stats.items():
+                matrices.setdefault(name, pandas.DataFrame(index=regions))
+                matrices[name].loc[region, emitting_country] = value
+
+    out_dir = f'../Results/transit_times/{scenario}'
+    pathlib.Path(out_dir).mkdir(parents=True, exist_ok=True)
+    for name, matrix in matrices.items():
+        matrix.index.name = 'Receiving region'
+        file_stem = name.lower().replace(' (days)', '').replace(' ', '_')
+        matrix.to_csv(f'{out_dir}/transit_time_{file_stem}.csv')
+
+    return matrices
+
+
+def summarise_histogram(days, histogram, total_mass):
+    """ Compute summary statistics from a histogram of arrival days
+    """
+    arrived_mass = histogram.sum()
+
+    stats = OrderedDict()
+    stats['Mass fraction arrived'] = arrived_mass / total_mass \
+        if total_mass > 0.0 else np.nan
+    stats['Mean (days)'] = np.average(days, weights=histogram) \
+        if arrived_mass > 0.0 else np.nan
+
+    for percentile, value in zip(percentiles,
+                                 weighted_percentiles(days, histogram,
+                                                      percentiles)):
+        stats[f'P{percentile} (days)'] = value
+
+    return stats
+
+
+# The run scenario
+scenario = 'ocean_leeway'
+
+# Location where connectivity data are stored
+connectivity_root_dir = f'../Derived_data/connectivity/{scenario}'
+
+# The list of receiving regions
+receiving_regions = connectivity_netcdf_names.keys()
+
+# The number of partcles released per release zone
+n_particles_prz = 100
+
+# Releases to process
+release_day = 1
+release_hour = 12
+first_release_year = 2000
+last_release_year = 2014
+
+# The number of time points read at once
+time_block_size = 32
+
+# Histogram length (the longest run, 2000-01-01 to 2015-01-01)
+max_n_days = 5480
+
+# Percentiles of arrival times to compute
+percentiles = [5, 25, 50, 75, 95]
+
+
+if __name__ == "__main__":
+    # Parse command line agruments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--country', help='Name of emitting country', metavar='')
+    parser.add_argument('-f', '--format', help='Connectivity data format (netcdf or zarr)',
+                        choices=['netcdf', 'zarr'], default='netcdf', metavar='')
+    parser.add_argument('--matrices', help='Build transit time matrices from '
+                                           'previously computed transit times',
+                        action='store_true')
+    parsed_args = parser.parse_args(sys.argv[1:])
+
+    if parsed_args.matrices:
+        build_transit_time_matrices()
+    else:
+        # Check country
+        country = parsed_args.country
+        if country not in na_countries:
+            raise RuntimeError(f'Invalid country name {country}')
+
+        process_emitting_country(country, parsed_args.format)
@@ -13,15 +13,14 @@ gives us the steady state mass y = M/k, where M is the total flux of plastic
 into the ocean per year. Creating a spread of 100 k values from 0.1 to 10, and
 associating each with a fraction M/100 of the total in flux, we achieve a
 steady state concentration which is approx. M/2.
+
+The coefficients are evaluated by `decay_models.py`, which the stock
+calculation now uses directly. The table is still written for scripts that
+read it.
 """
-import numpy as np
-import pandas
 import datetime
-from collections import OrderedDict
 
-# Constants
-# ---------
-years_per_day = 1/365.25
+from decay_models import get_default_decay_model
 
 # Create array of datetime strings
 # --------------------------------
@@ -35,26 +34,14 @@ end_datetime = datetime.datetime.strptime("2015-01-01 12:00:00",
 # Compute the total number of days (plus one to capture start and end points)
 n_days = (end_datetime - start_datetime).days + 1
 
-# Add array of day numbers to a data dict
-data = OrderedDict()
-data["Day number"] = np.arange(0, n_days)
-
 # Particles released per river
 n_particles = 100
 
-# Create array of gamma values (units: yr^-1)
-gammas = np.linspace(.1, 10, n_particles)
-
-# Initialise a dictionary for the precomputed decay coefficients
-for idx, gamma in enumerate(gammas):
-    data[f"k{idx+1}"] = []
-
-# Fill out the dictionary with pre-computed decay coefficients
-for day_number in data['Day number']:
-    for idx, gamma in enumerate(gammas):
-        data[f"k{idx+1}"].append(np.exp(-day_number * gamma * years_per_day))
+# Evaluate the decay coefficients for all days and classes at once, using
+# gamma values evenly spaced between 0.1 and 10 yr^-1
+decay_model = get_default_decay_model(n_particles)
+df = decay_model.get_coefficients_table(n_days).reset_index()
 
-# Save the dictionary to file
-df = pandas.DataFrame(data)
+# Save the table to file
 df.to_pickle(f'../Derived_data/particle_weights/{n_particles}_particles/weights_decay_coefficients_per_day.pkl')
 #df.to_pickle(f'../Derived_data/particle_weights/{n_particles}_particles/weights_decay_coefficients_per_day_1995.pkl')
@@ -1,4 +1,4 @@
-from joblib import Parallel, delayed
+from cython.parallel cimport prange, threadid
 
 import numpy as np
 cimport numpy as np
@@ -31,16 +31,19 @@ cpdef match_ones(const np.int32_t[:] arr1, const np.int32_t[:] arr2):
 
 cpdef find_first_instance_column_indices(const np.int32_t[:, :] var,
                                          const np.int32_t value,
-                                         const np.int32_t invalid):
+                                         const np.int32_t invalid,
+                                         int num_threads=1):
     """ Find column indices corresponding to the first time value appears
 
-    If value isn't found, return the value invalid for that row.
+    If value isn't found, return the value invalid for that row. Rows are
+    processed in parallel using `num_threads` OpenMP threads.
     """
-    cdef np.int32_t i
-    cdef np.int32_t j
-    cdef np.int32_t n_rows
-    cdef np.int32_t n_cols
+    cdef Py_ssize_t i
+    cdef Py_ssize_t j
+    cdef Py_ssize_t n_rows
+    cdef Py_ssize_t n_cols
     cdef np.int32_t[:] indices_c
+    cdef int n_threads = max(num_threads, 1)
 
     n_rows = var.shape[0]
     n_cols = var.shape[1]
@@ -49,66 +52,958 @@ cpdef find_first_instance_column_indices(const np.int32_t[:, :] var,
     indices = np.ones(n_rows, dtype=np.int32) * invalid
     indices_c = indices
 
-    for i in range(n_rows):
-        for j in range(n_cols):
-            if var[i, j] == value:
-                indices_c[i] = j
-                break
+    with nogil:
+        for i in prange(n_rows, num_threads=n_threads, schedule='static'):
+            for j in range(n_cols):
+                if var[i, j] == value:
+                    indices_c[i] = <np.int32_t>j
+                    break
 
     return indices
 
 
-cdef void cython_match_elements(int* hosts, int* flags, int* bdy_elements,
-                                int m, int n) nogil:
-    cdef int i
-    cdef int left, right, mid
-
-    for i in range(m):
-        host = hosts[i]
-        left = 0
-        right = n - 1
-
-        if bdy_elements[left] > host or bdy_elements[right] < host:
-            continue
-
-        while left <= right:
-      
-            mid = left + (right - left) // 2
-              
-            if bdy_elements[mid] == host:
-                flags[i] = 1
-                break
-            elif bdy_elements[mid] < host:
-                left = mid + 1
-            else:
-                right = mid - 1
-              
-
-cpdef cython_match_elements_wrapper(np.ndarray hosts, np.ndarray flags,
-                                    np.ndarray bdy_elements):
-    cdef int* hosts_ptr = <int*> hosts.data
-    cdef int* flags_ptr = <int*> flags.data
-    cdef int* bdy_elements_ptr = <int*> bdy_elements.data
-    cdef int m = hosts.shape[0]
-    cdef int n = bdy_elements.shape[0]
-
-    if m != flags.shape[0]:
+ctypedef fused host_t:
+    np.int16_t
+    np.int32_t
+    np.int64_t
+    np.uint16_t
+    np.uint32_t
+    np.uint64_t
+
+
+ctypedef fused flag_t:
+    np.int8_t
+    np.int32_t
+    np.int64_t
+
+
+ctypedef fused label_t:
+    np.int8_t
+    np.int16_t
+    np.int32_t
+
+
+# Arrays shorter than this are processed by a single thread, as the cost of
+# starting a parallel region outweighs the gain
+cdef Py_ssize_t min_parallel_size = 16384
+
+
+cdef inline bint is_in_sorted(np.int64_t value,
+                              const np.int32_t[::1] elements) noexcept nogil:
+    """ Binary search for `value` in the sorted array `elements`
+    """
+    cdef Py_ssize_t left, right, mid
+
+    left = 0
+    right = elements.shape[0] - 1
+
+    if right < 0 or elements[left] > value or elements[right] < value:
+        return False
+
+    while left <= right:
+        mid = left + (right - left) // 2
+
+        if elements[mid] == value:
+            return True
+        elif elements[mid] < value:
+            left = mid + 1
+        else:
+            right = mid - 1
+
+    return False
+
+
+cdef void match_elements_kernel(const host_t[::1] hosts,
+                                const np.int32_t[::1] bdy_elements,
+                                flag_t[::1] flags,
+                                int num_threads) noexcept nogil:
+    cdef Py_ssize_t i
+    cdef Py_ssize_t m = hosts.shape[0]
+
+    if num_threads > 1 and m >= min_parallel_size:
+        for i in prange(m, num_threads=num_threads, schedule='static'):
+            flags[i] = is_in_sorted(hosts[i], bdy_elements)
+    else:
+        for i in range(m):
+            flags[i] = is_in_sorted(hosts[i], bdy_elements)
+
+
+def cython_match_elements(const host_t[::1] hosts,
+                          const np.int32_t[::1] bdy_elements,
+                          flag_t[::1] flags,
+                          int num_threads=1):
+    """ Flag hosts that are in `bdy_elements`
+
+    Sets `flags[i]` to 1 if `hosts[i]` is in the sorted array
+    `bdy_elements` and to 0 otherwise. The GIL is released throughout.
+    """
+    if hosts.shape[0] != flags.shape[0]:
+        raise ValueError('Shape of hosts and flags arrays do not match')
+
+    with nogil:
+        match_elements_kernel(hosts, bdy_elements, flags, num_threads)
+
+
+def match_elements(hosts, bdy_elements, num_threads=16, out=None):
+    """ Flag hosts that lie within a region
+
+    Parameters
+    ----------
+    hosts : 1D NumPy array
+        Host elements. Any integer type is accepted without conversion.
+
+    bdy_elements : 1D NumPy array
+        Sorted array of elements in the region, as int32.
+
+    num_threads : int, optional
+        The number of OpenMP threads to use. Default: 16.
+
+    out : 1D NumPy array, optional
+        Array in which to save flags, with type int8, int32 or int64 and the
+        same length as `hosts`. Default: None, meaning a new int32 array is
+        created.
+
+    Returns
+    -------
+    out : 1D NumPy array
+        Flags set to 1 where hosts lie within the region and 0 otherwise.
+    """
+    if out is None:
+        out = np.empty(hosts.shape[0], dtype=np.int32)
+
+    cython_match_elements(np.ascontiguousarray(hosts),
+                          np.ascontiguousarray(bdy_elements, dtype=np.int32),
+                          out, num_threads)
+
+    return out
+
+
+cdef void accumulate_region_masses_kernel(const host_t[::1] hosts,
+                                          const label_t[::1] region_labels,
+                                          const double[::1] weights,
+                                          double[:, ::1] partial_sums,
+                                          np.int64_t[:, ::1] partial_counts,
+                                          int num_threads) noexcept nogil:
+    cdef Py_ssize_t i
+    cdef Py_ssize_t m = hosts.shape[0]
+    cdef Py_ssize_t n_elements = region_labels.shape[0]
+    cdef np.int64_t host
+    cdef Py_ssize_t label
+    cdef int tid
+
+    if num_threads > 1 and m >= min_parallel_size:
+        for i in prange(m, num_threads=num_threads, schedule='static'):
+            tid = threadid()
+            host = hosts[i]
+            if host < 0 or host >= n_elements:
+                continue
+            label = region_labels[host]
+            if label < 0:
+                continue
+            partial_sums[tid, label] += weights[i]
+            partial_counts[tid, label] += 1
+    else:
+        for i in range(m):
+            host = hosts[i]
+            if host < 0 or host >= n_elements:
+                continue
+            label = region_labels[host]
+            if label < 0:
+                continue
+            partial_sums[0, label] += weights[i]
+            partial_counts[0, label] += 1
+
+
+def cython_accumulate_region_masses(const host_t[::1] hosts,
+                                    const label_t[::1] region_labels,
+                                    const double[::1] weights,
+                                    double[:, ::1] partial_sums,
+                                    np.int64_t[:, ::1] partial_counts,
+                                    int num_threads=1):
+    """ Sum particle weights and counts by region into per-thread partial sums
+
+    `partial_sums` and `partial_counts` must have at least `num_threads`
+    rows and one column per region. The GIL is released throughout.
+    """
+    if hosts.shape[0] != weights.shape[0]:
+        raise ValueError('Shape of hosts and weights arrays do not match')
+
+    if partial_sums.shape[0] < num_threads or \
+            partial_counts.shape[0] < num_threads:
+        raise ValueError('Too few rows in the partial sums array')
+
+    if partial_counts.shape[1] < partial_sums.shape[1]:
+        raise ValueError('Too few columns in the partial counts array')
+
+    with nogil:
+        accumulate_region_masses_kernel(hosts, region_labels, weights,
+                                        partial_sums, partial_counts,
+                                        num_threads)
+
+
+def accumulate_region_masses(hosts, region_labels, weights, n_regions,
+                             num_threads=8, out=None, counts_out=None):
+    """ Sum particle masses by the region in which particles lie
+
+    Host elements are looked up in a label table that gives the index
+    of the region each element lies in, and particle weights are summed
+    into the corresponding region. This is done in a single pass, with no
+    intermediate flag or mass arrays. Hosts that are negative, lie beyond
+    the end of the label table or have a negative label are ignored.
+
+    Parameters
+    ----------
+    hosts : 1D NumPy array
+        Host elements. Any integer type is accepted without conversion.
+
+    region_labels : 1D NumPy array
+        Region index for each element, or -1 if the element does not lie in
+        any of the regions. Must be int8, int16 or int32.
+
+    weights : 1D NumPy array
+        Particle weights (masses), as float64.
+
+    n_regions : int
+        The number of regions.
+
+    num_threads : int, optional
+        The number of OpenMP threads to use. Default: 8.
+
+    out : 1D NumPy array, optional
+        float64 array of length `n_regions` to which masses are added.
+        Default: None, meaning a new array of zeros is created.
+
+    counts_out : 1D NumPy array, optional
+        int64 array of length `n_regions` to which the number of particles
+        in each region is added. Counts are computed in the same pass as
+        masses. Default: None, meaning counts are discarded.
+
+    Returns
+    -------
+    out : 1D NumPy array
+        The mass in each region.
+    """
+    if out is None:
+        out = np.zeros(n_regions, dtype=np.float64)
+
+    # Pad rows to a multiple of eight (one cache line) to avoid false
+    # sharing between threads
+    n_cols = ((n_regions + 7) // 8) * 8
+    partial_sums = np.zeros((max(num_threads, 1), n_cols), dtype=np.float64)
+    partial_counts = np.zeros((max(num_threads, 1), n_cols), dtype=np.int64)
+
+    cython_accumulate_region_masses(np.ascontiguousarray(hosts),
+                                    np.ascontiguousarray(region_labels),
+                                    np.ascontiguousarray(weights, dtype=np.float64),
+                                    partial_sums, partial_counts, num_threads)
+
+    out += partial_sums[:, :n_regions].sum(axis=0)
+
+    if counts_out is not None:
+        counts_out += partial_counts[:, :n_regions].sum(axis=0)
+
+    return out
+
+
+cdef void accumulate_region_mass_sets_kernel(const host_t[::1] hosts,
+                                             const label_t[::1] region_labels,
+                                             const double[:, ::1] weights,
+                                             double[:, :, ::1] partial_sums,
+                                             int num_threads) noexcept nogil:
+    cdef Py_ssize_t i, k
+    cdef Py_ssize_t m = hosts.shape[0]
+    cdef Py_ssize_t n_sets = weights.shape[1]
+    cdef Py_ssize_t n_elements = region_labels.shape[0]
+    cdef np.int64_t host
+    cdef Py_ssize_t label
+    cdef int tid
+
+    if num_threads > 1 and m >= min_parallel_size:
+        for i in prange(m, num_threads=num_threads, schedule='static'):
+            tid = threadid()
+            host = hosts[i]
+            if host < 0 or host >= n_elements:
+                continue
+            label = region_labels[host]
+            if label < 0:
+                continue
+            for k in range(n_sets):
+                partial_sums[tid, label, k] += weights[i, k]
+    else:
+        for i in range(m):
+            host = hosts[i]
+            if host < 0 or host >= n_elements:
+                continue
+            label = region_labels[host]
+            if label < 0:
+                continue
+            for k in range(n_sets):
+                partial_sums[0, label, k] += weights[i, k]
+
+
+def cython_accumulate_region_mass_sets(const host_t[::1] hosts,
+                                       const label_t[::1] region_labels,
+                                       const double[:, ::1] weights,
+                                       double[:, :, ::1] partial_sums,
+                                       int num_threads=1):
+    """ Sum sets of particle weights by region into per-thread partial sums
+
+    `partial_sums` must have dimensions of at least (`num_threads`, number
+    of regions, number of weight sets). The GIL is released throughout.
+    """
+    if hosts.shape[0] != weights.shape[0]:
+        raise ValueError('Shape of hosts and weights arrays do not match')
+
+    if partial_sums.shape[0] < num_threads:
+        raise ValueError('Too few rows in the partial sums array')
+
+    if partial_sums.shape[2] < weights.shape[1]:
+        raise ValueError('Too few weight sets in the partial sums array')
+
+    with nogil:
+        accumulate_region_mass_sets_kernel(hosts, region_labels, weights,
+                                           partial_sums, num_threads)
+
+
+def accumulate_region_mass_sets(hosts, region_labels, weights, n_regions,
+                                num_threads=8, out=None):
+    """ Sum several sets of particle masses by the region particles lie in
+
+    As `accumulate_region_masses`, but for a matrix of weights with one
+    column per weight set (e.g. per set of decay parameters). Each host is
+    looked up once, and all weight sets are summed in the same pass.
+
+    Parameters
+    ----------
+    hosts : 1D NumPy array
+        Host elements. Any integer type is accepted without conversion.
+
+    region_labels : 1D NumPy array
+        Region index for each element, or -1 if the element does not lie in
+        any of the regions. Must be int8, int16 or int32.
+
+    weights : 2D NumPy array
+        Particle weights (masses) with dimensions (particles, weight set),
+        as float64.
+
+    n_regions : int
+        The number of regions.
+
+    num_threads : int, optional
+        The number of OpenMP threads to use. Default: 8.
+
+    out : 2D NumPy array, optional
+        float64 array with dimensions (region, weight set) to which masses
+        are added. Default: None, meaning a new array of zeros is created.
+
+    Returns
+    -------
+    out : 2D NumPy array
+        The mass in each region for each weight set.
+    """
+    weights = np.ascontiguousarray(weights, dtype=np.float64)
+    n_sets = weights.shape[1]
+
+    if out is None:
+        out = np.zeros((n_regions, n_sets), dtype=np.float64)
+
+    # Pad weight sets to a multiple of eight doubles (one cache line) to
+    # avoid false sharing between threads
+    n_cols = ((n_sets + 7) // 8) * 8
+    partial_sums = np.zeros((max(num_threads, 1), n_regions, n_cols),
+                            dtype=np.float64)
+
+    cython_accumulate_region_mass_sets(np.ascontiguousarray(hosts),
+                                       np.ascontiguousarray(region_labels),
+                                       weights, partial_sums, num_threads)
+
+    out += partial_sums[:, :, :n_sets].sum(axis=0)
+
+    return out
+
+
+cdef void accumulate_region_mass_replicates_kernel(const host_t[::1] hosts,
+                                                   const label_t[::1] region_labels,
+                                                   const double[::1] weights,
+                                                   const np.uint8_t[:, ::1] counts,
+                                                   double[:, :, ::1] partial_sums,
+                                                   int num_threads) noexcept nogil:
+    cdef Py_ssize_t i, b
+    cdef Py_ssize_t m = hosts.shape[0]
+    cdef Py_ssize_t n_replicates = counts.shape[1]
+    cdef Py_ssize_t n_elements = region_labels.shape[0]
+    cdef np.int64_t host
+    cdef Py_ssize_t label
+    cdef double weight
+    cdef int tid
+
+    if num_threads > 1 and m >= min_parallel_size:
+        for i in prange(m, num_threads=num_threads, schedule='static'):
+            tid = threadid()
+            host = hosts[i]
+            if host < 0 or host >= n_elements:
+                continue
+            label = region_labels[host]
+            if label < 0:
+                continue
+            weight = weights[i]
+            for b in range(n_replicates):
+                partial_sums[tid, label, b] += weight * counts[i, b]
+    else:
+        for i in range(m):
+            host = hosts[i]
+            if host < 0 or host >= n_elements:
+                continue
+            label = region_labels[host]
+            if label < 0:
+                continue
+            weight = weights[i]
+            for b in range(n_replicates):
+                partial_sums[0, label, b] += weight * counts[i, b]
+
+
+def cython_accumulate_region_mass_replicates(const host_t[::1] hosts,
+                                             const label_t[::1] region_labels,
+                                             const double[::1] weights,
+                                             const np.uint8_t[:, ::1] counts,
+                                             double[:, :, ::1] partial_sums,
+                                             int num_threads=1):
+    """ Sum resampled particle weights by region into per-thread partial sums
+
+    `partial_sums` must have dimensions of at least (`num_threads`, number
+    of regions, number of replicates). The GIL is released throughout.
+    """
+    if hosts.shape[0] != weights.shape[0] or hosts.shape[0] != counts.shape[0]:
+        raise ValueError('Shape of hosts, weights and counts arrays do not match')
+
+    if partial_sums.shape[0] < num_threads:
+        raise ValueError('Too few rows in the partial sums array')
+
+    if partial_sums.shape[2] < counts.shape[1]:
+        raise ValueError('Too few replicates in the partial sums array')
+
+    with nogil:
+        accumulate_region_mass_replicates_kernel(hosts, region_labels, weights,
+                                                 counts, partial_sums,
+                                                 num_threads)
+
+
+def accumulate_region_mass_replicates(hosts, region_labels, weights, counts,
+                                      n_regions, num_threads=8, out=None):
+    """ Sum particle masses by region for a set of bootstrap replicates
+
+    In replicate `b`, particle `i` is counted `counts[i, b]` times. The
+    mass in each region is therefore the sum of `weights * counts[:, b]`
+    over the particles in the region. All replicates are computed in a
+    single pass, without forming the (particles x replicates) weight matrix.
+
+    Parameters
+    ----------
+    hosts : 1D NumPy array
+        Host elements. Any integer type is accepted without conversion.
+
+    region_labels : 1D NumPy array
+        Region index for each element, or -1 if the element does not lie in
+        any of the regions. Must be int8, int16 or int32.
+
+    weights : 1D NumPy array
+        Particle weights (masses), as float64.
+
+    counts : 2D NumPy array
+        Number of times each particle is drawn in each replicate, with
+        dimensions (particles, replicate), as uint8.
+
+    n_regions : int
+        The number of regions.
+
+    num_threads : int, optional
+        The number of OpenMP threads to use. Default: 8.
+
+    out : 2D NumPy array, optional
+        float64 array with dimensions (region, replicate) to which masses
+        are added. Default: None, meaning a new array of zeros is created.
+
+    Returns
+    -------
+    out : 2D NumPy array
+        The mass in each region for each replicate.
+    """
+    counts = np.ascontiguousarray(counts, dtype=np.uint8)
+    n_replicates = counts.shape[1]
+
+    if out is None:
+        out = np.zeros((n_regions, n_replicates), dtype=np.float64)
+
+    # Pad replicates to a multiple of eight doubles (one cache line) to
+    # avoid false sharing between threads
+    n_cols = ((n_replicates + 7) // 8) * 8
+    partial_sums = np.zeros((max(num_threads, 1), n_regions, n_cols),
+                            dtype=np.float64)
+
+    cython_accumulate_region_mass_replicates(np.ascontiguousarray(hosts),
+                                             np.ascontiguousarray(region_labels),
+                                             np.ascontiguousarray(weights, dtype=np.float64),
+                                             counts, partial_sums, num_threads)
+
+    out += partial_sums[:, :, :n_replicates].sum(axis=0)
+
+    return out
+
+
+cdef inline bint is_in_bitset(np.int64_t value,
+                              const np.uint64_t[::1] bitset) noexcept nogil:
+    """ Test whether bit `value` is set in `bitset`
+    """
+    if value < 0 or (value >> 6) >= bitset.shape[0]:
+        return False
+
+    return (bitset[value >> 6] >> (value & 63)) & 1
+
+
+def build_element_bitset(elements, n_elements=None):
+    """ Build a bitset over the element index space
+
+    Parameters
+    ----------
+    elements : 1D NumPy array
+        The elements in the set.
+
+    n_elements : int, optional
+        The number of elements in the grid. Default: None, meaning the bitset
+        ends at the largest element in `elements`. Hosts beyond the end of
+        the bitset are treated as lying outside the set.
+
+    Returns
+    -------
+     : 1D NumPy array
+        Bitset, as uint64 words. Bit `e % 64` of word `e // 64` is set if
+        element `e` is in the set.
+    """
+    elements = np.asarray(elements, dtype=np.int64)
+
+    if n_elements is None:
+        n_elements = int(elements.max()) + 1 if elements.shape[0] > 0 else 0
+
+    if elements.shape[0] > 0 and (elements.min() < 0 or
+                                  elements.max() >= n_elements):
+        raise ValueError('Elements lie outside the element index space')
+
+    bitset = np.zeros((n_elements + 63) // 64, dtype=np.uint64)
+    np.bitwise_or.at(bitset, elements >> 6,
+                     np.left_shift(np.uint64(1),
+                                   (elements & 63).astype(np.uint64)))
+
+    return bitset
+
+
+cdef void match_elements_bitset_kernel(const host_t[::1] hosts,
+                                       const np.uint64_t[::1] bitset,
+                                       flag_t[::1] flags,
+                                       int num_threads) noexcept nogil:
+    cdef Py_ssize_t i
+    cdef Py_ssize_t m = hosts.shape[0]
+
+    if num_threads > 1 and m >= min_parallel_size:
+        for i in prange(m, num_threads=num_threads, schedule='static'):
+            flags[i] = is_in_bitset(hosts[i], bitset)
+    else:
+        for i in range(m):
+            flags[i] = is_in_bitset(hosts[i], bitset)
+
+
+def cython_match_elements_bitset(const host_t[::1] hosts,
+                                 const np.uint64_t[::1] bitset,
+                                 flag_t[::1] flags,
+                                 int num_threads=1):
+    """ Flag hosts whose bit is set in `bitset`
+
+    The GIL is released throughout.
+    """
+    if hosts.shape[0] != flags.shape[0]:
         raise ValueError('Shape of hosts and flags arrays do not match')
 
     with nogil:
-        cython_match_elements(hosts_ptr, flags_ptr, bdy_elements_ptr, m, n)
+        match_elements_bitset_kernel(hosts, bitset, flags, num_threads)
+
+
+def match_elements_bitset(hosts, bitset, num_threads=16, out=None):
+    """ Flag hosts that lie within a region using a bitset
+
+    Equivalent to `match_elements`, but membership is tested with a single
+    bit probe rather than a binary search, which is faster for regions
+    with many elements. See `build_element_bitset`.
+
+    Parameters
+    ----------
+    hosts : 1D NumPy array
+        Host elements. Any integer type is accepted without conversion.
+
+    bitset : 1D NumPy array
+        Bitset of elements in the region, as uint64.
+
+    num_threads : int, optional
+        The number of OpenMP threads to use. Default: 16.
+
+    out : 1D NumPy array, optional
+        Array in which to save flags, with type int8, int32 or int64 and the
+        same length as `hosts`. Default: None, meaning a new int32 array is
+        created.
+
+    Returns
+    -------
+    out : 1D NumPy array
+        Flags set to 1 where hosts lie within the region and 0 otherwise.
+    """
+    if out is None:
+        out = np.empty(hosts.shape[0], dtype=np.int32)
+
+    cython_match_elements_bitset(np.ascontiguousarray(hosts),
+                                 np.ascontiguousarray(bitset, dtype=np.uint64),
+                                 out, num_threads)
+
+    return out
+
+
+def build_element_region_masks(region_elements, n_elements=None):
+    """ Build a table of region bitmasks over the element index space
+
+    Parameters
+    ----------
+    region_elements : list
+        List of 1D NumPy arrays, giving the elements in each region. At most
+        64 regions are supported.
+
+    n_elements : int, optional
+        The number of elements in the grid. Default: None, meaning the table
+        ends at the largest element in any of the regions.
+
+    Returns
+    -------
+     : 1D NumPy array
+        Masks, as uint64. Bit `r` of entry `e` is set if element `e` lies
+        in region `r`. Regions may overlap.
+    """
+    if len(region_elements) > 64:
+        raise ValueError(f'At most 64 regions are supported. Received '
+                         f'{len(region_elements)}.')
+
+    region_elements = [np.asarray(elements, dtype=np.int64)
+                       for elements in region_elements]
+
+    if n_elements is None:
+        n_elements = max([int(elements.max()) + 1 for elements in region_elements
+                          if elements.shape[0] > 0], default=0)
+
+    masks = np.zeros(n_elements, dtype=np.uint64)
+    for region_idx, elements in enumerate(region_elements):
+        masks[elements] |= np.uint64(1) << np.uint64(region_idx)
+
+    return masks
+
+
+cdef void lookup_region_masks_kernel(const host_t[::1] hosts,
+                                     const np.uint64_t[::1] element_masks,
+                                     np.uint64_t[::1] masks,
+                                     int num_threads) noexcept nogil:
+    cdef Py_ssize_t i
+    cdef Py_ssize_t m = hosts.shape[0]
+    cdef Py_ssize_t n_elements = element_masks.shape[0]
+    cdef np.int64_t host
+
+    if num_threads > 1 and m >= min_parallel_size:
+        for i in prange(m, num_threads=num_threads, schedule='static'):
+            host = hosts[i]
+            if host < 0 or host >= n_elements:
+                masks[i] = 0
+            else:
+                masks[i] = element_masks[host]
+    else:
+        for i in range(m):
+            host = hosts[i]
+            if host < 0 or host >= n_elements:
+                masks[i] = 0
+            else:
+                masks[i] = element_masks[host]
+
+
+def cython_lookup_region_masks(const host_t[::1] hosts,
+                               const np.uint64_t[::1] element_masks,
+                               np.uint64_t[::1] masks,
+                               int num_threads=1):
+    """ Look up the region bitmask of each host
+
+    The GIL is released throughout.
+    """
+    if hosts.shape[0] != masks.shape[0]:
+        raise ValueError('Shape of hosts and masks arrays do not match')
+
+    with nogil:
+        lookup_region_masks_kernel(hosts, element_masks, masks, num_threads)
+
+
+def match_regions(hosts, element_masks, num_threads=16, out=None):
+    """ Return a bitmask of all regions containing each host
+
+    Parameters
+    ----------
+    hosts : 1D NumPy array
+        Host elements. Any integer type is accepted without conversion.
+
+    element_masks : 1D NumPy array
+        Region bitmask for each element, as uint64. See
+        `build_element_region_masks`.
+
+    num_threads : int, optional
+        The number of OpenMP threads to use. Default: 16.
+
+    out : 1D NumPy array, optional
+        uint64 array in which to save masks, with the same length as
+        `hosts`. Default: None, meaning a new array is created.
+
+    Returns
+    -------
+    out : 1D NumPy array
+        Bit `r` of `out[i]` is set if `hosts[i]` lies within region `r`.
+        Hosts that are negative or lie beyond the end of the table are
+        given a mask of zero.
+    """
+    if out is None:
+        out = np.empty(hosts.shape[0], dtype=np.uint64)
+
+    cython_lookup_region_masks(np.ascontiguousarray(hosts),
+                               np.ascontiguousarray(element_masks, dtype=np.uint64),
+                               out, num_threads)
+
+    return out
+
+
+cdef inline bint is_in_bitset_row(np.int64_t value,
+                                  const np.uint64_t[:, ::1] bitsets,
+                                  Py_ssize_t row) noexcept nogil:
+    """ Test whether bit `value` is set in row `row` of `bitsets`
+    """
+    if value < 0 or (value >> 6) >= bitsets.shape[1]:
+        return False
+
+    return (bitsets[row, value >> 6] >> (value & 63)) & 1
+
+
+cdef inline np.int16_t find_neighbouring_label(np.int64_t host,
+                                               np.int16_t label,
+                                               const np.uint64_t[:, ::1] region_bitsets,
+                                               const np.int16_t[:, ::1] neighbours) noexcept nogil:
+    """ Return the region in the neighbourhood of `label` containing `host`
+
+    Returns -1 if `label` is negative or `host` lies outside the
+    neighbourhood.
+    """
+    cdef Py_ssize_t k
+    cdef np.int16_t neighbour
+
+    if label < 0:
+        return -1
+
+    for k in range(neighbours.shape[1]):
+        neighbour = neighbours[label, k]
+        if neighbour < 0:
+            break
+        if is_in_bitset_row(host, region_bitsets, neighbour):
+            return neighbour
+
+    return -1
+
+
+cdef np.int64_t update_region_labels_kernel(const host_t[::1] hosts,
+                                            np.int16_t[::1] labels,
+                                            const np.int16_t[::1] region_labels,
+                                            const np.uint64_t[:, ::1] region_bitsets,
+                                            const np.int16_t[:, ::1] neighbours,
+                                            int num_threads) noexcept nogil:
+    cdef Py_ssize_t i
+    cdef Py_ssize_t m = hosts.shape[0]
+    cdef Py_ssize_t n_elements = region_labels.shape[0]
+    cdef np.int64_t host
+    cdef np.int16_t label
+    cdef np.int64_t n_full_tests = 0
+
+    if num_threads > 1 and m >= min_parallel_size:
+        for i in prange(m, num_threads=num_threads, schedule='static'):
+            host = hosts[i]
+            label = find_neighbouring_label(host, labels[i], region_bitsets,
+                                            neighbours)
+            if label < 0:
+                n_full_tests += 1
+                if host >= 0 and host < n_elements:
+                    label = region_labels[host]
+            labels[i] = label
+    else:
+        for i in range(m):
+            host = hosts[i]
+            label = find_neighbouring_label(host, labels[i], region_bitsets,
+                                            neighbours)
+            if label < 0:
+                n_full_tests += 1
+                if host >= 0 and host < n_elements:
+                    label = region_labels[host]
+            labels[i] = label
+
+    return n_full_tests
+
+
+def cython_update_region_labels(const host_t[::1] hosts,
+                                np.int16_t[::1] labels,
+                                const np.int16_t[::1] region_labels,
+                                const np.uint64_t[:, ::1] region_bitsets,
+                                const np.int16_t[:, ::1] neighbours,
+                                int num_threads=1):
+    """ Update particle region labels, testing neighbouring regions first
+
+    The GIL is released throughout. Returns the number of full re-tests.
+    """
+    cdef np.int64_t n_full_tests
+
+    if hosts.shape[0] != labels.shape[0]:
+        raise ValueError('Shape of hosts and labels arrays do not match')
+
+    if region_bitsets.shape[0] != neighbours.shape[0]:
+        raise ValueError('The number of region bitsets and neighbourhoods '
+                         'differ')
+
+    with nogil:
+        n_full_tests = update_region_labels_kernel(hosts, labels,
+                                                   region_labels,
+                                                   region_bitsets,
+                                                   neighbours, num_threads)
+
+    return n_full_tests
 
 
-def match_elements(hosts, bdy_elements, num_threads=16):
-    flags = np.zeros_like(hosts, dtype=np.int32)
+def update_region_labels(hosts, labels, region_labels, region_bitsets,
+                         neighbours, num_threads=8):
+    """ Update the region each particle lies in, using region adjacency
 
-    hosts_split = np.array_split(hosts, num_threads)  
-    flags_split = np.array_split(flags, num_threads)  
-    
-    with Parallel(n_jobs=num_threads, backend='threading') as parallel:
-        parallel([delayed(cython_match_elements_wrapper)(hosts_split[i],
-                  flags_split[i], bdy_elements) for i in range(num_threads)])
+    Particles rarely move far between consecutive outputs, so a particle is
+    usually in the region it was in at the previous output, or in one of
+    the regions that border it. For each particle, the previous region and
+    its neighbours are tested first, using one bit probe each. The label
+    table is only consulted (a full re-test) if the particle has left that
+    neighbourhood, or was not in any region. The result is identical to
+    looking up every host in the label table.
+
+    Parameters
+    ----------
+    hosts : 1D NumPy array
+        Host elements. Any integer type is accepted without conversion.
+
+    labels : 1D NumPy array
+        Region index of each particle at the previous output, or -1 if it
+        did not lie in any region (or is unknown), as int16. Updated in
+        place.
+
+    region_labels : 1D NumPy array
+        Region index for each element, or -1, as int16 (see
+        `region_labels.build_region_label_table`).
+
+    region_bitsets : 2D NumPy array
+        Bitset of the elements in each region, as uint64 with dimensions
+        (region, word).
+
+    neighbours : 2D NumPy array
+        The regions tested for particles in each region, as int16 with
+        dimensions (region, neighbour), padded with -1. These should start
+        with the region itself.
+
+    num_threads : int, optional
+        The number of OpenMP threads to use. Default: 8.
+
+    Returns
+    -------
+     : int
+        The number of particles that needed a full re-test.
+    """
+    return cython_update_region_labels(np.ascontiguousarray(hosts), labels,
+                                       np.ascontiguousarray(region_labels, dtype=np.int16),
+                                       np.ascontiguousarray(region_bitsets, dtype=np.uint64),
+                                       np.ascontiguousarray(neighbours, dtype=np.int16),
+                                       num_threads)
+
+
+# The number of particles handled by each thread at a time when finding first
+# arrivals. Within a chunk, flags are scanned row by row, which keeps memory
+# access contiguous for (time, particles) arrays.
+cdef Py_ssize_t first_arrival_chunk_size = 4096
+
+
+cdef void update_first_arrivals_kernel(const flag_t[:, ::1] flags,
+                                       np.int64_t value,
+                                       np.int32_t t_offset,
+                                       np.int32_t[::1] first_arrivals,
+                                       int num_threads) noexcept nogil:
+    cdef Py_ssize_t i, j, chunk, j_start, j_end
+    cdef Py_ssize_t n_times = flags.shape[0]
+    cdef Py_ssize_t n_particles = flags.shape[1]
+    cdef Py_ssize_t n_chunks = (n_particles + first_arrival_chunk_size - 1) // first_arrival_chunk_size
+
+    for chunk in prange(n_chunks, num_threads=max(num_threads, 1),
+                        schedule='static'):
+        j_start = chunk * first_arrival_chunk_size
+        j_end = min(j_start + first_arrival_chunk_size, n_particles)
+        for i in range(n_times):
+            for j in range(j_start, j_end):
+                if first_arrivals[j] < 0 and flags[i, j] == value:
+                    first_arrivals[j] = t_offset + <np.int32_t>i
+
+
+def cython_update_first_arrivals(const flag_t[:, ::1] flags,
+                                 np.int64_t value,
+                                 np.int32_t t_offset,
+                                 np.int32_t[::1] first_arrivals,
+                                 int num_threads=1):
+    """ Record the first time index at which each particle has flag `value`
+
+    The GIL is released throughout.
+    """
+    if flags.shape[1] != first_arrivals.shape[0]:
+        raise ValueError('Shape of flags and first arrivals arrays do not match')
+
+    with nogil:
+        update_first_arrivals_kernel(flags, value, t_offset, first_arrivals,
+                                     num_threads)
+
+
+def update_first_arrivals(flags, t_offset, first_arrivals, value=1,
+                          num_threads=8):
+    """ Update first arrival times with a block of flags
+
+    Flags are processed one block of time points at a time, so first
+    arrivals can be found without holding the full (time, particles) array
+    in memory. Blocks must be passed in time order.
+
+    Parameters
+    ----------
+    flags : 2D NumPy array
+        Block of flags with dimensions (time, particles). Must be int8, int32
+        or int64.
+
+    t_offset : int
+        The time index of the first row in `flags`.
+
+    first_arrivals : 1D NumPy array
+        int32 array giving the time index at which each particle first had
+        flag `value`, or -1 if it has not done so yet. Updated in place.
+
+    value : int, optional
+        The flag value to search for. Default: 1.
+
+    num_threads : int, optional
+        The number of OpenMP threads to use. Default: 8.
+
+    Returns
+    -------
+    first_arrivals : 1D NumPy array
+        The updated array.
+    """
+    cython_update_first_arrivals(np.ascontiguousarray(flags), value,
+                                 t_offset, first_arrivals, num_threads)
 
-    # Join the arrays
-    return np.concatenate(flags_split)    
- 
+    return first_arrivals
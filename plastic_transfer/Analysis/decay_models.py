@@ -0,0 +1,344 @@
+""" Models for the loss of plastic from the surface ocean
+
+Each particle released from a river belongs to one of a fixed number of
+decay classes, given by its index within its release zone. The mass of a
+particle decays as:
+
+w(t) = w(t=0) * exp(-k_i*t),
+
+where t is time (in days) and k_i is the decay rate for class i (day^-1).
+Decay models differ only in how the rates k_i are chosen:
+
+* `RateSpectrumDecay` - explicitly given rates. The default model, with rates
+from 0.1 to 10 yr^-1, is the one used in the study.
+* `ExponentialDecay` - a single rate shared by all classes.
+* `GammaSpectrumDecay` - rates spread over a gamma distribution.
+* `SizeDependentDecay` - rates that scale with particle size.
+
+Coefficients are evaluated analytically for blocks of days and classes,
+so the table of precomputed coefficients written by
+`create_weights_decay_coefficients_file.py` is no longer needed. The
+coefficients of each class are cached by day, as the same days are needed
+for every release and receiving region. Vectors for a full release are
+tiled across release zones from the cached coefficients when requested;
+caching tiled vectors would use memory in proportion to the number of
+particles, for few cache hits.
+"""
+import functools
+
+import numpy as np
+import pandas
+from scipy import stats
+
+
+# Constants
+years_per_day = 1/365.25
+
+# The number of days for which class coefficients are cached by each model.
+# Each entry holds one coefficient per class.
+coefficients_cache_size = 8192
+
+
+class DecayModel(object):
+    """ Base class for decay models
+
+    Subclasses must implement `get_rates`.
+
+    Parameters
+    ----------
+    n_classes : int
+        The number of decay classes, which is equal to the number of
+        particles released per release zone.
+    """
+
+    def __init__(self, n_classes):
+        self.n_classes = int(n_classes)
+
+        # Per-instance cache of class coefficients for each day
+        self.get_day_coefficients = \
+            functools.lru_cache(maxsize=coefficients_cache_size)(self._get_day_coefficients)
+
+    def get_rates(self):
+        """ Return the decay rate of each class (yr^-1)
+        """
+        raise NotImplementedError
+
+    def get_daily_rates(self):
+        """ Return the decay rate of each class (day^-1)
+        """
+        return np.asarray(self.get_rates(), dtype=np.float64) * years_per_day
+
+    def get_coefficients(self, days):
+        """ Evaluate decay coefficients for a block of days
+
+        Parameters
+        ----------
+        days : int or 1D NumPy array
+            Day number(s) (time since release in days).
+
+        Returns
+        -------
+         : 1D or 2D NumPy array
+            Coefficients with dimensions (class) if `days` is a scalar, or
+            (day, class) otherwise.
+        """
+        days = np.asarray(days, dtype=np.float64)
+        return np.exp(-days[..., np.newaxis] * self.get_daily_rates())
+
+    def _get_day_coefficients(self, day):
+        """ Return the decay coefficient of each class for `day`
+
+        Called through `get_day_coefficients`, which caches results. The
+        returned array is read only.
+        """
+        coefs = self.get_coefficients(day)
+        coefs.setflags(write=False)
+        return coefs
+
+    def get_tiled_coefficients(self, day, n_groups):
+        """ Return decay coefficients for every particle in a release
+
+        Coefficients for each class are tiled by the number of release zones
+        (groups), matching the order of particles in PyLag output files.
+        Class coefficients are cached (see `get_day_coefficients`), but the
+        tiled vector is formed on each call. The returned array is read
+        only.
+
+        Parameters
+        ----------
+        day : int
+            Day number (time since release in days).
+
+        n_groups : int
+            The number of release zones.
+
+        Returns
+        -------
+         : 1D NumPy array
+            Decay coefficients, of length `n_groups * n_classes`.
+        """
+        coefs = np.tile(self.get_day_coefficients(int(day)), n_groups)
+        coefs.setflags(write=False)
+        return coefs
+
+    def get_coefficients_table(self, n_days):
+        """ Return coefficients for days 0 to `n_days - 1` as a table
+
+        The table has the same layout as the one written by
+        `create_weights_decay_coefficients_file.py`, and is indexed by day
+        number.
+
+        Returns
+        -------
+         : pandas.DataFrame
+            The table.
+        """
+        day_numbers = np.arange(0, n_days)
+        columns = [f'k{idx+1}' for idx in range(self.n_classes)]
+        table = pandas.DataFrame(self.get_coefficients(day_numbers),
+                                 columns=columns,
+                                 index=pandas.Index(day_numbers,
+                                                    name='Day number'))
+        return table
+
+
+class RateSpectrumDecay(DecayModel):
+    """ Decay with an explicitly given rate for each class
+
+    Parameters
+    ----------
+    gammas : 1D NumPy array
+        Decay rate for each class (yr^-1).
+    """
+
+    def __init__(self, gammas):
+        self.gammas = np.asarray(gammas, dtype=np.float64)
+        super().__init__(self.gammas.shape[0])
+
+    def get_rates(self):
+        return self.gammas
+
+
+class ExponentialDecay(DecayModel):
+    """ Decay at a single rate shared by all classes
+
+    Parameters
+    ----------
+    gamma : float
+        Decay rate (yr^-1).
+
+    n_classes : int
+        The number of decay classes.
+    """
+
+    def __init__(self, gamma, n_classes):
+        self.gamma = float(gamma)
+        super().__init__(n_classes)
+
+    def get_rates(self):
+        return np.full(self.n_classes, self.gamma)
+
+
+class GammaSpectrumDecay(DecayModel):
+    """ Decay with rates spread over a gamma distribution
+
+    Each class is assigned the rate at the midpoint of an equal probability
+    bin of the distribution, so that classes (which carry equal shares of
+    each river's emissions) sample the distribution evenly.
+
+    Parameters
+    ----------
+    shape : float
+        Shape parameter of the distribution.
+
+    scale : float
+        Scale parameter of the distribution (yr^-1).
+
+    n_classes : int
+        The number of decay classes.
+    """
+
+    def __init__(self, shape, scale, n_classes):
+        self.shape = float(shape)
+        self.scale = float(scale)
+        super().__init__(n_classes)
+
+    def get_rates(self):
+        quantiles = (np.arange(self.n_classes) + 0.5) / self.n_classes
+        return stats.gamma.ppf(quantiles, self.shape, scale=self.scale)
+
+
+class SizeDependentDecay(DecayModel):
+    """ Decay at rates that scale with particle size
+
+    Rates are given by `reference_rate * (size / reference_size)**-exponent`,
+    so smaller particles are lost more quickly when `exponent` is positive.
+
+    Parameters
+    ----------
+    sizes : 1D NumPy array
+        Particle size for each class (e.g. in mm).
+
+    reference_rate : float
+        Decay rate for particles of size `reference_size` (yr^-1).
+
+    reference_size : float
+        Reference size, in the same units as `sizes`.
+
+    exponent : float, optional
+        Size scaling exponent. Default: 1.
+    """
+
+    def __init__(self, sizes, reference_rate, reference_size, exponent=1.0):
+        self.sizes = np.asarray(sizes, dtype=np.float64)
+        self.reference_rate = float(reference_rate)
+        self.reference_size = float(reference_size)
+        self.exponent = float(exponent)
+        super().__init__(self.sizes.shape[0])
+
+    def get_rates(self):
+        return self.reference_rate * \
+            (self.sizes / self.reference_size)**(-self.exponent)
+
+
+def get_default_decay_model(n_classes=100):
+    """ Return the decay model used in the study
+
+    Rates are evenly spaced between 0.1 and 10 yr^-1. This gives a steady
+    state stock of approximately half the annual flux of plastic into the
+    ocean (see `create_weights_decay_coefficients_file.py`).
+    """
+    return RateSpectrumDecay(np.linspace(.1, 10, n_classes))
+
+
+class DecaySweep(object):
+    """ A set of decay models that are evaluated together
+
+    Used to compute stocks for several sets of decay parameters from a
+    single pass over the trajectories.
+
+    Parameters
+    ----------
+    names : list
+        A name for each parameter set.
+
+    models : list
+        The decay model for each parameter set. All models must have the
+        same number of classes.
+    """
+
+    def __init__(self, names, models):
+        if len(names) != len(models):
+            raise ValueError('The number of names and models differ')
+
+        if len(set(model.n_classes for model in models)) != 1:
+            raise ValueError('Decay models have differing numbers of classes')
+
+        self.names = list(names)
+        self.models = list(models)
+        self.n_classes = self.models[0].n_classes
+
+        # Per-instance cache of class coefficients for each day
+        self.get_day_coefficients = \
+            functools.lru_cache(maxsize=coefficients_cache_size)(self._get_day_coefficients)
+
+    def __len__(self):
+        return len(self.models)
+
+    def get_coefficients(self, day):
+        """ Return decay coefficients for `day`
+
+        Returns
+        -------
+         : 2D NumPy array
+            Coefficients with dimensions (class, parameter set).
+        """
+        return np.stack([model.get_coefficients(day) for model in self.models],
+                        axis=1)
+
+    def _get_day_coefficients(self, day):
+        """ Return decay coefficients for `day`
+
+        Called through `get_day_coefficients`, which caches results. The
+        returned array is read only.
+        """
+        coefs = self.get_coefficients(day)
+        coefs.setflags(write=False)
+        return coefs
+
+    def get_tiled_coefficients(self, day, n_groups):
+        """ Return decay coefficients for every particle in a release
+
+        Coefficients for each class are cached (see `get_day_coefficients`),
+        and are tiled by the number of release zones on each call. The
+        returned array is read only.
+
+        Returns
+        -------
+         : 2D NumPy array
+            Coefficients with dimensions (particle, parameter set).
+        """
+        coefs = np.ascontiguousarray(np.tile(self.get_day_coefficients(int(day)),
+                                             (n_groups, 1)))
+        coefs.setflags(write=False)
+        return coefs
+
+
+def read_decay_sweep(file_name, n_classes):
+    """ Read a decay parameter sweep from a CSV file
+
+    The file should have the columns `Name`, `Gamma min` and `Gamma max`.
+    Each row defines a spectrum of rates evenly spaced between `Gamma min`
+    and `Gamma max` (yr^-1), as for the default model.
+
+    Returns
+    -------
+     : DecaySweep
+        The sweep.
+    """
+    pdf = pandas.read_csv(file_name)
+
+    models = [RateSpectrumDecay(np.linspace(gamma_min, gamma_max, n_classes))
+              for gamma_min, gamma_max in zip(pdf['Gamma min'], pdf['Gamma max'])]
+
+    return DecaySweep(pdf['Name'].astype(str).tolist(), models)
@@ -0,0 +1,221 @@
+""" Cached access to the ocean grid metrics
+
+Several scripts read the element centres and land mask from the ocean grid
+metrics file, `grid_metrics_surface_ocean.nc`, and then derive the same
+products from them (e.g. the indices of ocean elements). `GridMetrics`
+reads these variables once, converts them from masked arrays to plain
+NumPy arrays, and saves them as `.npy` files that are memory mapped on
+later uses. The cache is keyed by a checksum of the grid metrics file, so
+it is rebuilt if the file changes. As computing the checksum means reading
+the full file, checksums are themselves recorded against the file's size
+and modification time.
+
+Derived products are computed when first used, and memoized.
+"""
+import os
+import json
+import zlib
+import pathlib
+import functools
+
+import numpy as np
+from netCDF4 import Dataset
+
+
+# Default ocean grid metrics file
+grid_metrics_file_name = '../Inputs/grid_metrics/grid_metrics_surface_ocean.nc'
+
+# Directory where cached grid variables are saved
+grid_cache_dir = '../Derived_data/grid_metrics_cache'
+
+# Grid variables that are cached, and the values used to fill masked entries
+cached_vars = {'longitude_c': np.nan,
+               'latitude_c': np.nan,
+               'mask_c': 1}
+
+
+def get_file_checksum(file_name, cache_dir=grid_cache_dir):
+    """ Return the CRC32 checksum of `file_name` as a hex string
+
+    Checksums are recorded in `cache_dir` against the size and modification
+    time of the file, and are only recomputed if either changes.
+    """
+    stat = os.stat(file_name)
+    key = f'{os.path.abspath(file_name)}:{stat.st_size}:{stat.st_mtime_ns}'
+
+    index_file_name = f'{cache_dir}/checksums.json'
+    try:
+        with open(index_file_name, 'r') as f:
+            index = json.load(f)
+    except (FileNotFoundError, ValueError):
+        index = {}
+
+    if key not in index:
+        checksum = 0
+        with open(file_name, 'rb') as f:
+            for block in iter(functools.partial(f.read, 64 * 1024**2), b''):
+                checksum = zlib.crc32(block, checksum)
+        index[key] = f'{checksum:08x}'
+
+        pathlib.Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        tmp_file_name = f'{index_file_name}.{os.getpid()}.tmp'
+        with open(tmp_file_name, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_file_name, index_file_name)
+
+    return index[key]
+
+
+class GridMetrics(object):
+    """ Ocean grid element centres and land mask
+
+    Parameters
+    ----------
+    file_name : str, optional
+        Path to the grid metrics file. Default: `grid_metrics_file_name`.
+
+    cache_dir : str, optional
+        Directory where cached variables are saved. Default:
+        `grid_cache_dir`.
+    """
+
+    def __init__(self, file_name=grid_metrics_file_name,
+                 cache_dir=grid_cache_dir):
+        self.file_name = file_name
+        self.checksum = get_file_checksum(file_name, cache_dir)
+        self.cache_dir = f'{cache_dir}/{self.checksum}'
+
+        if not all(os.path.isfile(self._get_cache_path(var_name))
+                   for var_name in cached_vars):
+            self._build_cache()
+
+        # Per-instance cache of bounding box queries
+        self.get_bbox_elements = functools.lru_cache(maxsize=None)(self._get_bbox_elements)
+
+    def _get_cache_path(self, var_name):
+        return f'{self.cache_dir}/{var_name}.npy'
+
+    def _build_cache(self):
+        print(f'Caching grid metrics from {self.file_name}')
+        pathlib.Path(self.cache_dir).mkdir(parents=True, exist_ok=True)
+
+        with Dataset(self.file_name) as ds:
+            for var_name, fill_value in cached_vars.items():
+                data = np.ma.filled(ds[var_name][:], fill_value)
+
+                # Write to a temporary file first, so that other processes
+                # never see a partially written cache
+                cache_path = self._get_cache_path(var_name)
+                tmp_cache_path = f'{cache_path}.{os.getpid()}.tmp.npy'
+                np.save(tmp_cache_path, data)
+                os.replace(tmp_cache_path, cache_path)
+
+    def _load(self, var_name):
+        return np.load(self._get_cache_path(var_name), mmap_mode='r')
+
+    @functools.cached_property
+    def lons(self):
+        """ Longitudes of element centres """
+        return self._load('longitude_c')
+
+    @functools.cached_property
+    def lats(self):
+        """ Latitudes of element centres """
+        return self._load('latitude_c')
+
+    @functools.cached_property
+    def mask(self):
+        """ Land mask, which is non-zero for land elements """
+        return self._load('mask_c')
+
+    @property
+    def n_elements(self):
+        return self.mask.shape[0]
+
+    @functools.cached_property
+    def ocean_elements(self):
+        """ Indices of ocean elements """
+        return _read_only(np.flatnonzero(np.asarray(self.mask) == 0))
+
+    @functools.cached_property
+    def cartesian_coords(self):
+        """ Cartesian coordinates of element centres, with dimensions (element, 3)
+
+        Coordinates are computed with PyLag, as they are when particle
+        release positions are snapped to the grid.
+        """
+        from pylag.math import geographic_to_cartesian_coords_python
+
+        x, y, z = geographic_to_cartesian_coords_python(np.radians(self.lons),
+                                                        np.radians(self.lats))
+        return _read_only(np.column_stack([x, y, z]))
+
+    def get_hemisphere_elements(self, hemisphere, ocean_only=True):
+        """ Return the indices of elements in one hemisphere
+
+        Elements on the equator are assigned to the southern hemisphere.
+
+        Parameters
+        ----------
+        hemisphere : str
+            'north' or 'south'.
+
+        ocean_only : bool, optional
+            If True, only return ocean elements. Default: True.
+        """
+        if hemisphere == 'north':
+            return self.get_bbox_elements(-np.inf, np.inf, 0., np.inf,
+                                          ocean_only, include_lower_lat=False)
+        elif hemisphere == 'south':
+            return self.get_bbox_elements(-np.inf, np.inf, -np.inf, 0.,
+                                          ocean_only)
+
+        raise ValueError(f'Unknown hemisphere {hemisphere}')
+
+    def _get_bbox_elements(self, lon_min, lon_max, lat_min, lat_max,
+                           ocean_only=True, include_lower_lat=True):
+        """ Return the indices of elements within a bounding box
+
+        Called through `get_bbox_elements`, which caches results. The
+        returned array is read only.
+
+        Parameters
+        ----------
+        lon_min, lon_max, lat_min, lat_max : float
+            Bounds of the box. Longitudes are compared directly with those
+            in the grid metrics file, so boxes that cross the ends of the
+            longitude range should be split.
+
+        ocean_only : bool, optional
+            If True, only return ocean elements. Default: True.
+
+        include_lower_lat : bool, optional
+            If True, elements with latitude equal to `lat_min` are included.
+            Default: True.
+        """
+        lons = np.asarray(self.lons)
+        lats = np.asarray(self.lats)
+
+        above_lower_lat = lats >= lat_min if include_lower_lat else lats > lat_min
+        in_box = (lons >= lon_min) & (lons <= lon_max) & above_lower_lat & \
+            (lats <= lat_max)
+
+        if ocean_only:
+            in_box &= np.asarray(self.mask) == 0
+
+        return _read_only(np.flatnonzero(in_box))
+
+
+def _read_only(array):
+    array.setflags(write=False)
+    return array
+
+
+@functools.lru_cache(maxsize=None)
+def get_grid_metrics(file_name=grid_metrics_file_name):
+    """ Return the grid metrics for `file_name`
+
+    Grid metrics are cached, so all callers in a process share derived
+    products.
+    """
+    return GridMetrics(file_name)
@@ -0,0 +1,164 @@
+""" Mapping from ocean grid elements to output grid cells
+
+Gridding particle masses by position requires particle longitudes and
+latitudes to be read, which are much larger than the `host_arakawa_a`
+integers (and are not needed for anything else). Instead, each Arakawa-A
+element of the ocean grid can be assigned to the output grid cell that
+its centre lies in. Concentration maps are then built with a single
+lookup and `np.bincount` over host elements.
+
+This places all particles within an element in the cell containing the
+element's centre, so it is only accurate when output cells are large
+compared with elements. Maps are built for each output grid resolution
+by `build_element_cell_maps.py`, and saved as `.npy` files which are
+memory mapped when used. Maps are saved under the checksum of the grid
+metrics file (see `grid.py`), so a map built for a different ocean grid is
+never used.
+"""
+import functools
+import pathlib
+
+import numpy as np
+
+from utils import generate_grid, get_grid_cell_indices
+from grid import get_grid_metrics
+
+# Directory where maps are saved
+element_cell_map_dir = '../Derived_data/grid_cell_mapping'
+
+
+def get_element_cell_map_path(spacing, checksum=None):
+    """ Return the path to the map for grid spacing `spacing` (degrees)
+
+    Parameters
+    ----------
+    spacing : float
+        Output grid spacing in decimal degrees.
+
+    checksum : str, optional
+        Checksum of the grid metrics file. Default: None, meaning the
+        checksum of the current grid metrics file is used.
+    """
+    if checksum is None:
+        checksum = get_grid_metrics().checksum
+
+    return (f'{element_cell_map_dir}/{checksum}/'
+            f'element_cells_{spacing:g}deg.npy')
+
+
+def compute_element_cell_map(lons, lats, spacing, mask=None):
+    """ Find the output grid cell the centre of each element lies in
+
+    Parameters
+    ----------
+    lons, lats : 1D NumPy arrays
+        Longitudes and latitudes of element centres.
+
+    spacing : float
+        Output grid spacing in decimal degrees (see `utils.generate_grid`).
+
+    mask : 1D NumPy array, optional
+        Land mask for each element, with non-zero values on land. Default:
+        None.
+
+    Returns
+    -------
+     : 1D NumPy array
+        The cell each element lies in, as int32, with cells numbered in
+        row-major (latitude, longitude) order. Land elements and elements
+        outside the grid are given the index -1.
+    """
+    _, _, lon_bin_edges, lat_bin_edges, _, _ = \
+        generate_grid(spacing, use_global_land_mask=False)
+
+    # Wrap longitudes into the range [-180, 180)
+    lons = np.mod(np.asarray(lons, dtype=np.float64) + 180., 360.) - 180.
+    lats = np.asarray(lats, dtype=np.float64)
+
+    element_cells = get_grid_cell_indices(lons, lats, lon_bin_edges,
+                                          lat_bin_edges).astype(np.int32)
+
+    if mask is not None:
+        element_cells[np.asarray(mask) != 0] = -1
+
+    return element_cells
+
+
+def build_element_cell_map(spacing, file_name=None):
+    """ Build and save the map for grid spacing `spacing` (degrees)
+
+    Returns
+    -------
+     : str
+        Path to the map.
+    """
+    grid_metrics = get_grid_metrics()
+
+    if file_name is None:
+        file_name = get_element_cell_map_path(spacing, grid_metrics.checksum)
+        pathlib.Path(file_name).parent.mkdir(parents=True, exist_ok=True)
+
+    element_cells = compute_element_cell_map(grid_metrics.lons,
+                                             grid_metrics.lats, spacing,
+                                             grid_metrics.mask)
+    np.save(file_name, element_cells)
+
+    return file_name
+
+
+@functools.lru_cache(maxsize=None)
+def get_element_cell_map(spacing):
+    """ Open the map for grid spacing `spacing` (degrees)
+
+    Maps are cached, and returned as read-only memory maps.
+    """
+    file_name = get_element_cell_map_path(spacing)
+    try:
+        return np.load(file_name, mmap_mode='r')
+    except FileNotFoundError:
+        raise RuntimeError(f'No element to grid cell map for a spacing of '
+                           f'{spacing:g} degrees and the current grid '
+                           f'metrics file. Build it with '
+                           f'build_element_cell_maps.py.')
+
+
+def grid_host_masses(hosts, masses, element_cells, grid_shape, out=None):
+    """ Sum particle masses within output grid cells using host elements
+
+    Parameters
+    ----------
+    hosts : 1D NumPy array
+        Host element of each particle.
+
+    masses : 1D NumPy array
+        Particle masses.
+
+    element_cells : 1D NumPy array
+        The output grid cell of each element (see `get_element_cell_map`).
+
+    grid_shape : tuple
+        Shape of the output grid, (n_lats, n_lons).
+
+    out : 2D NumPy array, optional
+        Array to which masses are added. Default: None, meaning a new array
+        is returned.
+
+    Returns
+    -------
+     : 2D NumPy array
+        Summed masses with dimensions (latitude, longitude).
+    """
+    valid_hosts = (hosts >= 0) & (hosts < element_cells.shape[0])
+    cells = np.full(hosts.shape, -1, dtype=np.int32)
+    cells[valid_hosts] = element_cells[hosts[valid_hosts]]
+    valid = cells >= 0
+
+    gridded = np.bincount(cells[valid], weights=masses[valid],
+                          minlength=grid_shape[0] * grid_shape[1]).reshape(grid_shape)
+
+    if out is None:
+        return gridded
+
+    out += gridded
+
+    return out
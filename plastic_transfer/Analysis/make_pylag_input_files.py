@@ -2,7 +2,6 @@
 
 import os
 import numpy as np
-from netCDF4 import Dataset
 from scipy.spatial import cKDTree
 import geopandas
 from matplotlib import pyplot as plt
@@ -18,6 +17,7 @@ from marine_boundaries import remove_us_west_coast_rivers
 from marine_boundaries import remove_french_guiana_rivers
 
 from shared import na_countries
+from grid import get_grid_metrics
 
 
 # What fraction of all river inputs should be accounted for?
@@ -95,25 +95,17 @@ for _gdf, country in zip(gdf_list, na_countries):
           f"for {input_fraction} of it's total plastic inputs")
 
 # Read in grid metrics info
-gm = Dataset(grid_metrics_1_12_deg)
-lonc = gm['longitude_c'][:]
-latc = gm['latitude_c'][:]
-maskc = gm.variables['mask_c'][:]
+gm = get_grid_metrics(grid_metrics_1_12_deg)
 
 # Indices for ocean elements
-ocean_elements = np.asarray(maskc == 0).nonzero()[0]
+ocean_elements = gm.ocean_elements
 
 # Limit grid to ocean elements only
-lonc = lonc[ocean_elements]
-latc = latc[ocean_elements]
+lonc = gm.lons[ocean_elements]
+latc = gm.lats[ocean_elements]
 
-# Convert to Cartesian coords and build a KDE tree
-lonc_radians = np.radians(lonc)
-latc_radians = np.radians(latc)
-
-# Convert to Cartesian coordinates
-x, y, z = geographic_to_cartesian_coords_python(lonc_radians, latc_radians)
-grid_points = np.column_stack([x, y, z])
+# Cartesian coordinates of ocean elements
+grid_points = gm.cartesian_coords[ocean_elements]
 
 # Form KDTree
 tree = cKDTree(grid_points)
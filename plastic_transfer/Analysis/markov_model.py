@@ -0,0 +1,479 @@
+""" Region-to-region transition (Markov) model of plastic transport
+
+Stocks computed by `compute_plastic_stock_in_eezs.py` are exact, but require
+a pass over every particle on every day. This module provides a much cheaper
+approximation. Particles are assigned to one of a small number of states (the
+receiving regions used for the connectivity metrics, plus "Other Waters"),
+and the connectivity data are used to estimate the probability that a
+particle moves from one state to another over one month. There is one
+transition matrix for each calendar month, which captures the seasonal cycle
+in currents and winds.
+
+Stocks are then projected forward one month at a time. Each month, new
+emissions are added to the states they are found in immediately after
+release, the state vector is multiplied by the transition matrix for the
+month, and mass is decayed. As decay rates differ between particle classes
+(see `decay_models.py`), a separate state vector
+is held for each emitting country and decay class.
+
+Notes
+-----
+- Transitions are estimated from snapshots taken on the release day of each
+month (e.g. the 1st at 12:00), which are also the dates at which stocks are
+projected.
+
+- Transition probabilities are estimated from particle counts, pooled across
+all emitting countries and releases. States with no observed transitions are
+assumed to retain all of their mass.
+
+- Decay is exponential in time (see `decay_models.py`).
+"""
+import datetime
+
+import numpy as np
+import pandas
+
+from shared import connectivity_netcdf_names
+from zarr_store import get_release_dates
+from netcdf_utils import netcdf_lock
+from utils import get_weights, open_connectivity_release
+from decay_models import get_default_decay_model
+
+
+# The name of the state for particles outside all of the receiving regions
+other_waters = 'Other Waters'
+
+# Calendar months in each season, used when pooling transitions by season
+seasons = {'DJF': [12, 1, 2],
+           'MAM': [3, 4, 5],
+           'JJA': [6, 7, 8],
+           'SON': [9, 10, 11]}
+
+
+def get_states():
+    """ Return the list of model states
+
+    States are the receiving regions, in the order used for the connectivity
+    metrics, followed by "Other Waters".
+    """
+    return list(connectivity_netcdf_names.keys()) + [other_waters]
+
+
+def add_months(date, n_months):
+    """ Return the date `n_months` after `date`, keeping the day and time
+    """
+    month_idx = date.month - 1 + n_months
+    return date.replace(year=date.year + month_idx // 12,
+                        month=month_idx % 12 + 1)
+
+
+def get_snapshot_indices(time_days, release_date):
+    """ Return time indices of monthly snapshots within a run
+
+    Parameters
+    ----------
+    time_days : 1D NumPy array
+        Time since the release of each time point in days.
+
+    release_date : datetime.datetime
+        The date of the release.
+
+    Returns
+    -------
+    dates : list
+        Snapshot dates, one month apart, starting on `release_date`.
+
+    indices : list
+        The corresponding time indices.
+    """
+    dates = []
+    indices = []
+
+    n_months = 0
+    while True:
+        date = add_months(release_date, n_months)
+        days = (date - release_date).total_seconds() / 86400.
+
+        idx = int(np.searchsorted(time_days, days - 1.e-6))
+        if idx >= time_days.shape[0] or abs(time_days[idx] - days) > 1.e-6:
+            break
+
+        dates.append(date)
+        indices.append(idx)
+        n_months += 1
+
+    return dates, indices
+
+
+def read_release_states(get_flags, snapshot_indices, regions):
+    """ Read the state of each particle at each snapshot
+
+    Parameters
+    ----------
+    get_flags : callable
+        Function returning the connectivity flags for a receiving region (see
+        `utils.open_connectivity_release`).
+
+    snapshot_indices : list
+        Time indices of the snapshots.
+
+    regions : list
+        The receiving regions. Region `i` is given state `i`. Particles that
+        are outside all of the regions are given state `len(regions)`.
+
+    Returns
+    -------
+     : 2D NumPy array
+        States with dimensions (snapshot, particles), or None if connectivity
+        data for any region are missing or incomplete.
+    """
+    states = None
+    for region_idx, region in enumerate(regions):
+        flags_var = get_flags(region)
+        if flags_var is None:
+            print(f' ... data for receiving region {region} are missing '
+                  f'or incomplete')
+            return None
+
+        if states is None:
+            states = np.full((len(snapshot_indices), flags_var.shape[1]),
+                             len(regions), dtype=np.int16)
+
+        for snapshot_idx, tidx in enumerate(snapshot_indices):
+            with netcdf_lock:
+                flags = np.asarray(flags_var[tidx, :])
+            states[snapshot_idx, flags == 1] = region_idx
+
+    return states
+
+
+class TransitionModel(object):
+    """ Monthly region-to-region transition model
+
+    Parameters
+    ----------
+    states : list
+        The model states.
+
+    emitters : list
+        The emitting countries.
+
+    transition_counts : 3D NumPy array
+        Number of observed transitions with dimensions (calendar month,
+        from state, to state).
+
+    initial_fractions : 3D NumPy array
+        Fraction of the mass emitted by each emitting country that is found
+        in each decay class and state immediately after release, with
+        dimensions (emitter, decay class, state).
+
+    baseline_emissions : 1D NumPy array
+        Mass emitted by each emitting country each month in the Lagrangian
+        runs (tonnes).
+
+    decay_rates : 1D NumPy array
+        Decay rate for each decay class (day^-1).
+    """
+
+    def __init__(self, states, emitters, transition_counts, initial_fractions,
+                 baseline_emissions, decay_rates):
+        self.states = list(states)
+        self.emitters = list(emitters)
+        self.transition_counts = np.asarray(transition_counts, dtype=np.float64)
+        self.initial_fractions = np.asarray(initial_fractions, dtype=np.float64)
+        self.baseline_emissions = np.asarray(baseline_emissions, dtype=np.float64)
+        self.decay_rates = np.asarray(decay_rates, dtype=np.float64)
+
+    @property
+    def n_states(self):
+        return len(self.states)
+
+    def get_transition_matrices(self, period='monthly'):
+        """ Return row-normalised transition matrices for each calendar month
+
+        Parameters
+        ----------
+        period : str, optional
+            Either 'monthly', to estimate a separate matrix for each calendar
+            month, or 'seasonal', to pool transitions over the months in each
+            season. Default: 'monthly'.
+
+        Returns
+        -------
+         : 3D NumPy array
+            Transition probabilities with dimensions (calendar month, from
+            state, to state).
+        """
+        counts = self.transition_counts
+        if period == 'seasonal':
+            counts = counts.copy()
+            for months in seasons.values():
+                month_indices = [month - 1 for month in months]
+                counts[month_indices] = \
+                    self.transition_counts[month_indices].sum(axis=0)
+        elif period != 'monthly':
+            raise ValueError(f'Unknown period `{period}`.')
+
+        matrices = np.zeros_like(counts)
+        totals = counts.sum(axis=2)
+        for month_idx in range(counts.shape[0]):
+            for state_idx in range(self.n_states):
+                if totals[month_idx, state_idx] > 0.0:
+                    matrices[month_idx, state_idx, :] = \
+                        counts[month_idx, state_idx, :] / totals[month_idx, state_idx]
+                else:
+                    matrices[month_idx, state_idx, state_idx] = 1.0
+
+        return matrices
+
+    def project(self, emissions, start_date, period='monthly'):
+        """ Project stocks forward in time
+
+        Parameters
+        ----------
+        emissions : 2D NumPy array
+            Mass emitted by each emitting country on the release day of each
+            month (tonnes), with dimensions (month, emitter).
+
+        start_date : datetime.datetime
+            Date of the first emission.
+
+        period : str, optional
+            Period over which transition matrices are estimated (see
+            `get_transition_matrices`). Default: 'monthly'.
+
+        Returns
+        -------
+        dates : list
+            The date of each month's emission.
+
+        stocks : 3D NumPy array
+            Stock on each date, just after that date's emission (tonnes),
+            with dimensions (month, emitter, state).
+        """
+        emissions = np.asarray(emissions, dtype=np.float64)
+        n_months = emissions.shape[0]
+
+        matrices = self.get_transition_matrices(period)
+
+        # Mass held in each emitter, decay class and state
+        mass = np.zeros_like(self.initial_fractions)
+
+        dates = []
+        stocks = np.zeros((n_months, len(self.emitters), self.n_states))
+        for month_idx in range(n_months):
+            date = add_months(start_date, month_idx)
+            if month_idx > 0:
+                previous_date = dates[-1]
+                days = (date - previous_date).total_seconds() / 86400.
+                mass = mass @ matrices[previous_date.month - 1]
+                mass *= np.exp(-self.decay_rates * days)[np.newaxis, :, np.newaxis]
+
+            mass += emissions[month_idx, :, np.newaxis, np.newaxis] * \
+                self.initial_fractions
+
+            dates.append(date)
+            stocks[month_idx, :, :] = mass.sum(axis=1)
+
+        return dates, stocks
+
+    def save(self, file_name):
+        """ Save the model to a `.npz` file
+        """
+        np.savez(file_name, states=np.array(self.states),
+                 emitters=np.array(self.emitters),
+                 transition_counts=self.transition_counts,
+                 initial_fractions=self.initial_fractions,
+                 baseline_emissions=self.baseline_emissions,
+                 decay_rates=self.decay_rates)
+
+    @classmethod
+    def load(cls, file_name):
+        """ Load a model saved with `save`
+        """
+        data = np.load(file_name)
+        return cls(data['states'].tolist(), data['emitters'].tolist(),
+                   data['transition_counts'], data['initial_fractions'],
+                   data['baseline_emissions'], data['decay_rates'])
+
+
+def estimate_transition_model(emitters, connectivity_root_dir, n_particles_prz,
+                              first_release_year, last_release_year,
+                              release_day=1, release_hour=12,
+                              input_format='netcdf', decay_model=None):
+    """ Estimate a transition model from connectivity data
+
+    Parameters
+    ----------
+    emitters : list
+        The emitting countries.
+
+    connectivity_root_dir : str
+        Root path to where connectivity data are stored.
+
+    n_particles_prz : int
+        The number of particles released per release zone, which is also
+        the number of decay classes.
+
+    first_release_year, last_release_year : int
+        The first and last release years (inclusive).
+
+    release_day, release_hour : int, optional
+        Day of the month and hour of the day on which particles were released.
+
+    input_format : str, optional
+        The format of the connectivity data (netcdf or zarr). Default:
+        'netcdf'.
+
+    decay_model : decay_models.DecayModel, optional
+        Model for the loss of plastic. Default: None, meaning the model used
+        in the study.
+
+    Returns
+    -------
+     : TransitionModel
+        The model.
+    """
+    states = get_states()
+    regions = states[:-1]
+    n_states = len(states)
+
+    weights, _ = get_weights(n_particles_prz, emitters, read_decay_coefs=False)
+
+    if decay_model is None:
+        decay_model = get_default_decay_model(n_particles_prz)
+
+    transition_counts = np.zeros((12, n_states, n_states), dtype=np.float64)
+    initial_mass = np.zeros((len(emitters), n_particles_prz, n_states),
+                            dtype=np.float64)
+    baseline_emissions = np.zeros(len(emitters), dtype=np.float64)
+
+    for emitter_idx, emitting_country in enumerate(emitters):
+        print(f'Estimating transitions for emitting country {emitting_country}')
+
+        particle_weights = weights[emitting_country]
+        particle_classes = np.arange(particle_weights.shape[0]) % n_particles_prz
+        baseline_emissions[emitter_idx] = particle_weights.sum()
+
+        for release_date in get_release_dates(first_release_year,
+                                              last_release_year,
+                                              release_day, release_hour):
+            release = open_connectivity_release(connectivity_root_dir,
+                                                emitting_country,
+                                                release_date, input_format)
+            if release is None:
+                continue
+
+            get_flags, time_days, close = release
+            dates, snapshot_indices = get_snapshot_indices(time_days,
+                                                           release_date)
+            states_data = read_release_states(get_flags, snapshot_indices,
+                                              regions)
+            close()
+
+            if states_data is None:
+                continue
+
+            print(f'Processing release {release_date}')
+
+            # States immediately after release
+            np.add.at(initial_mass[emitter_idx],
+                      (particle_classes, states_data[0, :]),
+                      particle_weights)
+
+            # Transitions between consecutive snapshots
+            for snapshot_idx in range(len(dates) - 1):
+                month_idx = dates[snapshot_idx].month - 1
+                pairs = states_data[snapshot_idx, :].astype(np.int64) * n_states + \
+                    states_data[snapshot_idx + 1, :]
+                transition_counts[month_idx] += \
+                    np.bincount(pairs, minlength=n_states**2).reshape(n_states,
+                                                                      n_states)
+
+    totals = initial_mass.sum(axis=(1, 2), keepdims=True)
+    initial_fractions = np.divide(initial_mass, totals,
+                                  out=np.zeros_like(initial_mass),
+                                  where=totals > 0.0)
+
+    return TransitionModel(states, emitters, transition_counts,
+                           initial_fractions, baseline_emissions,
+                           decay_model.get_daily_rates())
+
+
+def validate_projection(model, stock_dir, year, emissions_start_date,
+                        period='monthly'):
+    """ Compare projected stocks with those from the Lagrangian model
+
+    Stocks are projected using the baseline emissions, and are compared with
+    the stocks computed by `compute_plastic_stock_in_eezs.py` on the release
+    day of each month in `year`. Regions for which Lagrangian stocks are
+    missing are skipped.
+
+    Parameters
+    ----------
+    model : TransitionModel
+        The model.
+
+    stock_dir : str
+        Directory where Lagrangian stocks are saved.
+
+    year : int
+        The year in which stocks are compared.
+
+    emissions_start_date : datetime.datetime
+        The date when monthly emissions started.
+
+    period : str, optional
+        Period over which transition matrices are estimated (see
+        `TransitionModel.get_transition_matrices`). Default: 'monthly'.
+
+    Returns
+    -------
+    comparison : pandas.DataFrame
+        Lagrangian and projected stocks for each date, receiving region and
+        emitting country.
+
+    summary : pandas.DataFrame
+        Annual mean stocks and errors for each receiving region and emitting
+        country.
+    """
+    n_months = (year - emissions_start_date.year) * 12 + 12 - \
+        (emissions_start_date.month - 1)
+    emissions = np.tile(model.baseline_emissions, (n_months, 1))
+    dates, stocks = model.project(emissions, emissions_start_date, period)
+
+    rows = []
+    for region_idx, region in enumerate(model.states[:-1]):
+        for month in range(1, 13):
+            stock_file = (f'{stock_dir}/{region}/{year}/{month:02}/'
+                          f'plastic_stock_in_{region}_{year}_{month:02}.pkl')
+            try:
+                pdf = pandas.read_pickle(stock_file)
+            except FileNotFoundError:
+                continue
+
+            date = datetime.datetime(year, month, emissions_start_date.day,
+                                     emissions_start_date.hour)
+            date_idx = dates.index(date)
+            lagrangian = pdf.set_index('Date').loc[date]
+
+            for emitter_idx, emitter in enumerate(model.emitters):
+                if emitter not in lagrangian.index:
+                    continue
+                rows.append({'Date': date,
+                             'Receiving region': region,
+                             'Emitter': emitter,
+                             'Lagrangian': lagrangian[emitter],
+                             'Markov': stocks[date_idx, emitter_idx, region_idx]})
+
+    comparison = pandas.DataFrame(rows, columns=['Date', 'Receiving region',
+                                                 'Emitter', 'Lagrangian',
+                                                 'Markov'])
+
+    summary = comparison.groupby(['Receiving region', 'Emitter'])[
+        ['Lagrangian', 'Markov']].mean()
+    summary['Absolute error'] = summary['Markov'] - summary['Lagrangian']
+    summary['Relative error'] = summary['Absolute error'] / \
+        summary['Lagrangian'].where(summary['Lagrangian'] != 0.0)
+
+    return comparison, summary
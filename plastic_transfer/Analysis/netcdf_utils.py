@@ -1,7 +1,16 @@
-from netCDF4 import Dataset
+from netCDF4 import Dataset, date2num
 import numpy as np
 from collections import OrderedDict
 import os
+import logging
+import queue
+import threading
+
+
+# Lock that can be shared by threads that access netCDF files. HDF5 is not
+# always built thread safe, so threads that read or write netCDF files
+# concurrently should hold this lock while they do.
+netcdf_lock = threading.RLock()
 
 
 class NetCDFFileCreator(object):
@@ -17,16 +26,30 @@ class NetCDFFileCreator(object):
     format : str, optional
         The format of the NetCDF file (e.g. NetCDF4). Default: NetCDF4.
 
+    zlib : bool, optional
+        Compress variables with zlib. Set to False for fast, uncompressed
+        output. Default: True.
+
+    complevel : int, optional
+        The zlib compression level (1-9). Default: 7.
+
+    shuffle : bool, optional
+        Apply the HDF5 shuffle filter before compression. Default: True.
+
     """
 
-    def __init__(self, file_name, title='', format="NETCDF4"):
+    def __init__(self, file_name, title='', format="NETCDF4", zlib=True,
+                 complevel=7, shuffle=True):
         self.file_name = file_name
         self.title = title
 
         self.format = format
 
         # Compression options for the netCDF variables.
-        self.ncopts = {'zlib': True, 'complevel': 7}
+        self.ncopts = get_compression_options(zlib, complevel, shuffle)
+
+        # Index at which the next block will be written, for each variable
+        self._next_block_index = {}
 
         # Create attribute for the NetCDF4 dataset
         self.ncfile = None
@@ -66,15 +89,16 @@ class NetCDFFileCreator(object):
         name : str
             Name of the dimension
 
-        size : int
-            Name of the string
+        size : int or None
+            Size of the dimension. If None, the dimension is unlimited.
         """
         if name in self.ncfile.dimensions.keys():
             raise RuntimeError('Dimension {} already exists'.format(name))
             
         self.ncfile.createDimension(name, size)
 
-    def create_variable(self, var_name, var_data, dimensions, dtype, fill_value=None, attrs=None):
+    def create_variable(self, var_name, var_data, dimensions, dtype, fill_value=None, attrs=None,
+                        chunksizes=None, ncopts=None):
         """" Add variable
 
         Parameters
@@ -82,8 +106,9 @@ class NetCDFFileCreator(object):
         var_name : str
             Name of the variable to add
 
-        var_data : ndarray
-            Data array
+        var_data : ndarray or None
+            Data array. If None, the variable is created but no data is
+            written. Data can then be written in blocks using `write_block`.
 
         dimensions : tuple
             Dimensions of the ndarray
@@ -96,6 +121,14 @@ class NetCDFFileCreator(object):
 
         attrs : dict, optional
             Dictionary of attributes. Default: None.
+
+        chunksizes : tuple, optional
+            Chunk shape. Default: None, meaning the netCDF library default.
+
+        ncopts : dict, optional
+            Compression options for this variable (see
+            `get_compression_options`). Default: None, meaning the options
+            the file was created with.
         """
         if var_name in self.ncfile.variables.keys():
             raise RuntimeError('Variable {} already exists'.format(var_name))
@@ -105,16 +138,59 @@ class NetCDFFileCreator(object):
                 raise RuntimeError("Can't create variable `{}': the `{}' coordinate " \
                                    "variable has not yet been created.".format(var_name, dimension))
 
+        if ncopts is None:
+            ncopts = self.ncopts
+
+        if chunksizes is not None:
+            ncopts = dict(ncopts, chunksizes=chunksizes)
+
         if fill_value is not None:
             var = self.ncfile.createVariable(var_name, dtype, dimensions, fill_value=fill_value,
-                                                             **self.ncopts)
+                                                             **ncopts)
         else:
-            var = self.ncfile.createVariable(var_name, dtype, dimensions, **self.ncopts)
+            var = self.ncfile.createVariable(var_name, dtype, dimensions, **ncopts)
 
         if attrs is not None:
             var.setncatts(attrs)
 
-        var[:] = var_data.astype(dtype, casting='same_kind')
+        if var_data is not None:
+            var[:] = var_data.astype(dtype, casting='same_kind')
+            self._next_block_index[var_name] = var_data.shape[0]
+        else:
+            self._next_block_index[var_name] = 0
+
+    def write_block(self, var_name, var_data, start=None):
+        """ Write a block of data along the variable's first dimension
+
+        Used to stream data into a variable, typically in blocks of time
+        points, without holding the full array in memory. If the first
+        dimension is unlimited, it grows as blocks are written.
+
+        Parameters
+        ----------
+        var_name : str
+            Name of the variable.
+
+        var_data : ndarray
+            Data block. The trailing dimensions must match those of the
+            variable.
+
+        start : int, optional
+            Index along the first dimension at which to write the block.
+            Default: None, meaning immediately after the last block written.
+        """
+        if var_name not in self.ncfile.variables.keys():
+            raise RuntimeError('Variable {} does not exist'.format(var_name))
+
+        var = self.ncfile.variables[var_name]
+
+        if start is None:
+            start = self._next_block_index.get(var_name, 0)
+
+        end = start + var_data.shape[0]
+        var[start:end] = var_data.astype(var.dtype, casting='same_kind')
+
+        self._next_block_index[var_name] = end
 
     def _set_global_attributes(self):
         """ Set global attributes
@@ -144,8 +220,145 @@ class NetCDFFileCreator(object):
             raise RuntimeError('Problem closing file')
 
 
+class AsyncNetCDFWriter(object):
+    """ Write to a netCDF file on a background thread
+
+    Completed blocks of data are passed to a dedicated thread through a
+    bounded queue. The thread compresses and writes them while the caller
+    carries on computing the next block. Operations are applied in the
+    order they are submitted.
+
+    Once a writer has been created, all operations on the file should go
+    through it (using `write_block` or `submit`). Reading the file from
+    another thread is only safe while holding `lock`.
+
+    Parameters
+    ----------
+    nc_file : NetCDFFileCreator
+        The file to write to.
+
+    queue_depth : int, optional
+        The maximum number of operations waiting to be applied. Once the
+        queue is full, `write_block` and `submit` block. Default: 4.
+
+    lock : threading.Lock or threading.RLock, optional
+        Lock held while each operation is applied. Default: `netcdf_lock`.
+    """
+
+    def __init__(self, nc_file, queue_depth=4, lock=netcdf_lock):
+        self.nc_file = nc_file
+        self.lock = lock
+
+        self._queue = queue.Queue(maxsize=queue_depth)
+        self._error = None
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+
+                # Once an operation has failed, later ones are skipped
+                if self._error is None:
+                    func, args, kwargs = item
+                    with self.lock:
+                        func(*args, **kwargs)
+            except BaseException as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise RuntimeError(f'Failed to write to file '
+                               f'{self.nc_file.file_name}') from error
+
+    def submit(self, func, *args, **kwargs):
+        """ Queue a call to `func` on the writer thread
+
+        Raises any error from a previously submitted operation.
+        """
+        self._raise_error()
+
+        if not self._thread.is_alive():
+            raise RuntimeError('The writer has been closed')
+
+        self._queue.put((func, args, kwargs))
+
+    def write_block(self, var_name, var_data, start=None):
+        """ Queue a block of data to be written
+
+        See `NetCDFFileCreator.write_block`. `var_data` is copied, so the
+        caller may reuse its buffer as soon as this method returns.
+        """
+        self.submit(self.nc_file.write_block, var_name, np.array(var_data),
+                    start)
+
+    def flush(self):
+        """ Wait until all queued operations have been applied
+
+        Raises any error from a queued operation.
+        """
+        self._queue.join()
+        self._raise_error()
+
+    def close_file(self):
+        """ Apply all queued operations, stop the thread and close the file
+
+        The file is closed even if a queued operation failed, in which case
+        the error is raised afterwards.
+        """
+        if self._thread.is_alive():
+            self._queue.join()
+            self._queue.put(None)
+            self._thread.join()
+
+        try:
+            self.nc_file.close_file()
+        finally:
+            self._raise_error()
+
+
+def get_compression_options(zlib=True, complevel=7, shuffle=True):
+    """ Return compression options for netCDF variables
+
+    Parameters
+    ----------
+    zlib : bool, optional
+        Compress variables with zlib. Default: True.
+
+    complevel : int, optional
+        The zlib compression level (1-9). Default: 7.
+
+    shuffle : bool, optional
+        Apply the HDF5 shuffle filter before compression. Default: True.
+
+    Returns
+    -------
+     : dict
+        Keyword arguments for `netCDF4.Dataset.createVariable`.
+    """
+    if not zlib:
+        return {'zlib': False, 'shuffle': False}
+
+    if complevel not in range(1, 10):
+        raise ValueError(f'Invalid compression level {complevel}')
+
+    return {'zlib': True, 'complevel': complevel, 'shuffle': shuffle}
+
+
 class MassConcNetCDFFileCreator(object):
-    """ Class to assist in the modification of NetCDF files
+    """ Class to assist in the creation of gridded mass concentration files
+
+    Variables can either be written in one go, or created empty and then
+    filled one time slice at a time with `write_block`, so that the full
+    time series never needs to be held in memory.
     """
     _time_name = 'time'
     _lat_name = 'latitude'
@@ -155,6 +368,7 @@ class MassConcNetCDFFileCreator(object):
     def __init__(self, file_name):
         logger = logging.getLogger(__name__)
         logger.info('Creating output file: {}.'.format(file_name))
+        self.file_name = file_name
         self.ncfile = Dataset(file_name, mode='w')
 
         # Coordinate dimensions
@@ -187,7 +401,7 @@ class MassConcNetCDFFileCreator(object):
 
         # Add time variable
         self.coordinates[self._time_name] = self.ncfile.createVariable(
-            self._time_name, 'f4', (self._time_name,), **self.ncopts)
+            self._time_name, 'f8', (self._time_name,), **self.ncopts)
         self.coordinates[
             self._time_name].units = 'seconds since 2018-01-01 00:00:00'
         self.coordinates[self._time_name].calendar = 'Gregorian'
@@ -284,9 +498,16 @@ class MassConcNetCDFFileCreator(object):
         self.coordinates[self._lon_name][:] = lons
 
     def create_variable(self, var_name, var_data, dtype, fill_value,
-                        missing_value, attrs):
+                        missing_value, attrs, n_dims=None):
+        """ Add a gridded variable
+
+        If `var_data` is None, the variable is created without writing any
+        data, and `n_dims` must be given. Data can then be written using
+        `write_block`.
+        """
+        if var_data is not None:
+            n_dims = len(var_data.shape)
 
-        n_dims = len(var_data.shape)
         if n_dims == 3:
             dimensions = (self._time_name, self._lat_name, self._lon_name)
         elif n_dims == 4:
@@ -295,9 +516,15 @@ class MassConcNetCDFFileCreator(object):
         else:
             raise RuntimeError('Unsupported number of dims')
 
+        # Chunk by time slice, matching the way data are written
+        chunksizes = tuple(1 if dimension == self._time_name
+                           else len(self.dims[dimension])
+                           for dimension in dimensions)
+
         self.vars[var_name] = self.ncfile.createVariable(var_name, dtype,
                                                          dimensions,
                                                          fill_value=fill_value,
+                                                         chunksizes=chunksizes,
                                                          **self.ncopts)
         self.vars[var_name].standard_name = attrs['standard_name']
         self.vars[var_name].long_name = attrs['long_name']
@@ -307,7 +534,27 @@ class MassConcNetCDFFileCreator(object):
         if 'positive' in attrs:
             self.vars[var_name].positive = attrs['positive']
 
-        self.vars[var_name][:] = var_data
+        if var_data is not None:
+            self.vars[var_name][:] = var_data
+
+    def write_block(self, var_name, var_data, start):
+        """ Write a block of time slices to a variable
+
+        Parameters
+        ----------
+        var_name : str
+            Name of the variable.
+
+        var_data : ndarray
+            Data block, with time as the first dimension.
+
+        start : int
+            Time index at which to write the block.
+        """
+        if var_name not in self.vars.keys():
+            raise RuntimeError('Variable {} does not exist'.format(var_name))
+
+        self.vars[var_name][start:start + var_data.shape[0]] = var_data
 
     def set_global_attributes(self, global_attributes):
         self.ncfile.setncatts(global_attributes)
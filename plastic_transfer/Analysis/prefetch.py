@@ -0,0 +1,116 @@
+""" Prefetching of data blocks on background threads
+
+The analysis scripts alternate between reading a block of data (e.g. a time
+slice of host elements) and reducing it. Done in sequence, the CPU sits idle
+while data are read and decompressed, and vice versa. The generator
+`prefetch` runs the reads on a small pool of threads, keeping a bounded
+number of blocks in flight ahead of the consumer, so the two overlap.
+
+Notes
+-----
+- Blocks are always yielded in the order in which the tasks were given.
+
+- HDF5 is only safe to call from multiple threads when it has been built
+with thread safety enabled. With the default of one I/O thread, all netCDF
+reads happen on the same background thread, so the consumer must not read
+from netCDF files itself while iterating. Memory-mapped trajectory caches
+can safely be read with several threads.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def get_nbytes(block):
+    """ Return the number of bytes held by `block`
+
+    `block` may be an array or a tuple or list of arrays and other objects.
+    Objects without an `nbytes` attribute are counted as zero bytes.
+    """
+    if isinstance(block, (tuple, list)):
+        return sum(get_nbytes(item) for item in block)
+
+    return getattr(block, 'nbytes', 0)
+
+
+def prefetch(loader, tasks, queue_depth=2, max_bytes=None, num_workers=1):
+    """ Load blocks in the background while the caller consumes them
+
+    Parameters
+    ----------
+    loader : callable
+        Function that is called with a single task and returns the block
+        of data for it.
+
+    tasks : iterable
+        The tasks to process.
+
+    queue_depth : int, optional
+        The maximum number of blocks that are loading, or loaded and
+        waiting to be consumed, in addition to the block that is currently
+        being consumed. Default: 2.
+
+    max_bytes : int, optional
+        Cap on the number of bytes held in loaded or loading blocks. As the
+        size of a block is only known once it has been loaded, the size of
+        the largest block seen so far is used as an estimate for blocks
+        that are still loading. At least one block is always in flight, so
+        a single block larger than `max_bytes` is still loaded. Default:
+        None, meaning no cap.
+
+    num_workers : int, optional
+        The number of I/O threads. Default: 1.
+
+    Yields
+    ------
+     : tuple
+        Tuples of (task, block), in task order. Any exception raised by
+        `loader` is re-raised here, when its block is reached.
+    """
+    if queue_depth < 1:
+        raise ValueError(f'Queue depth must be at least one. Received '
+                         f'`{queue_depth}`.')
+
+    tasks = iter(tasks)
+    pending = deque()
+    block_nbytes = 0
+    exhausted = False
+
+    def can_submit():
+        if not pending:
+            return True
+
+        if len(pending) >= queue_depth:
+            return False
+
+        if max_bytes is not None:
+            return (len(pending) + 1) * block_nbytes <= max_bytes
+
+        return True
+
+    def top_up():
+        nonlocal exhausted
+        while not exhausted and can_submit():
+            try:
+                task = next(tasks)
+            except StopIteration:
+                exhausted = True
+                break
+            pending.append((task, executor.submit(loader, task)))
+
+    executor = ThreadPoolExecutor(max_workers=num_workers)
+    try:
+        top_up()
+        while pending:
+            task, future = pending.popleft()
+            block = future.result()
+            block_nbytes = max(block_nbytes, get_nbytes(block))
+
+            # Queue up the next blocks before handing this one over, so
+            # they are read while this one is processed
+            top_up()
+
+            yield task, block
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
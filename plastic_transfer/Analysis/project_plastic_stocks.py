@@ -0,0 +1,111 @@
+""" Project plastic stocks with the region-to-region transition model
+
+Use the transition model built by `build_transition_model.py` to
+approximate the annual mean stock of plastic in each region for a given
+year. By default, emissions are the same as those in the Lagrangian runs.
+New emission scenarios can be given as a CSV file with the columns
+`Emitter` and `Scale factor`, which scale each emitting country's monthly
+emissions. Emitters that are not listed are left unchanged.
+
+The annual mean stock matrix is saved with rows giving the receiving
+region and columns giving the emitting country, as for the stock matrices
+in `../Results/plastic_stocks`. As stocks are projected on the release day
+of each month, the annual mean is computed from twelve monthly snapshots.
+
+With `--validate`, projected stocks are compared with the stocks computed
+by `compute_plastic_stock_in_eezs.py`, and a validation report is saved.
+
+Usage
+-----
+python project_plastic_stocks.py -y <year> [-e <scale_factors_csv>] [-p <period>] [--validate]
+"""
+import sys
+import argparse
+import pathlib
+import datetime
+
+import numpy as np
+import pandas
+
+from markov_model import TransitionModel, validate_projection
+
+
+# Parse command line agruments
+parser = argparse.ArgumentParser()
+parser.add_argument('-y', '--year', help='Target year', metavar='')
+parser.add_argument('-e', '--emissions', help='CSV file of emission scale '
+                                              'factors for each emitter',
+                    metavar='')
+parser.add_argument('-p', '--period', help='Period over which transitions are '
+                                           'pooled (monthly or seasonal)',
+                    choices=['monthly', 'seasonal'], default='monthly',
+                    metavar='')
+parser.add_argument('--validate', help='Compare with Lagrangian stocks',
+                    action='store_true')
+parsed_args = parser.parse_args(sys.argv[1:])
+
+target_year = int(parsed_args.year)
+
+# The run scenario
+scenario = 'ocean_leeway'
+
+# The date when monthly emissions started
+release_day = 1
+release_hour = 12
+emissions_start_date = datetime.datetime(2000, 1, release_day, release_hour)
+
+# Directory where Lagrangian stocks are saved
+stock_dir = '../Derived_data/plastic_stock'
+
+# Load the model
+model = TransitionModel.load(f'../Derived_data/markov_model/{scenario}/'
+                             f'transition_model.npz')
+
+# Monthly emissions for each emitter
+scale_factors = np.ones(len(model.emitters))
+if parsed_args.emissions is not None:
+    scale_factors_df = pandas.read_csv(parsed_args.emissions).set_index('Emitter')
+    for emitter, scale_factor in scale_factors_df['Scale factor'].items():
+        if emitter not in model.emitters:
+            raise RuntimeError(f'Invalid country name {emitter}')
+        scale_factors[model.emitters.index(emitter)] = scale_factor
+
+n_months = (target_year - emissions_start_date.year) * 12 + 12 - \
+    (emissions_start_date.month - 1)
+emissions = np.tile(model.baseline_emissions * scale_factors, (n_months, 1))
+
+# Project stocks and compute the annual mean for the target year
+dates, stocks = model.project(emissions, emissions_start_date,
+                              parsed_args.period)
+year_indices = [idx for idx, date in enumerate(dates) if date.year == target_year]
+annual_mean = stocks[year_indices].mean(axis=0)
+
+pdf = pandas.DataFrame(annual_mean.T, index=model.states, columns=model.emitters)
+pdf['All countries'] = pdf.sum(axis=1)
+
+out_dir = f'../Results/markov_model/{scenario}'
+pathlib.Path(out_dir).mkdir(parents=True, exist_ok=True)
+pdf.to_csv(f'{out_dir}/projected_annual_mean_plastic_stock_{target_year}.csv')
+
+if parsed_args.validate:
+    comparison, summary = validate_projection(model, stock_dir, target_year,
+                                              emissions_start_date,
+                                              parsed_args.period)
+
+    comparison.to_csv(f'{out_dir}/validation_{target_year}.csv', index=False)
+    summary.to_csv(f'{out_dir}/validation_summary_{target_year}.csv')
+
+    if comparison.shape[0] == 0:
+        print(f'No Lagrangian stocks found for year {target_year}')
+    else:
+        lagrangian = comparison['Lagrangian'].values
+        markov = comparison['Markov'].values
+        total_error = (markov.sum() - lagrangian.sum()) / lagrangian.sum()
+        correlation = np.corrcoef(lagrangian, markov)[0, 1] \
+            if comparison.shape[0] > 1 else np.nan
+
+        print(f'Validation against Lagrangian stocks for year {target_year}:')
+        print(f'  Number of comparisons: {comparison.shape[0]}')
+        print(f'  Relative error in total stock: {total_error:.3f}')
+        print(f'  Correlation: {correlation:.3f}')
+        print(summary.to_string())
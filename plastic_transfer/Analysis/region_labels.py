@@ -0,0 +1,358 @@
+""" Region lookups for grid elements
+
+The grid elements that lie within each EEZ are saved by
+`associate_grid_elements_with_marine_boundaries.py`, with one file per
+region. This module reads these files and combines them into a label
+table that gives, for every grid element, the index of the region it
+lies in. With the label table, the region a particle lies in is found
+with a single array lookup on its host element.
+
+For membership tests, bitsets over the element index space (one region) and
+tables of region bitmasks (several, possibly overlapping, regions) are also
+provided. These are built once per process and cached.
+
+Particles move little between consecutive outputs, so the region a particle
+is in can also be updated by testing only the region it was in previously
+and those that border it (see `shared.region_connections` and
+`cython_helpers.update_region_labels`). Neighbour tables and stacked region
+bitsets for this are built here too.
+
+Regions are grouped into countries (e.g. Portugal, with the Azores and
+Madeira) with a region-to-country index map (see
+`build_region_country_map`), so that country totals are formed from
+region totals, or from particle region labels, with vectorized reductions.
+
+For mass budgets, elements are also given one of a small set of budget
+labels: within any region, in other waters (ocean outside all regions,
+including the EEZs of countries outside the project) or invalid (e.g. land)
+(see `build_budget_label_table`).
+"""
+import functools
+
+import numpy as np
+
+from shared import region_connections, eez_names
+from regions import countries
+
+import cython_helpers
+
+
+# Directory where grid elements for each EEZ are saved
+eez_grid_elements_dir = '../Derived_data/grid_elements/EEZ'
+
+# Budget labels (see `build_budget_label_table`)
+budget_labels = ('In regions', 'In other waters', 'On invalid hosts')
+
+# The budget label of ocean elements outside all regions
+outside_regions_budget_label = 1
+
+
+def read_region_elements(region, bdy_dir=eez_grid_elements_dir):
+    """ Read the sorted list of grid elements that lie within `region`
+
+    Parameters
+    ----------
+    region : str
+        The region (EEZ) key (see shared.py).
+
+    bdy_dir : str, optional
+        Directory where grid elements are saved.
+
+    Returns
+    -------
+     : 1D NumPy array
+        Sorted array of elements, as int32.
+    """
+    bdy_file_name = f'{bdy_dir}/grid_elements_for_{region}_EEZ_boundary.csv'
+    bdy_elements = np.fromfile(bdy_file_name, sep=',')
+
+    return np.sort(np.array(bdy_elements, dtype=np.int32))
+
+
+def build_region_label_table(regions, n_elements=None,
+                             bdy_dir=eez_grid_elements_dir):
+    """ Build a table giving the index of the region each element lies in
+
+    Parameters
+    ----------
+    regions : list
+        The regions (EEZ keys). Regions are labelled by their position in
+        this list.
+
+    n_elements : int, optional
+        The number of elements in the grid. Default: None, meaning the table
+        ends at the largest element in any of the regions. Hosts beyond the
+        end of the table are treated as lying outside all regions.
+
+    bdy_dir : str, optional
+        Directory where grid elements are saved.
+
+    Returns
+    -------
+     : 1D NumPy array
+        Region labels, as int16. Elements outside all of the regions are
+        labelled -1.
+
+    Raises
+    ------
+    RuntimeError
+        If an element lies within more than one region. A particle can only
+        be given one label, so overlapping regions must be processed
+        separately.
+    """
+    region_elements = [read_region_elements(region, bdy_dir)
+                       for region in regions]
+
+    if n_elements is None:
+        n_elements = max([elements[-1] + 1 for elements in region_elements
+                          if elements.shape[0] > 0], default=0)
+
+    labels = np.full(n_elements, -1, dtype=np.int16)
+    for label, (region, elements) in enumerate(zip(regions, region_elements)):
+        if np.any(labels[elements] >= 0):
+            overlapping = regions[labels[elements][labels[elements] >= 0][0]]
+            raise RuntimeError(f'Regions {overlapping} and {region} share '
+                               f'grid elements.')
+
+        labels[elements] = label
+
+    return labels
+
+
+@functools.lru_cache(maxsize=None)
+def get_region_bitset(region, bdy_dir=eez_grid_elements_dir):
+    """ Return a bitset of the grid elements that lie within `region`
+
+    Bitsets are cached, so each region is only read once. The returned
+    array is read only.
+
+    Parameters
+    ----------
+    region : str
+        The region (EEZ) key (see shared.py).
+
+    bdy_dir : str, optional
+        Directory where grid elements are saved.
+
+    Returns
+    -------
+     : 1D NumPy array
+        Bitset, as uint64 words (see `cython_helpers.build_element_bitset`).
+    """
+    bitset = cython_helpers.build_element_bitset(
+        read_region_elements(region, bdy_dir))
+    bitset.setflags(write=False)
+
+    return bitset
+
+
+@functools.lru_cache(maxsize=None)
+def get_region_mask_table(regions, bdy_dir=eez_grid_elements_dir):
+    """ Return a table of region bitmasks over the grid elements
+
+    Tables are cached, so each set of regions is only read once. The
+    returned array is read only.
+
+    Parameters
+    ----------
+    regions : tuple
+        The regions (EEZ keys). Region `r` is given bit `r` in the masks.
+        At most 64 regions are supported. Regions may overlap.
+
+    bdy_dir : str, optional
+        Directory where grid elements are saved.
+
+    Returns
+    -------
+     : 1D NumPy array
+        Masks, as uint64 (see `cython_helpers.build_element_region_masks`).
+    """
+    masks = cython_helpers.build_element_region_masks(
+        [read_region_elements(region, bdy_dir) for region in regions])
+    masks.setflags(write=False)
+
+    return masks
+
+
+def build_region_neighbour_table(regions):
+    """ Build a table of the regions that border each region
+
+    Parameters
+    ----------
+    regions : list
+        The regions (EEZ keys). Regions are labelled by their position in
+        this list.
+
+    Returns
+    -------
+     : 2D NumPy array
+        Neighbouring region labels, as int16 with dimensions (region,
+        neighbour). Each row starts with the region itself, followed by the
+        regions it is connected to in `shared.region_connections`, and is
+        padded with -1. Connected regions that are not in `regions`, and
+        Other Waters, are left out.
+    """
+    region_indices = {region: idx for idx, region in enumerate(regions)}
+
+    neighbours = []
+    for region in regions:
+        row = [region_indices[region]]
+        row.extend(region_indices[connection]
+                   for connection in region_connections[region]
+                   if connection in region_indices and connection != region)
+        neighbours.append(row)
+
+    max_neighbours = max([len(row) for row in neighbours], default=0)
+    table = np.full((len(regions), max_neighbours), -1, dtype=np.int16)
+    for idx, row in enumerate(neighbours):
+        table[idx, :len(row)] = row
+
+    return table
+
+
+def build_region_bitsets(regions, n_elements=None,
+                         bdy_dir=eez_grid_elements_dir):
+    """ Stack the bitsets of the grid elements in each region
+
+    Parameters
+    ----------
+    regions : list
+        The regions (EEZ keys), in label order.
+
+    n_elements : int, optional
+        The number of elements in the grid. Default: None, meaning bitsets
+        end at the largest element in any of the regions.
+
+    bdy_dir : str, optional
+        Directory where grid elements are saved.
+
+    Returns
+    -------
+     : 2D NumPy array
+        Bitsets, as uint64 words with dimensions (region, word) (see
+        `get_region_bitset`).
+    """
+    bitsets = [get_region_bitset(region, bdy_dir) for region in regions]
+
+    n_words = max([bitset.shape[0] for bitset in bitsets], default=0)
+    if n_elements is not None:
+        n_words = max(n_words, (n_elements + 63) // 64)
+
+    stacked = np.zeros((len(regions), n_words), dtype=np.uint64)
+    for idx, bitset in enumerate(bitsets):
+        stacked[idx, :bitset.shape[0]] = bitset
+
+    return stacked
+
+
+def build_region_country_map(regions):
+    """ Map regions to the countries they belong to
+
+    Only countries with all of their regions (see `regions.countries`) in
+    `regions` are included, so that country totals are complete.
+
+    Parameters
+    ----------
+    regions : list
+        The regions (EEZ keys), in label order.
+
+    Returns
+    -------
+    region_countries : 1D NumPy array
+        The index of the country each region belongs to, as int16, or -1
+        if the country is not included.
+
+    country_keys : list
+        The included countries, in registry order.
+    """
+    region_indices = {region: idx for idx, region in enumerate(regions)}
+
+    region_countries = np.full(len(regions), -1, dtype=np.int16)
+    country_keys = []
+    for key, country in countries.items():
+        if not all(region in region_indices for region in country.regions):
+            continue
+
+        for region in country.regions:
+            region_countries[region_indices[region]] = len(country_keys)
+        country_keys.append(key)
+
+    return region_countries, country_keys
+
+
+def aggregate_to_countries(values, region_countries, n_countries, axis=-1):
+    """ Sum values over the regions in each country
+
+    Parameters
+    ----------
+    values : NumPy array
+        Values for each region along `axis`.
+
+    region_countries : 1D NumPy array
+        The country index of each region, or -1 (see
+        `build_region_country_map`).
+
+    n_countries : int
+        The number of countries.
+
+    axis : int, optional
+        The region axis. Default: -1.
+
+    Returns
+    -------
+     : NumPy array
+        Summed values, with the region axis replaced by a country axis.
+    """
+    values = np.asarray(values)
+    region_countries = np.asarray(region_countries)
+
+    membership = np.zeros((region_countries.shape[0], n_countries),
+                          dtype=values.dtype)
+    in_country = region_countries >= 0
+    membership[in_country, region_countries[in_country]] = 1
+
+    return np.moveaxis(np.moveaxis(values, axis, -1) @ membership, -1, axis)
+
+
+def get_country_label_table(region_countries):
+    """ Return a table mapping region labels to country labels
+
+    The table has one more entry than there are regions, with the last
+    entry set to -1, so that indexing it with particle region labels maps
+    the label -1 (outside all regions) to -1.
+    """
+    return np.append(np.asarray(region_countries, dtype=np.int16),
+                     np.int16(-1))
+
+
+def build_budget_label_table(mask, bdy_dir=eez_grid_elements_dir):
+    """ Build a table giving the budget label of each element
+
+    Parameters
+    ----------
+    mask : 1D NumPy array
+        Land mask for each element of the grid, with non-zero values on land
+        (see `grid.GridMetrics.mask`).
+
+    bdy_dir : str, optional
+        Directory where grid elements are saved.
+
+    Returns
+    -------
+     : 1D NumPy array
+        Labels, as int16, indexing `budget_labels`. Ocean elements within
+        any region (see `shared.eez_names`) are labelled 0, other ocean
+        elements (other waters, which include the EEZs of countries outside
+        the project) 1, and land elements 2. Hosts
+        outside the table are also invalid, so their mass is given by the
+        total less the mass in labelled elements.
+    """
+    mask = np.asarray(mask)
+
+    labels = np.ones(mask.shape[0], dtype=np.int16)
+    for region in eez_names:
+        elements = read_region_elements(region, bdy_dir)
+        labels[elements[elements < mask.shape[0]]] = 0
+    labels[mask != 0] = 2
+
+    return labels
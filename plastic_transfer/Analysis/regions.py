@@ -0,0 +1,244 @@
+""" Registry of emitting countries and receiving regions
+
+This module has no third party dependencies, so that it (and `shared.py`,
+which builds its lookup tables from it) can be imported quickly by the
+many short jobs that only need country and region names.
+
+Each emitting country has one or more receiving regions (EEZs), e.g. the
+US has separate regions for Alaska and Hawaii. Regions are listed in the
+order used to index region dimensions in saved outputs, which must not
+change.
+
+EEZ names are as given in the Marine Boundaries data set for EEZs (v11).
+Several exclave regions are excluded, including French Guiana (France).
+Exclave and semi-exclave regions for the US, including Hawaii and Alaska,
+are included.
+"""
+from dataclasses import dataclass
+from typing import Dict, Tuple
+
+
+# Name of the pseudo-region covering all waters outside the listed EEZs
+other_waters = 'Other Waters'
+
+
+@dataclass(frozen=True)
+class Country:
+    """ An emitting country
+
+    Attributes
+    ----------
+    key : str
+        Short name used throughout the project (e.g. in file names).
+
+    gni_name : str
+        Name used in the Gross National Income data.
+
+    world_data_name : str
+        Name used in the Geopandas World Data dataset, which was used to
+        associate Meijer rivers with countries.
+
+    regions : tuple
+        Keys of the country's receiving regions.
+    """
+    key: str
+    gni_name: str
+    world_data_name: str
+    regions: Tuple[str, ...]
+
+
+@dataclass(frozen=True)
+class Region:
+    """ A receiving region (EEZ)
+
+    Attributes
+    ----------
+    key : str
+        Short name used throughout the project (e.g. in file names).
+
+    country : str
+        Key of the country the region belongs to.
+
+    eez_name : str
+        Name used in the Marine Boundaries data set.
+
+    netcdf_name : str
+        NetCDF friendly name, used in connectivity variable names.
+
+    connections : tuple
+        Keys of the regions that are directly connected to this one
+        geographically, including itself and `other_waters`.
+    """
+    key: str
+    country: str
+    eez_name: str
+    netcdf_name: str
+    connections: Tuple[str, ...]
+
+
+def _build_registry(items):
+    return {item.key: item for item in items}
+
+
+# Emitting countries, in project order
+countries = _build_registry([
+    Country('Belgium', gni_name='Belgium',
+            world_data_name='Belgium',
+            regions=('Belgium',)),
+    Country('Canada', gni_name='Canada',
+            world_data_name='Canada',
+            regions=('Canada',)),
+    Country('Denmark', gni_name='Denmark',
+            world_data_name='Denmark',
+            regions=('Denmark',)),
+    Country('France', gni_name='France',
+            world_data_name='France',
+            regions=('France',)),
+    Country('Germany', gni_name='Germany',
+            world_data_name='Germany',
+            regions=('Germany',)),
+    Country('Dom. Rep.', gni_name='Dominican Republic',
+            world_data_name='Dominican Rep.',
+            regions=('Dom. Rep.',)),
+    Country('Haiti', gni_name='Haiti',
+            world_data_name='Haiti',
+            regions=('Haiti',)),
+    Country('Ireland', gni_name='Ireland',
+            world_data_name='Ireland',
+            regions=('Ireland',)),
+    Country('Mexico', gni_name='Mexico',
+            world_data_name='Mexico',
+            regions=('Mexico',)),
+    Country('Morocco', gni_name='Morocco',
+            world_data_name='Morocco',
+            regions=('Morocco', 'Morocco (Western Saharan)')),
+    Country('Netherlands', gni_name='Netherlands',
+            world_data_name='Netherlands',
+            regions=('Netherlands',)),
+    Country('Portugal', gni_name='Portugal',
+            world_data_name='Portugal',
+            regions=('Portugal', 'Portugal (Azores)', 'Portugal (Madeira)')),
+    Country('Spain', gni_name='Spain',
+            world_data_name='Spain',
+            regions=('Spain', 'Spain (Canary Islands)')),
+    Country('Sweden', gni_name='Sweden',
+            world_data_name='Sweden',
+            regions=('Sweden',)),
+    Country('UK', gni_name='United Kingdom',
+            world_data_name='United Kingdom',
+            regions=('UK',)),
+    Country('US', gni_name='United States',
+            world_data_name='United States of America',
+            regions=('US', 'US (Alaska)', 'US (Hawaii)')),
+])
+
+# Receiving regions, in the order used to index saved outputs
+regions = _build_registry([
+    Region('Belgium', country='Belgium',
+           eez_name='Belgian Exclusive Economic Zone',
+           netcdf_name='belgium',
+           connections=('Belgium', 'France', 'Netherlands', 'UK', 'Other Waters')),
+    Region('Canada', country='Canada',
+           eez_name='Canadian Exclusive Economic Zone',
+           netcdf_name='canada',
+           connections=('Canada', 'US', 'US (Alaska)', 'Other Waters')),
+    Region('Denmark', country='Denmark',
+           eez_name='Danish Exclusive Economic Zone',
+           netcdf_name='denmark',
+           connections=('Denmark', 'Germany', 'Sweden', 'Other Waters')),
+    Region('France', country='France',
+           eez_name='French Exclusive Economic Zone',
+           netcdf_name='france',
+           connections=('Belgium', 'France', 'Netherlands', 'Spain', 'UK', 'Other Waters')),
+    Region('Germany', country='Germany',
+           eez_name='German Exclusive Economic Zone',
+           netcdf_name='germany',
+           connections=('Denmark', 'Germany', 'Netherlands', 'Sweden', 'Other Waters')),
+    Region('Dom. Rep.', country='Dom. Rep.',
+           eez_name='Dominican Republic Exclusive Economic Zone',
+           netcdf_name='dom_rep',
+           connections=('Dom. Rep.', 'Haiti', 'Other Waters')),
+    Region('Haiti', country='Haiti',
+           eez_name='Haitian Exclusive Economic Zone',
+           netcdf_name='haiti',
+           connections=('Dom. Rep.', 'Haiti', 'Other Waters')),
+    Region('Ireland', country='Ireland',
+           eez_name='Irish Exclusive Economic Zone',
+           netcdf_name='ireland',
+           connections=('Ireland', 'UK', 'Other Waters')),
+    Region('Mexico', country='Mexico',
+           eez_name='Mexican Exclusive Economic Zone',
+           netcdf_name='mexico',
+           connections=('Mexico', 'US', 'Other Waters')),
+    Region('Morocco', country='Morocco',
+           eez_name='Moroccan Exclusive Economic Zone',
+           netcdf_name='morocco',
+           connections=('Morocco', 'Morocco (Western Saharan)', 'Spain', 'Spain (Canary Islands)', 'Other Waters')),
+    Region('Morocco (Western Saharan)', country='Morocco',
+           eez_name='Overlapping claim Western Saharan Exclusive Economic Zone',
+           netcdf_name='western_saharan',
+           connections=('Morocco', 'Morocco (Western Saharan)', 'Spain (Canary Islands)', 'Other Waters')),
+    Region('Netherlands', country='Netherlands',
+           eez_name='Dutch Exclusive Economic Zone',
+           netcdf_name='netherlands',
+           connections=('Belgium', 'Denmark', 'Germany', 'Netherlands', 'UK', 'Other Waters')),
+    Region('Portugal', country='Portugal',
+           eez_name='Portuguese Exclusive Economic Zone',
+           netcdf_name='portugal',
+           connections=('Morocco', 'Portugal', 'Spain', 'Other Waters')),
+    Region('Portugal (Azores)', country='Portugal',
+           eez_name='Portuguese Exclusive Economic Zone (Azores)',
+           netcdf_name='azores',
+           connections=('Portugal (Azores)', 'Other Waters')),
+    Region('Portugal (Madeira)', country='Portugal',
+           eez_name='Portuguese Exclusive Economic Zone (Madeira)',
+           netcdf_name='madeira',
+           connections=('Morocco', 'Portugal (Madeira)', 'Spain (Canary Islands)', 'Other Waters')),
+    Region('Spain', country='Spain',
+           eez_name='Spanish Exclusive Economic Zone',
+           netcdf_name='spain',
+           connections=('France', 'Morocco', 'Portugal', 'Spain', 'Other Waters')),
+    Region('Spain (Canary Islands)', country='Spain',
+           eez_name='Spanish Exclusive Economic Zone (Canary Islands)',
+           netcdf_name='canaries',
+           connections=('Morocco', 'Morocco (Western Saharan)', 'Portugal (Madeira)', 'Spain (Canary Islands)', 'Other Waters')),
+    Region('Sweden', country='Sweden',
+           eez_name='Swedish Exclusive Economic Zone',
+           netcdf_name='sweden',
+           connections=('Denmark', 'Germany', 'Sweden', 'Other Waters')),
+    Region('UK', country='UK',
+           eez_name='United Kingdom Exclusive Economic Zone',
+           netcdf_name='uk',
+           connections=('Belgium', 'Denmark', 'France', 'Germany', 'Ireland', 'Netherlands', 'UK', 'Other Waters')),
+    Region('US', country='US',
+           eez_name='United States Exclusive Economic Zone',
+           netcdf_name='us',
+           connections=('Canada', 'Mexico', 'US', 'Other Waters')),
+    Region('US (Alaska)', country='US',
+           eez_name='United States Exclusive Economic Zone (Alaska)',
+           netcdf_name='alaska',
+           connections=('Canada', 'US (Alaska)', 'Other Waters')),
+    Region('US (Hawaii)', country='US',
+           eez_name='United States Exclusive Economic Zone (Hawaii)',
+           netcdf_name='hawaii',
+           connections=('US (Hawaii)', 'Other Waters')),
+])
+
+
+def _check_registry(countries: Dict[str, Country],
+                    regions: Dict[str, Region]):
+    for country in countries.values():
+        for region in country.regions:
+            if regions[region].country != country.key:
+                raise RuntimeError(f'Region {region} is listed under '
+                                   f'{country.key}, but belongs to '
+                                   f'{regions[region].country}')
+
+    for region in regions.values():
+        for connection in region.connections:
+            if connection != other_waters and connection not in regions:
+                raise RuntimeError(f'Unknown region {connection} connected '
+                                   f'to {region.key}')
+
+
+_check_registry(countries, regions)
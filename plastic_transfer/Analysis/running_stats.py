@@ -0,0 +1,136 @@
+""" Running statistics for stock matrices
+
+Annual mean stock matrices were previously assembled by hand once all the
+monthly stock files for a year were available. `RunningStats` instead keeps
+the mean, variance, minimum and maximum of the daily stocks in each cell
+of a (receiving region, emitting country) matrix, and is updated one month
+at a time as monthly outputs complete. Means and variances are updated
+with Welford's algorithm, in the form that combines the statistics of a
+batch of values (here, the days of one month) with the running ones:
+
+n = n_a + n_b
+delta = mean_b - mean_a
+mean = mean_a + delta * n_b / n
+M2 = M2_a + M2_b + delta**2 * n_a * n_b / n,
+
+where M2 is the sum of squared deviations from the mean. This avoids the
+loss of precision of accumulating sums of squares.
+
+The statistics, together with the months that have been consumed for each
+region, are saved in a compact binary (npz) file. Loading this file allows
+the statistics to be updated when further months complete.
+"""
+import os
+
+import numpy as np
+
+
+class RunningStats(object):
+    """ Running statistics of daily stocks for each matrix cell
+
+    Parameters
+    ----------
+    regions : list
+        The receiving regions (matrix rows).
+
+    emitters : list
+        The emitting countries (matrix columns).
+    """
+
+    def __init__(self, regions, emitters):
+        self.regions = list(regions)
+        self.emitters = list(emitters)
+
+        shape = (len(self.regions), len(self.emitters))
+        self.count = np.zeros(shape, dtype=np.int64)
+        self.mean = np.zeros(shape, dtype=np.float64)
+        self.m2 = np.zeros(shape, dtype=np.float64)
+        self.min = np.full(shape, np.inf)
+        self.max = np.full(shape, -np.inf)
+
+        # Key identifying the version of the stocks consumed for each region
+        # and month (e.g. the modification time of the stock file), or NaN
+        # if the month has not been consumed
+        self.consumed = np.full((len(self.regions), 12), np.nan)
+
+    def update(self, region, values):
+        """ Update the statistics for `region` with a batch of values
+
+        Parameters
+        ----------
+        region : str
+            The receiving region.
+
+        values : 2D NumPy array
+            Values with dimensions (day, emitter). NaNs are ignored.
+        """
+        region_idx = self.regions.index(region)
+
+        # Only update emitters with at least one valid value
+        valid = np.isfinite(values)
+        cols = np.flatnonzero(valid.any(axis=0))
+        if cols.shape[0] == 0:
+            return
+        values = values[:, cols]
+        valid = valid[:, cols]
+
+        n_b = valid.sum(axis=0)
+        mean_b = np.where(valid, values, 0.0).sum(axis=0) / n_b
+        m2_b = (np.where(valid, values - mean_b, 0.0)**2).sum(axis=0)
+
+        n_a = self.count[region_idx, cols]
+        mean_a = self.mean[region_idx, cols]
+        n = n_a + n_b
+        delta = mean_b - mean_a
+
+        self.count[region_idx, cols] = n
+        self.mean[region_idx, cols] = mean_a + delta * n_b / n
+        self.m2[region_idx, cols] += m2_b + delta**2 * n_a * n_b / n
+        self.min[region_idx, cols] = np.minimum(self.min[region_idx, cols],
+                                                np.where(valid, values, np.inf).min(axis=0))
+        self.max[region_idx, cols] = np.maximum(self.max[region_idx, cols],
+                                                np.where(valid, values, -np.inf).max(axis=0))
+
+    def get_variance(self, ddof=1):
+        """ Return the variance of the values in each cell
+
+        Cells with no more than `ddof` values are set to NaN.
+        """
+        return np.divide(self.m2, self.count - ddof,
+                         out=np.full(self.m2.shape, np.nan),
+                         where=self.count > ddof)
+
+    def get_statistic(self, name):
+        """ Return the statistic `name` (mean, variance, min or max)
+
+        Cells with no values are set to NaN.
+        """
+        if name == 'variance':
+            return self.get_variance()
+
+        values = {'mean': self.mean, 'min': self.min, 'max': self.max}[name]
+        return np.where(self.count > 0, values, np.nan)
+
+    def save(self, file_name):
+        """ Save the statistics to file
+
+        The file is written to a temporary file first, so a reader never
+        sees a partially written file.
+        """
+        tmp_file_name = f'{file_name}.tmp'
+        with open(tmp_file_name, 'wb') as f:
+            np.savez(f, regions=np.array(self.regions),
+                     emitters=np.array(self.emitters), count=self.count,
+                     mean=self.mean, m2=self.m2, min=self.min, max=self.max,
+                     consumed=self.consumed)
+        os.replace(tmp_file_name, file_name)
+
+    @classmethod
+    def load(cls, file_name):
+        """ Load statistics saved with `save`
+        """
+        data = np.load(file_name)
+        stats = cls(data['regions'].tolist(), data['emitters'].tolist())
+        for name in ['count', 'mean', 'm2', 'min', 'max', 'consumed']:
+            setattr(stats, name, data[name])
+        return stats
@@ -1,123 +1,33 @@
 """ Module for shared constants etc
+
+Country and region names are built from the registry in `regions.py`.
+Geometry and CRS objects (`data_crs` and `canada_outline_poly`) are created
+on first access, so that scripts which only need names do not pay the cost
+of importing cartopy and shapely.
 """
-import cartopy.crs as ccrs
-import shapely.geometry
+from regions import countries, regions, other_waters
 
 font_size = 8
 
-data_crs=ccrs.PlateCarree()
-
 
 # List of North Atlantic States for the project
-na_countries = ['Belgium',
-                'Canada',
-                'Denmark',
-                'France',
-                'Germany',
-                'Dom. Rep.',
-                'Haiti',
-                'Ireland',
-                'Mexico',
-                'Morocco',
-                'Netherlands',
-                'Portugal',
-                'Spain',
-                'Sweden',
-                'UK',
-                'US']
+na_countries = list(countries.keys())
 
 # List of GNI names for the North Atlantic States
-gni_names = {'Belgium': 'Belgium',
-             'Canada': 'Canada',
-             'Denmark': 'Denmark',
-             'France': 'France',
-             'Germany': 'Germany',
-             'Dom. Rep.': 'Dominican Republic',
-             'Haiti': 'Haiti',
-             'Ireland': 'Ireland',
-             'Mexico': 'Mexico',
-             'Morocco': 'Morocco',
-             'Netherlands': 'Netherlands',
-             'Portugal': 'Portugal',
-             'Spain': 'Spain',
-             'Sweden': 'Sweden',
-             'UK': 'United Kingdom',
-             'US': 'United States'}
+gni_names = {key: country.gni_name for key, country in countries.items()}
 
 # Dictionary of country names, as given in the Geopandas World Data dataset; these
 # names were used to associate Meijer rivers with countries.
-world_data_names = {'Belgium': 'Belgium',
-                    'Canada': 'Canada',
-                    'Denmark': 'Denmark',
-                    'France': 'France',
-                    'Germany': 'Germany',
-                    'Dom. Rep.': 'Dominican Rep.',
-                    'Haiti': 'Haiti',
-                    'Ireland': 'Ireland',
-                    'Mexico': 'Mexico',
-                    'Morocco': 'Morocco',
-                    'Netherlands': 'Netherlands',
-                    'Portugal': 'Portugal',
-                    'Spain': 'Spain',
-                    'Sweden': 'Sweden',
-                    'UK': 'United Kingdom',
-                    'US': 'United States of America'}
+world_data_names = {key: country.world_data_name
+                    for key, country in countries.items()}
 
 # Dictionary of EEZ names, as given in the Marine Boundaries data set for
 # EEZs (v11).
-#
-# Notes
-# -----
-# Excludes several exclave regions, including: French Guiana (France).
-#
-# Includes exclave and semi-exclave regions for the US, including:
-# Hawaii and Alaska.
-eez_names = {'Belgium': 'Belgian Exclusive Economic Zone',
-             'Canada': 'Canadian Exclusive Economic Zone',
-             'Denmark': 'Danish Exclusive Economic Zone',
-             'France': 'French Exclusive Economic Zone',
-             'Germany': 'German Exclusive Economic Zone',
-             'Dom. Rep.': 'Dominican Republic Exclusive Economic Zone',
-             'Haiti': 'Haitian Exclusive Economic Zone',
-             'Ireland': 'Irish Exclusive Economic Zone',
-             'Mexico': 'Mexican Exclusive Economic Zone',
-             'Morocco': 'Moroccan Exclusive Economic Zone',
-             'Morocco (Western Saharan)': 'Overlapping claim Western Saharan Exclusive Economic Zone',
-             'Netherlands': 'Dutch Exclusive Economic Zone',
-             'Portugal': 'Portuguese Exclusive Economic Zone',
-             'Portugal (Azores)': 'Portuguese Exclusive Economic Zone (Azores)',
-             'Portugal (Madeira)': 'Portuguese Exclusive Economic Zone (Madeira)',
-             'Spain': 'Spanish Exclusive Economic Zone',
-             'Spain (Canary Islands)': 'Spanish Exclusive Economic Zone (Canary Islands)',
-             'Sweden': 'Swedish Exclusive Economic Zone',
-             'UK': 'United Kingdom Exclusive Economic Zone',
-             'US': 'United States Exclusive Economic Zone',
-             'US (Alaska)': 'United States Exclusive Economic Zone (Alaska)',
-             'US (Hawaii)': 'United States Exclusive Economic Zone (Hawaii)'}
+eez_names = {key: region.eez_name for key, region in regions.items()}
 
 # Dictionary of netcdf friendly country names for the connectivity files
-connectivity_netcdf_names = {'Belgium': 'belgium',
-                             'Canada': 'canada',
-                             'Denmark': 'denmark',
-                             'France': 'france',
-                             'Germany': 'germany',
-                             'Dom. Rep.': 'dom_rep',
-                             'Haiti': 'haiti',
-                             'Ireland': 'ireland',
-                             'Mexico': 'mexico',
-                             'Morocco': 'morocco',
-                             'Morocco (Western Saharan)': 'western_saharan',
-                             'Netherlands': 'netherlands',
-                             'Portugal': 'portugal',
-                             'Portugal (Azores)': 'azores',
-                             'Portugal (Madeira)': 'madeira',
-                             'Spain': 'spain',
-                             'Spain (Canary Islands)': 'canaries',
-                             'Sweden': 'sweden',
-                             'UK': 'uk',
-                             'US': 'us',
-                             'US (Alaska)': 'alaska',
-                             'US (Hawaii)': 'hawaii'}
+connectivity_netcdf_names = {key: region.netcdf_name
+                             for key, region in regions.items()}
 
 
 international_waters_netcdf_var_name = "is_present_in_international_waters"
@@ -126,46 +36,18 @@ international_waters_netcdf_var_attrs = {'units': 'n/a',
 
 
 def get_country_regions(country):
-    if country == "Morocco":
-        regions = ["Morocco", "Morocco (Western Saharan)"]
-    elif country == "Portugal":
-        regions = ["Portugal", "Portugal (Azores)", "Portugal (Madeira)"]
-    elif country == "Spain":
-        regions = ["Spain", "Spain (Canary Islands)"]
-    elif country == "US":
-        regions = ["US", "US (Alaska)", "US (Hawaii)"]
-    else:
-        regions = [f"{country}"]
-    return regions
+    if country in countries:
+        return list(countries[country].regions)
+    return [f"{country}"]
 
 
 # Regions that are directly connected geographically
-region_connections = {'Belgium': ['Belgium', 'France', 'Netherlands', 'UK', 'Other Waters'],
-                      'Canada': ['Canada', 'US', 'US (Alaska)', 'Other Waters'],
-                      'Denmark': ['Denmark', 'Germany', 'Sweden', 'Other Waters'],
-                      'France': ['Belgium', 'France', 'Netherlands', 'Spain', 'UK', 'Other Waters'],
-                      'Germany': ['Denmark', 'Germany', 'Netherlands', 'Sweden', 'Other Waters'],
-                      'Dom. Rep.': ['Dom. Rep.', 'Haiti', 'Other Waters'],
-                      'Haiti': ['Dom. Rep.', 'Haiti', 'Other Waters'],
-                      'Ireland': ['Ireland', 'UK', 'Other Waters'],
-                      'Mexico': ['Mexico', 'US', 'Other Waters'],
-                      'Morocco': ['Morocco', 'Morocco (Western Saharan)', 'Spain', 'Spain (Canary Islands)', 'Other Waters'],
-                      'Morocco (Western Saharan)': ['Morocco', 'Morocco (Western Saharan)', 'Spain (Canary Islands)', 'Other Waters'],
-                      'Netherlands': ['Belgium', 'Denmark', 'Germany', 'Netherlands', 'UK', 'Other Waters'],
-                      'Portugal': ['Morocco', 'Portugal', 'Spain', 'Other Waters'],
-                      'Portugal (Azores)': ['Portugal (Azores)', 'Other Waters'],
-                      'Portugal (Madeira)': ['Morocco', 'Portugal (Madeira)', 'Spain (Canary Islands)', 'Other Waters'],
-                      'Spain': ['France', 'Morocco', 'Portugal', 'Spain', 'Other Waters'],
-                      'Spain (Canary Islands)': ['Morocco', 'Morocco (Western Saharan)', 'Portugal (Madeira)', 'Spain (Canary Islands)', 'Other Waters'],
-                      'Sweden': ['Denmark', 'Germany', 'Sweden', 'Other Waters'],
-                      'UK': ['Belgium', 'Denmark', 'France', 'Germany', 'Ireland', 'Netherlands', 'UK', 'Other Waters'],
-                      'US': ['Canada', 'Mexico', 'US', 'Other Waters'],
-                      'US (Alaska)': ['Canada', 'US (Alaska)', 'Other Waters'],
-                      'US (Hawaii)': ['US (Hawaii)', 'Other Waters']}
+region_connections = {key: list(region.connections)
+                      for key, region in regions.items()}
 
 # Add Other Waters
-region_connections['Other Waters'] = list(eez_names.keys())
-region_connections['Other Waters'].append('Other Waters')
+region_connections[other_waters] = list(eez_names.keys())
+region_connections[other_waters].append(other_waters)
 
 
 # Country specific run parameters
@@ -225,7 +107,33 @@ archer_wall_time = {'Belgium': '24:00:00',
 # Polygons that roughly outline countries
 canada_outline = [[-47.2, 40.], [-47.2, 55.], [-63.7, 78.5], [-50., 86.8],
                   [-105., 86.8], [-142, 80.], [-142., 45.], [-80., 40.]]
-canada_outline_poly = shapely.geometry.Polygon([[p[0], p[1]] for p in canada_outline])
 
 # Earth's radius
 earth_radius = 6378137.
+
+
+# Objects that need cartopy or shapely, created on first access
+_lazy_attributes = {}
+
+
+def _create_data_crs():
+    import cartopy.crs as ccrs
+    return ccrs.PlateCarree()
+
+
+def _create_canada_outline_poly():
+    import shapely.geometry
+    return shapely.geometry.Polygon([[p[0], p[1]] for p in canada_outline])
+
+
+_lazy_attribute_factories = {'data_crs': _create_data_crs,
+                             'canada_outline_poly': _create_canada_outline_poly}
+
+
+def __getattr__(name):
+    if name in _lazy_attribute_factories:
+        if name not in _lazy_attributes:
+            _lazy_attributes[name] = _lazy_attribute_factories[name]()
+        return _lazy_attributes[name]
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,509 @@
+""" Catalog of PyLag simulation outputs
+
+The analysis scripts repeatedly need the same handful of facts about each
+PyLag output file: the number of particles it contains, how many river
+release zones these belong to and which time index corresponds to a given
+date. Reading these from the netCDF files means opening every file and
+converting its full time array for every day that is processed. Instead,
+the Simulations tree is scanned once and the facts are stored in a SQLite
+database, which can then be queried without opening any netCDF files.
+
+The catalog assumes the directory layout created by
+`configure_pylag_simulations.py`, i.e.:
+
+<root_dir>/<emitter>/<year>/<month>/output/pylag_1.nc
+
+Usage
+-----
+python build_simulation_catalog.py -s <scenario>
+"""
+import os
+import glob
+import sqlite3
+import datetime
+from collections import namedtuple
+
+from netCDF4 import Dataset
+from cftime import num2date
+
+
+# Default name of the catalog file, which is saved in the root directory
+catalog_file_name = 'simulation_catalog.db'
+
+# Reference date used when rounding dates
+_epoch = datetime.datetime(1970, 1, 1)
+
+# Record describing a single release
+ReleaseRecord = namedtuple('ReleaseRecord', ['path',
+                                             'emitter',
+                                             'release_date',
+                                             'n_particles',
+                                             'n_groups',
+                                             'n_times',
+                                             'time_origin',
+                                             'time_step',
+                                             'file_size',
+                                             'file_mtime'])
+
+_schema = """
+CREATE TABLE IF NOT EXISTS releases (
+    path TEXT PRIMARY KEY,
+    emitter TEXT NOT NULL,
+    release_date TEXT NOT NULL,
+    n_particles INTEGER NOT NULL,
+    n_groups INTEGER NOT NULL,
+    n_times INTEGER NOT NULL,
+    time_origin TEXT NOT NULL,
+    time_step REAL NOT NULL,
+    file_size INTEGER NOT NULL,
+    file_mtime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS releases_by_emitter
+    ON releases (emitter, release_date);
+CREATE TABLE IF NOT EXISTS caches (
+    path TEXT NOT NULL,
+    var_name TEXT NOT NULL,
+    cache_path TEXT NOT NULL,
+    source_size INTEGER NOT NULL,
+    source_mtime REAL NOT NULL,
+    PRIMARY KEY (path, var_name)
+);
+"""
+
+
+def get_catalog_file_name(root_dir):
+    """ Return the path to the catalog file for `root_dir`
+
+    Parameters
+    ----------
+    root_dir : str
+        Root path to where PyLag output files are stored.
+    """
+    return f'{root_dir}/{catalog_file_name}'
+
+
+def round_datetime(date, rounding):
+    """ Round `date` to the nearest multiple of `rounding` seconds
+
+    This mirrors the rounding applied by PyLag's `Viewer` when it is
+    given the argument `time_rounding`.
+    """
+    seconds = (date - _epoch).total_seconds()
+    seconds = round(seconds / rounding) * rounding
+    return _epoch + datetime.timedelta(seconds=seconds)
+
+
+def read_release_record(file_path, emitter, release_date, n_particles_prz,
+                        time_rounding=3600):
+    """ Read catalog information from a single PyLag output file
+
+    Only the particles dimension and the first two time points are read.
+
+    Parameters
+    ----------
+    file_path : str
+        Path to the PyLag output file.
+
+    emitter : str
+        The name of the emitting country.
+
+    release_date : datetime.datetime
+        The date on which particles were released.
+
+    n_particles_prz : int
+        The number of particles released per release zone.
+
+    time_rounding : int, optional
+        Period in seconds to which dates are rounded. Default: 3600.
+
+    Returns
+    -------
+     : ReleaseRecord
+        The catalog record.
+    """
+    with Dataset(file_path, 'r') as ds:
+        n_particles = ds.dimensions['particles'].size
+        n_times = ds.dimensions['time'].size
+
+        time_var = ds.variables['time']
+        calendar = getattr(time_var, 'calendar', 'standard')
+        times = time_var[:min(n_times, 2)]
+        dates = num2date(times, units=time_var.units, calendar=calendar,
+                         only_use_cftime_datetimes=False,
+                         only_use_python_datetimes=True)
+        dates = [round_datetime(date, time_rounding) for date in dates]
+
+    if n_particles % n_particles_prz != 0:
+        raise RuntimeError(f'The number of particles in {file_path} '
+                           f'({n_particles}) is not a multiple of the number '
+                           f'of particles per release zone '
+                           f'({n_particles_prz}).')
+
+    time_step = (dates[1] - dates[0]).total_seconds() if n_times > 1 else 0.0
+
+    stat = os.stat(file_path)
+
+    return ReleaseRecord(path=file_path,
+                         emitter=emitter,
+                         release_date=release_date,
+                         n_particles=n_particles,
+                         n_groups=n_particles // n_particles_prz,
+                         n_times=n_times,
+                         time_origin=dates[0],
+                         time_step=time_step,
+                         file_size=stat.st_size,
+                         file_mtime=stat.st_mtime)
+
+
+def find_pylag_output_files(root_dir, file_name='pylag_1.nc'):
+    """ Find all PyLag output files beneath `root_dir`
+
+    Parameters
+    ----------
+    root_dir : str
+        Root path to where PyLag output files are stored.
+
+    file_name : str, optional
+        The name of the output file in each run directory.
+
+    Returns
+    -------
+     : list
+        List of tuples (path, emitter, year, month).
+    """
+    pattern = f'{root_dir}/*/[0-9][0-9][0-9][0-9]/[0-9][0-9]/output/{file_name}'
+
+    files = []
+    for path in sorted(glob.glob(pattern)):
+        parts = os.path.normpath(path).split(os.sep)
+        emitter, year, month = parts[-5], int(parts[-4]), int(parts[-3])
+        files.append((path, emitter, year, month))
+
+    return files
+
+
+def build_catalog(root_dir, n_particles_prz, catalog_file=None,
+                  release_day=1, release_hour=12, time_rounding=3600):
+    """ Scan the simulations tree and (re)build the catalog
+
+    Files that are already in the catalog and whose size and modification
+    time have not changed are not reopened, so the catalog can be cheaply
+    updated as new runs complete.
+
+    Parameters
+    ----------
+    root_dir : str
+        Root path to where PyLag output files are stored.
+
+    n_particles_prz : int
+        The number of particles released per release zone.
+
+    catalog_file : str, optional
+        Path to the catalog file. Default: `root_dir`/simulation_catalog.db.
+
+    release_day : int, optional
+        Day of the month on which particles were released. Default: 1.
+
+    release_hour : int, optional
+        Hour of the day at which particles were released. Default: 12.
+
+    time_rounding : int, optional
+        Period in seconds to which dates are rounded. Default: 3600.
+
+    Returns
+    -------
+     : int
+        The number of records that were added or updated.
+    """
+    if catalog_file is None:
+        catalog_file = get_catalog_file_name(root_dir)
+
+    connection = sqlite3.connect(catalog_file)
+    try:
+        connection.executescript(_schema)
+
+        known = {row[0]: (row[1], row[2]) for row in connection.execute(
+            'SELECT path, file_size, file_mtime FROM releases')}
+
+        n_updated = 0
+        found = set()
+        for path, emitter, year, month in find_pylag_output_files(root_dir):
+            found.add(path)
+
+            stat = os.stat(path)
+            if known.get(path) == (stat.st_size, stat.st_mtime):
+                continue
+
+            print(f'Cataloging {path}')
+            release_date = datetime.datetime(year, month, release_day,
+                                             release_hour)
+            record = read_release_record(path, emitter, release_date,
+                                         n_particles_prz, time_rounding)
+
+            connection.execute(
+                'INSERT OR REPLACE INTO releases VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (record.path, record.emitter,
+                 record.release_date.isoformat(), record.n_particles,
+                 record.n_groups, record.n_times,
+                 record.time_origin.isoformat(), record.time_step,
+                 record.file_size, record.file_mtime))
+            n_updated += 1
+
+        # Drop records for files that no longer exist
+        for path in set(known.keys()) - found:
+            connection.execute('DELETE FROM releases WHERE path = ?', (path,))
+            connection.execute('DELETE FROM caches WHERE path = ?', (path,))
+
+        connection.commit()
+    finally:
+        connection.close()
+
+    return n_updated
+
+
+def register_cache(catalog_file, record, var_name, cache_path):
+    """ Record that `var_name` in a release has been cached
+
+    The size and modification time of the source file are saved with the
+    entry. If the source file changes, and the catalog is rebuilt, the
+    cache is no longer considered fresh.
+
+    Parameters
+    ----------
+    catalog_file : str
+        Path to the catalog file.
+
+    record : ReleaseRecord
+        The catalog record for the source file.
+
+    var_name : str
+        The name of the cached variable.
+
+    cache_path : str
+        Path to the cache file.
+    """
+    connection = sqlite3.connect(catalog_file)
+    try:
+        connection.executescript(_schema)
+        connection.execute('INSERT OR REPLACE INTO caches VALUES '
+                           '(?, ?, ?, ?, ?)',
+                           (record.path, var_name, cache_path,
+                            record.file_size, record.file_mtime))
+        connection.commit()
+    finally:
+        connection.close()
+
+
+class SimulationCatalog(object):
+    """ Read-only view of a simulation catalog
+
+    All records are loaded into memory when the catalog is opened, so
+    lookups are dictionary accesses and simple arithmetic.
+
+    Parameters
+    ----------
+    catalog_file : str
+        Path to the catalog file.
+    """
+
+    def __init__(self, catalog_file):
+        if not os.path.isfile(catalog_file):
+            raise RuntimeError(f'Catalog file {catalog_file} does not exist')
+
+        self.catalog_file = catalog_file
+
+        connection = sqlite3.connect(catalog_file)
+        try:
+            connection.executescript(_schema)
+            rows = connection.execute(
+                'SELECT path, emitter, release_date, n_particles, n_groups, '
+                'n_times, time_origin, time_step, file_size, file_mtime '
+                'FROM releases ORDER BY emitter, release_date').fetchall()
+            cache_rows = connection.execute(
+                'SELECT path, var_name, cache_path, source_size, source_mtime '
+                'FROM caches').fetchall()
+        finally:
+            connection.close()
+
+        # Cache entries, keyed on (path, var_name)
+        self._caches = {(row[0], row[1]): (row[2], row[3], row[4])
+                        for row in cache_rows}
+
+        self._records = {}
+        self._releases_by_emitter = {}
+        for row in rows:
+            record = ReleaseRecord(path=row[0],
+                                   emitter=row[1],
+                                   release_date=datetime.datetime.fromisoformat(row[2]),
+                                   n_particles=row[3],
+                                   n_groups=row[4],
+                                   n_times=row[5],
+                                   time_origin=datetime.datetime.fromisoformat(row[6]),
+                                   time_step=row[7],
+                                   file_size=row[8],
+                                   file_mtime=row[9])
+            self._records[record.path] = record
+            self._releases_by_emitter.setdefault(record.emitter, []).append(record)
+
+    def __contains__(self, file_path):
+        return file_path in self._records
+
+    def __getitem__(self, file_path):
+        return self._records[file_path]
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def __len__(self):
+        return len(self._records)
+
+    def get_releases(self, emitter, emissions_start_date, current_date):
+        """ Return records for releases made between the two dates
+
+        This is the catalog equivalent of `utils.get_pylag_file_list`.
+
+        Parameters
+        ----------
+        emitter : str
+            The name of the emitting country.
+
+        emissions_start_date : datetime.datetime
+            The date on which plastic emissions started.
+
+        current_date : datetime.datetime
+            The current date.
+
+        Returns
+        -------
+         : list
+            List of ReleaseRecords, sorted by release date.
+        """
+        assert current_date >= emissions_start_date, \
+            'The current date precedes the emissions start date'
+
+        return [record for record in self._releases_by_emitter.get(emitter, [])
+                if emissions_start_date <= record.release_date <= current_date]
+
+    def get_time_index(self, file_path, date):
+        """ Return the time index corresponding to `date`
+
+        Parameters
+        ----------
+        file_path : str
+            Path to the PyLag output file.
+
+        date : datetime.datetime
+            The date to look up.
+
+        Returns
+        -------
+         : int
+            The time index.
+
+        Raises
+        ------
+        ValueError
+            If `date` is not one of the output dates.
+        """
+        record = self._records[file_path]
+
+        offset = (date - record.time_origin).total_seconds()
+        if record.time_step > 0.0:
+            tidx, remainder = divmod(offset, record.time_step)
+        else:
+            tidx, remainder = offset, offset
+
+        if remainder != 0.0 or tidx < 0 or tidx >= record.n_times:
+            raise ValueError(f'{date} is not an output date in {file_path}')
+
+        return int(tidx)
+
+    def get_cache_path(self, file_path, var_name):
+        """ Return the path to a fresh cache of `var_name`, if there is one
+
+        A cache is fresh if it was made from a source file with the same size
+        and modification time as the one in the catalog and the one currently
+        on disk, and if the cache file still exists. The source file is
+        checked on disk so that a run which has been rewritten since the
+        catalog was built falls back to being read from netCDF.
+
+        Parameters
+        ----------
+        file_path : str
+            Path to the PyLag output file.
+
+        var_name : str
+            The name of the variable.
+
+        Returns
+        -------
+         : str or None
+            Path to the cache file, or None if there is no fresh cache.
+        """
+        entry = self._caches.get((file_path, var_name))
+        if entry is None or file_path not in self._records:
+            return None
+
+        cache_path, source_size, source_mtime = entry
+        record = self._records[file_path]
+        if (source_size, source_mtime) != (record.file_size, record.file_mtime):
+            return None
+
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            return None
+
+        if (source_size, source_mtime) != (stat.st_size, stat.st_mtime):
+            return None
+
+        if not os.path.isfile(cache_path):
+            return None
+
+        return cache_path
+
+    def get_dates(self, file_path, time_indices=None):
+        """ Return the dates corresponding to `time_indices`
+
+        Parameters
+        ----------
+        file_path : str
+            Path to the PyLag output file.
+
+        time_indices : iterable of int, optional
+            The time indices. Default: all time indices.
+
+        Returns
+        -------
+         : list
+            List of datetime.datetime objects.
+        """
+        record = self._records[file_path]
+
+        if time_indices is None:
+            time_indices = range(record.n_times)
+
+        return [record.time_origin +
+                datetime.timedelta(seconds=int(tidx) * record.time_step)
+                for tidx in time_indices]
+
+
+def open_catalog(root_dir):
+    """ Open the catalog for `root_dir` if it exists
+
+    Parameters
+    ----------
+    root_dir : str
+        Root path to where PyLag output files are stored.
+
+    Returns
+    -------
+     : SimulationCatalog or None
+        The catalog, or None if a catalog has not been built.
+    """
+    catalog_file = get_catalog_file_name(root_dir)
+    if os.path.isfile(catalog_file):
+        return SimulationCatalog(catalog_file)
+
+    return None
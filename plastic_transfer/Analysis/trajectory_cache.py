@@ -0,0 +1,177 @@
+""" Memory-mapped cache of PyLag trajectory variables
+
+PyLag output variables are zlib compressed, so every read of a time slice
+of `host_arakawa_a` pays the cost of HDF5 decompression. As the same runs
+are analysed many times, variables can instead be extracted once into
+uncompressed, time-major `.npy` files which are subsequently read through
+memory maps. Reading a time slice from the cache is then a view onto
+the page cache rather than a decompression.
+
+Caches are written to a `cache` directory next to the PyLag output file,
+and are registered in the simulation catalog (see `simulation_catalog.py`),
+which is used to check that a cache is still fresh before it is used.
+"""
+import os
+
+import numpy as np
+from netCDF4 import Dataset
+
+from pylag.processing.ncview import Viewer
+
+from simulation_catalog import register_cache
+
+
+# Data types used when caching variables. Host elements are saved as int32,
+# which is the type expected by the Cython helpers.
+cache_dtypes = {'host_arakawa_a': np.int32,
+                'longitude': np.float32,
+                'latitude': np.float32}
+
+
+def get_cache_path(file_path, var_name):
+    """ Return the path to the cache file for `var_name`
+
+    Parameters
+    ----------
+    file_path : str
+        Path to the PyLag output file.
+
+    var_name : str
+        The name of the variable.
+    """
+    return f'{os.path.dirname(file_path)}/cache/{var_name}.npy'
+
+
+def cache_variable(file_path, var_name, time_block_size=100):
+    """ Extract a variable from a PyLag output file into a `.npy` file
+
+    Data are copied across in blocks of time points, so the full variable
+    is never held in memory. The cache is written to a temporary file which
+    is renamed once complete, so readers never see a partial cache.
+
+    Parameters
+    ----------
+    file_path : str
+        Path to the PyLag output file.
+
+    var_name : str
+        The name of the variable to cache.
+
+    time_block_size : int, optional
+        The number of time points to copy at once. Default: 100.
+
+    Returns
+    -------
+     : str
+        Path to the cache file.
+    """
+    cache_path = get_cache_path(file_path, var_name)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_cache_path = f'{cache_path}.tmp.npy'
+
+    dtype = cache_dtypes.get(var_name, None)
+
+    with Dataset(file_path, 'r') as ds:
+        var = ds.variables[var_name]
+        var.set_auto_mask(False)
+
+        if var.dimensions != ('time', 'particles'):
+            raise RuntimeError(f'Variable {var_name} in {file_path} does not '
+                               f'have dimensions (time, particles).')
+
+        if dtype is None:
+            dtype = var.dtype
+
+        cache = np.lib.format.open_memmap(tmp_cache_path, mode='w+',
+                                          dtype=dtype, shape=var.shape)
+
+        n_times = var.shape[0]
+        for t_start in range(0, n_times, time_block_size):
+            t_end = min(t_start + time_block_size, n_times)
+            cache[t_start:t_end, :] = var[t_start:t_end, :]
+
+        cache.flush()
+        del cache
+
+    os.replace(tmp_cache_path, cache_path)
+
+    return cache_path
+
+
+def cache_release(catalog, file_path, var_names=('host_arakawa_a',),
+                  time_block_size=100):
+    """ Cache variables for a single release and register them in `catalog`
+
+    Variables with a fresh cache are skipped.
+
+    Parameters
+    ----------
+    catalog : simulation_catalog.SimulationCatalog
+        The simulation catalog.
+
+    file_path : str
+        Path to the PyLag output file.
+
+    var_names : tuple, optional
+        The variables to cache. Default: ('host_arakawa_a',).
+
+    time_block_size : int, optional
+        The number of time points to copy at once. Default: 100.
+
+    Returns
+    -------
+     : list
+        The names of the variables that were cached.
+    """
+    record = catalog[file_path]
+
+    cached = []
+    for var_name in var_names:
+        if catalog.get_cache_path(file_path, var_name) is not None:
+            continue
+
+        print(f'Caching {var_name} from {file_path}')
+        cache_path = cache_variable(file_path, var_name, time_block_size)
+        register_cache(catalog.catalog_file, record, var_name, cache_path)
+        cached.append(var_name)
+
+    return cached
+
+
+def open_variable(file_path, var_name, catalog=None, pylag_viewer=None):
+    """ Open a trajectory variable for reading
+
+    If `catalog` holds a fresh cache of the variable, a read-only memory map
+    onto the cache is returned. Otherwise, the variable is read from the
+    PyLag output file. In both cases, time slices can be read by indexing
+    the returned object with the time index.
+
+    Parameters
+    ----------
+    file_path : str
+        Path to the PyLag output file.
+
+    var_name : str
+        The name of the variable.
+
+    catalog : simulation_catalog.SimulationCatalog, optional
+        The simulation catalog. Default: None.
+
+    pylag_viewer : pylag.processing.ncview.Viewer, optional
+        An existing viewer for `file_path`, which is used if there is no
+        cache. Default: None.
+
+    Returns
+    -------
+     : numpy.memmap or netCDF4.Variable
+        The variable.
+    """
+    if catalog is not None:
+        cache_path = catalog.get_cache_path(file_path, var_name)
+        if cache_path is not None:
+            return np.load(cache_path, mmap_mode='r')
+
+    if pylag_viewer is None:
+        pylag_viewer = Viewer(file_path, time_rounding=3600)
+
+    return pylag_viewer(var_name)
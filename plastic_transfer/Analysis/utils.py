@@ -1,6 +1,18 @@
+import os
 import datetime
 import numpy as np
 import pandas
+from netCDF4 import Dataset
+
+try:
+    from global_land_mask import globe
+except ImportError:
+    globe = None
+
+from zarr_store import ConnectivityReader, get_connectivity_var_name
+from shared import connectivity_netcdf_names, earth_radius
+from weights_store import open_weights_store, get_weights_file_path
+from weights_store import get_decay_coefficients_file_path
 
 
 def generate_grid(spacing, use_global_land_mask=True):
@@ -10,7 +22,29 @@ def generate_grid(spacing, use_global_land_mask=True):
     ----------
     spacing : float
         The spacing between grid points in decimal degress.
+
+    use_global_land_mask : bool, optional
+        If True, compute a land mask using the `global_land_mask` package.
+        Default: True.
+
+    Returns
+    -------
+    lons_grid, lats_grid : 1D NumPy arrays
+        Longitudes and latitudes of cell centres.
+
+    lon_bin_edges, lat_bin_edges : 1D NumPy arrays
+        Longitudes and latitudes of cell edges.
+
+    mask : 2D NumPy array or None
+        True for cells whose centres lie on land, with dimensions
+        (latitude, longitude), or None if `use_global_land_mask` is False.
+
+    areas : 2D NumPy array
+        Cell areas (m^2), with dimensions (latitude, longitude).
     """
+    if use_global_land_mask and globe is None:
+        raise ImportError('The land mask requires the global_land_mask '
+                          'package, which could not be imported.')
 
     # Set parameters for the grid edges
     n_lons = int(360./spacing)
@@ -30,14 +64,13 @@ def generate_grid(spacing, use_global_land_mask=True):
                                                      np.sin(lat_bin_edges_r[:-1]))
 
     # Create grid of cell centres
-    lons_grid = lon_bin_edges[:-1] + 0.5*grid_spacing
-    lats_grid = lat_bin_edges[:-1] + 0.5*grid_spacing
+    lons_grid = lon_bin_edges[:-1] + 0.5*spacing
+    lats_grid = lat_bin_edges[:-1] + 0.5*spacing
 
     # Compute mask
-    lats2D, lons2D = np.meshgrid(lats_grid, lons_grid, indexing='ij')
-    is_on_land = globe.is_land(lats2D.flatten(), lons2D.flatten())
-
     if use_global_land_mask:
+        lats2D, lons2D = np.meshgrid(lats_grid, lons_grid, indexing='ij')
+        is_on_land = globe.is_land(lats2D.flatten(), lons2D.flatten())
         mask = is_on_land.reshape(lats2D.shape)
     else:
         mask = None
@@ -48,6 +81,96 @@ def generate_grid(spacing, use_global_land_mask=True):
     return lons_grid, lats_grid, lon_bin_edges, lat_bin_edges, mask, areas
 
 
+def get_grid_cell_indices(lons, lats, lon_bin_edges, lat_bin_edges):
+    """ Return the index of the grid cell each point lies in
+
+    As the grid is regular, cells are computed directly from positions.
+    Cells are numbered in row-major order, i.e. the cell with latitude
+    index `j` and longitude index `i` has index `j * n_lons + i`.
+
+    Parameters
+    ----------
+    lons, lats : 1D NumPy arrays
+        Longitudes and latitudes.
+
+    lon_bin_edges, lat_bin_edges : 1D NumPy arrays
+        Evenly spaced cell edges, as returned by `generate_grid`.
+
+    Returns
+    -------
+     : 1D NumPy array
+        Cell indices, as int64. Points with non-finite positions or that
+        lie outside the grid are given the index -1.
+    """
+    n_lons = lon_bin_edges.shape[0] - 1
+    n_lats = lat_bin_edges.shape[0] - 1
+    lon_spacing = (lon_bin_edges[-1] - lon_bin_edges[0]) / n_lons
+    lat_spacing = (lat_bin_edges[-1] - lat_bin_edges[0]) / n_lats
+
+    lon_indices = np.floor((lons - lon_bin_edges[0]) / lon_spacing)
+    lat_indices = np.floor((lats - lat_bin_edges[0]) / lat_spacing)
+
+    # Points on the last edge belong to the last cell
+    lon_indices[lons == lon_bin_edges[-1]] = n_lons - 1
+    lat_indices[lats == lat_bin_edges[-1]] = n_lats - 1
+
+    valid = (lon_indices >= 0) & (lon_indices < n_lons) & \
+            (lat_indices >= 0) & (lat_indices < n_lats)
+
+    cell_indices = np.full(lons.shape, -1, dtype=np.int64)
+    cell_indices[valid] = lat_indices[valid].astype(np.int64) * n_lons + \
+        lon_indices[valid].astype(np.int64)
+
+    return cell_indices
+
+
+def grid_masses(lons, lats, masses, lon_bin_edges, lat_bin_edges, out=None):
+    """ Sum particle masses within the cells of a regular lat/lon grid
+
+    This is a weighted 2D histogram. The cell each particle lies in is
+    computed directly from its position (see `get_grid_cell_indices`), and
+    masses are summed with a single `np.bincount` call, which is much faster
+    than `np.histogram2d`. Particles with non-finite positions or that lie
+    outside the grid are ignored.
+
+    Parameters
+    ----------
+    lons, lats : 1D NumPy arrays
+        Particle longitudes and latitudes.
+
+    masses : 1D NumPy array
+        Particle masses.
+
+    lon_bin_edges, lat_bin_edges : 1D NumPy arrays
+        Evenly spaced cell edges, as returned by `generate_grid`.
+
+    out : 2D NumPy array, optional
+        Array to which masses are added, with dimensions (latitude,
+        longitude). Default: None, meaning a new array is returned.
+
+    Returns
+    -------
+     : 2D NumPy array
+        Summed masses with dimensions (latitude, longitude).
+    """
+    n_lons = lon_bin_edges.shape[0] - 1
+    n_lats = lat_bin_edges.shape[0] - 1
+
+    cell_indices = get_grid_cell_indices(lons, lats, lon_bin_edges,
+                                         lat_bin_edges)
+    valid = cell_indices >= 0
+
+    gridded = np.bincount(cell_indices[valid], weights=masses[valid],
+                          minlength=n_lats * n_lons).reshape(n_lats, n_lons)
+
+    if out is None:
+        return gridded
+
+    out += gridded
+
+    return out
+
+
 def get_pylag_file_list(pylag_root_dir, emissions_start_date, current_date,
                         emitting_country, release_day=1, release_hour=12):
     """ Return a list of PyLag output files
@@ -115,6 +238,60 @@ def get_pylag_file_list(pylag_root_dir, emissions_start_date, current_date,
     return file_paths
 
 
+def get_release_file_list(pylag_root_dir, emissions_start_date, current_date,
+                          emitting_country, catalog=None):
+    """ Return a list of PyLag output files, checked against the catalog
+
+    Files are listed with `get_pylag_file_list`. If a simulation catalog is
+    given, the releases it holds for the same period must match, so that
+    runs completed after the catalog was last built are not silently left
+    out.
+
+    Parameters
+    ----------
+    pylag_root_dir : str
+        Root path to where PyLag output files are stored
+
+    emissions_start_date : datetime.datetime
+        The date on which plastic emissions started.
+
+    current_date : datetime.datetime
+        The current date.
+
+    emitting_country : str
+        The name of the emitting country.
+
+    catalog : simulation_catalog.SimulationCatalog, optional
+        The simulation catalog. Default: None.
+
+    Raises
+    ------
+    RuntimeError
+        If the files listed in the catalog differ from those expected.
+    """
+    file_paths = get_pylag_file_list(pylag_root_dir, emissions_start_date,
+                                     current_date, emitting_country)
+    if catalog is None:
+        return file_paths
+
+    catalog_paths = [release.path for release in
+                     catalog.get_releases(emitting_country,
+                                          emissions_start_date, current_date)]
+
+    expected = set(os.path.normpath(path) for path in file_paths)
+    found = set(os.path.normpath(path) for path in catalog_paths)
+    if expected != found:
+        missing = sorted(expected - found)
+        unexpected = sorted(found - expected)
+        raise RuntimeError(f'The simulation catalog for {pylag_root_dir} is out '
+                           f'of date for {emitting_country} releases up to '
+                           f'{current_date}. Missing: {missing}. Unexpected: '
+                           f'{unexpected}. Rebuild it with '
+                           f'build_simulation_catalog.py.')
+
+    return file_paths
+
+
 def get_connectivity_file_list(connectivity_root_dir, emissions_start_date,
                                current_date, emitting_country, release_day=1,
                                release_hour=12):
@@ -188,23 +365,143 @@ def get_connectivity_file_list(connectivity_root_dir, emissions_start_date,
     return file_paths
 
 
-def get_weights(n_particles_prz, na_countries):
-    # Directory for particle weights
-    weights_dir = (f'../Derived_data/particle_weights/'
-                   f'{n_particles_prz}_particles/monthly')
+def open_connectivity_release(connectivity_root_dir, emitting_country,
+                              release_date, input_format='netcdf'):
+    """ Open the connectivity data for one release
+
+    Parameters
+    ----------
+    connectivity_root_dir : str
+        Root path to where connectivity data are stored.
+
+    emitting_country : str
+        The name of the emitting country.
+
+    release_date : datetime.datetime
+        The date of the release.
+
+    input_format : str, optional
+        The format of the connectivity data (netcdf or zarr). Default:
+        'netcdf'.
+
+    Returns
+    -------
+    None if there are no connectivity data for the release. Otherwise, a
+    tuple of:
+
+    get_flags : callable
+        Function returning the flags variable for a receiving region,
+        or None if the region has not been processed.
+
+    time_days : 1D NumPy array
+        Time since the release of each time point in days.
+
+    close : callable
+        Function that closes the data source.
+    """
+    if input_format == 'zarr':
+        store_path = f'{connectivity_root_dir}/zarr/{emitting_country}_connectivity.zarr'
+        if not os.path.isdir(store_path):
+            return None
+
+        all_regions = list(connectivity_netcdf_names.keys())
+        reader = ConnectivityReader(store_path, all_regions[0])
+        if release_date not in reader.release_dates or \
+                'complete' not in reader.group:
+            return None
+        release_idx = reader.release_dates.index(release_date)
+        complete = reader.group['complete'][release_idx, :]
+
+        def get_flags(region):
+            if not complete[all_regions.index(region)]:
+                return None
+            return ConnectivityReader(store_path, region).get_release(release_date)
+
+        # Time in seconds since 1990-01-01 00:00:00, NaN after the end of a run
+        times = reader.group['time'][release_idx, :]
+        times = times[~np.isnan(times)]
+        if times.shape[0] == 0:
+            return None
+
+        def close():
+            pass
+    else:
+        year_str = f'{release_date.year}'
+        month_str = f'{release_date.month:02}'
+        file_name = (f'{connectivity_root_dir}/{year_str}/{month_str}/'
+                     f'{emitting_country}_connectivity_{year_str}_{month_str}.nc')
+        if not os.path.isfile(file_name):
+            return None
+
+        ds = Dataset(file_name, 'r')
+
+        def get_flags(region):
+            var_name = get_connectivity_var_name(region)
+            if var_name not in ds.variables:
+                return None
+            var = ds.variables[var_name]
+            if getattr(var, 'status', '') == 'incomplete':
+                return None
+            var.set_auto_mask(False)
+            return var
+
+        # Time in seconds since 1990-01-01 00:00:00
+        times = np.asarray(ds.variables['time'][:], dtype=np.float64)
+
+        def close():
+            ds.close()
+
+    time_days = (times - times[0]) / 86400.
+
+    return get_flags, time_days, close
+
+
+def get_weights(n_particles_prz, na_countries, read_decay_coefs=True,
+                use_store=True):
+    """ Read particle weights and, optionally, weights decay coefficients
+
+    If a binary weights store has been built (see `weights_store.py`) and
+    holds all of the requested emitters, weights and decay coefficients are
+    read from it through a memory map. Otherwise, or if any of the CSV and
+    pickle files have changed since the store was built, they are read from
+    the CSV and pickle files.
+
+    Decay coefficients are those written by
+    `create_weights_decay_coefficients_file.py`. If `read_decay_coefs` is
+    False, None is returned in their place; scripts that evaluate decay
+    coefficients with `decay_models.py` do not need the table.
+    """
+    if use_store:
+        store = open_weights_store(n_particles_prz)
+        if store is not None and all(emitting_country in store.emitters
+                                     for emitting_country in na_countries):
+            stale_sources = store.get_stale_sources(na_countries,
+                                                    read_decay_coefs)
+            if not stale_sources:
+                weights = {emitting_country:
+                           store.get_weights(emitting_country)
+                           for emitting_country in na_countries}
+
+                if not read_decay_coefs:
+                    return weights, None
+
+                return weights, store.get_decay_coefficients_table()
+
+            print(f'Weights store {store.file_name} is out of date, so '
+                  f'weights are read from the CSV and pickle files. Changed: '
+                  f'{stale_sources}. Rerun build_weights_store.py.')
 
     weights = {}
     for emitting_country in na_countries:
         # Read in weights for the emitting country
-        weights_file = (f'{weights_dir}/'
-                        f'monthly_particle_weights_{emitting_country}.csv')
+        weights_file = get_weights_file_path(n_particles_prz, emitting_country)
         weights[emitting_country] = np.fromfile(weights_file, sep=',')
 
+    if not read_decay_coefs:
+        return weights, None
+
     # Read in weights decay coefficients
-    weights_decay_coef_file_dir = (f'../Derived_data/particle_weights'
-                                   f'/{n_particles_prz}_particles')
-    weights_decay_coef_file = (f'{weights_decay_coef_file_dir}'
-                               f'/weights_decay_coefficients_per_day.pkl')
+    weights_decay_coef_file = get_decay_coefficients_file_path(n_particles_prz)
 
     weights_decay_coefs = \
         pandas.read_pickle(weights_decay_coef_file).set_index('Day number')
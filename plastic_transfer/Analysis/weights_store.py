@@ -0,0 +1,386 @@
+""" Binary store of particle weights
+
+`utils.get_weights` originally parsed one text CSV file per emitting country
+and unpickled the table of decay coefficients every time it was called. This
+module compiles all of these into a single binary file per particle
+configuration (i.e. number of particles per release zone), which is opened
+through a memory map. Opening the store only reads a small header.
+
+File layout
+-----------
+The file begins with an 8 byte magic string, followed by the length of a
+JSON header as a little-endian uint64 and then the header itself. The header
+gives the format version, the emitting countries and the number of release
+zones (groups) in each of their releases, and the dtype, shape and offset of
+each array. It also holds a CRC32 checksum of the data section, and the size
+and modification time of the CSV and pickle files each array was built from,
+which are used to detect a store that is out of date. Arrays follow the
+header, each aligned to 64 bytes. The arrays are:
+
+* `weights/<emitter>` - weight of each particle (tonnes), float64.
+* `decay_rates` - decay rate of each decay class (day^-1), float64.
+* `day_numbers` - day numbers of the decay coefficients table, int32.
+* `decay_coefficients` - decay coefficients with dimensions (day, class),
+  float64.
+
+Particle `i` belongs to decay class `i % n_particles_prz`.
+"""
+import os
+import json
+import zlib
+import functools
+
+import numpy as np
+import pandas
+
+
+# Magic string identifying weights store files
+magic = b'PTWGHTS\x00'
+
+# Format version
+version = 2
+
+# Alignment of arrays within the file, in bytes
+alignment = 64
+
+
+def get_weights_store_path(n_particles_prz):
+    """ Return the path to the weights store for a particle configuration
+    """
+    return (f'../Derived_data/particle_weights/{n_particles_prz}_particles/'
+            f'particle_weights.bin')
+
+
+def get_weights_file_path(n_particles_prz, emitter):
+    """ Return the path to the particle weights CSV file for `emitter`
+    """
+    return (f'../Derived_data/particle_weights/{n_particles_prz}_particles/'
+            f'monthly/monthly_particle_weights_{emitter}.csv')
+
+
+def get_decay_coefficients_file_path(n_particles_prz):
+    """ Return the path to the weights decay coefficients pickle file
+    """
+    return (f'../Derived_data/particle_weights/{n_particles_prz}_particles/'
+            f'weights_decay_coefficients_per_day.pkl')
+
+
+def get_source_paths(n_particles_prz, emitters, read_decay_coefs=True):
+    """ Return the source file of each array in the store
+
+    Parameters
+    ----------
+    n_particles_prz : int
+        The number of particles released per release zone.
+
+    emitters : list
+        The emitting countries.
+
+    read_decay_coefs : bool, optional
+        If True, include the decay coefficients file. Default: True.
+
+    Returns
+    -------
+     : dict
+        Paths to the source files, keyed by array name.
+    """
+    source_paths = {f'weights/{emitter}':
+                    get_weights_file_path(n_particles_prz, emitter)
+                    for emitter in emitters}
+
+    if read_decay_coefs:
+        source_paths['decay_coefficients'] = \
+            get_decay_coefficients_file_path(n_particles_prz)
+
+    return source_paths
+
+
+def stat_sources(source_paths):
+    """ Return the size and modification time of each source file
+
+    Parameters
+    ----------
+    source_paths : dict
+        Paths to the source files, keyed by array name.
+
+    Returns
+    -------
+     : dict
+        The size (bytes) and modification time of each file, keyed by array
+        name. Files that do not exist are given as None.
+    """
+    sources = {}
+    for name, path in source_paths.items():
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            sources[name] = None
+            continue
+        sources[name] = {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    return sources
+
+
+def _align(offset):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def _compute_checksum(data):
+    checksum = 0
+    block_size = 64 * 1024**2
+    for start in range(0, data.shape[0], block_size):
+        checksum = zlib.crc32(data[start:start + block_size], checksum)
+    return checksum
+
+
+def write_weights_store(file_name, n_particles_prz, weights, day_numbers,
+                        decay_coefficients, sources=None):
+    """ Write a weights store
+
+    Parameters
+    ----------
+    file_name : str
+        Path to the store.
+
+    n_particles_prz : int
+        The number of particles released per release zone.
+
+    weights : dict
+        Particle weights for each emitting country.
+
+    day_numbers : 1D NumPy array
+        Day numbers of the decay coefficients table.
+
+    decay_coefficients : 2D NumPy array
+        Decay coefficients with dimensions (day, class).
+
+    sources : dict, optional
+        The size and modification time of the file each array was built
+        from, as returned by `stat_sources`. Default: None.
+    """
+    day_numbers = np.asarray(day_numbers, dtype=np.int32)
+    decay_coefficients = np.ascontiguousarray(decay_coefficients,
+                                              dtype=np.float64)
+
+    # Decay rates, assuming exponential decay
+    decay_rates = np.log(decay_coefficients[0, :] / decay_coefficients[1, :]) / \
+        float(day_numbers[1] - day_numbers[0])
+
+    arrays = {}
+    emitters = {}
+    for emitter, emitter_weights in weights.items():
+        emitter_weights = np.ascontiguousarray(emitter_weights, dtype=np.float64)
+        if emitter_weights.shape[0] % n_particles_prz != 0:
+            raise ValueError(f'The number of weights for {emitter} is not a '
+                             f'multiple of {n_particles_prz}')
+        arrays[f'weights/{emitter}'] = emitter_weights
+        emitters[emitter] = {'n_groups': emitter_weights.shape[0] // n_particles_prz}
+
+    arrays['decay_rates'] = decay_rates
+    arrays['day_numbers'] = day_numbers
+    arrays['decay_coefficients'] = decay_coefficients
+
+    # Lay out arrays within the data section
+    array_info = {}
+    offset = 0
+    for name, array in arrays.items():
+        offset = _align(offset)
+        array_info[name] = {'offset': offset,
+                            'dtype': array.dtype.str,
+                            'shape': list(array.shape)}
+        offset += array.nbytes
+    data_size = _align(offset)
+
+    data = np.zeros(data_size, dtype=np.uint8)
+    for name, array in arrays.items():
+        start = array_info[name]['offset']
+        data[start:start + array.nbytes] = array.reshape(-1).view(np.uint8)
+
+    header = {'version': version,
+              'n_particles_prz': n_particles_prz,
+              'emitters': emitters,
+              'arrays': array_info,
+              'data_size': data_size,
+              'checksum': _compute_checksum(data),
+              'sources': sources if sources is not None else {}}
+    header_bytes = json.dumps(header).encode('utf-8')
+
+    # Pad the header so the data section is aligned
+    header_size = len(magic) + 8 + len(header_bytes)
+    header_bytes += b' ' * (_align(header_size) - header_size)
+
+    tmp_file_name = f'{file_name}.tmp'
+    with open(tmp_file_name, 'wb') as f:
+        f.write(magic)
+        f.write(np.uint64(len(header_bytes)).astype('<u8').tobytes())
+        f.write(header_bytes)
+        f.write(data.tobytes())
+
+    os.replace(tmp_file_name, file_name)
+
+
+def convert_weights(n_particles_prz, emitters, file_name=None):
+    """ Build a weights store from the existing CSV and pickle files
+
+    Parameters
+    ----------
+    n_particles_prz : int
+        The number of particles released per release zone.
+
+    emitters : list
+        The emitting countries.
+
+    file_name : str, optional
+        Path to the store. Default: None, meaning the default path for the
+        particle configuration is used.
+
+    Returns
+    -------
+     : str
+        Path to the store.
+    """
+    # Imported here to avoid a circular import, as utils uses this module
+    from utils import get_weights
+
+    if file_name is None:
+        file_name = get_weights_store_path(n_particles_prz)
+
+    # Source files are checked before they are read, so a file modified
+    # while the store is being built leaves the store out of date
+    sources = stat_sources(get_source_paths(n_particles_prz, emitters))
+
+    weights, weights_decay_coefs = get_weights(n_particles_prz, emitters,
+                                               use_store=False)
+
+    write_weights_store(file_name, n_particles_prz, weights,
+                        weights_decay_coefs.index.values,
+                        weights_decay_coefs.values, sources=sources)
+
+    return file_name
+
+
+class WeightsStore(object):
+    """ Read-only view of a weights store
+
+    Arrays are memory mapped, so only the data that are used are read.
+
+    Parameters
+    ----------
+    file_name : str
+        Path to the store.
+
+    verify : bool, optional
+        If True, check the checksum of the data section. This reads the full
+        file. Default: False.
+    """
+
+    def __init__(self, file_name, verify=False):
+        self.file_name = file_name
+
+        with open(file_name, 'rb') as f:
+            if f.read(len(magic)) != magic:
+                raise RuntimeError(f'{file_name} is not a weights store')
+            header_size = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+            self.header = json.loads(f.read(header_size).decode('utf-8'))
+
+        if self.header['version'] != version:
+            raise RuntimeError(f'Weights store {file_name} has version '
+                               f'{self.header["version"]}, but version '
+                               f'{version} is required')
+
+        self.data = np.memmap(file_name, dtype=np.uint8, mode='r',
+                              offset=len(magic) + 8 + header_size,
+                              shape=(self.header['data_size'],))
+
+        if verify and _compute_checksum(self.data) != self.header['checksum']:
+            raise RuntimeError(f'Checksum mismatch in weights store {file_name}')
+
+        self.n_particles_prz = self.header['n_particles_prz']
+        self.emitters = list(self.header['emitters'].keys())
+
+    def get_stale_sources(self, emitters, read_decay_coefs=True):
+        """ Return the source files that have changed since the store was built
+
+        A source file has changed if its size or modification time differs
+        from that recorded in the store, or if it was not recorded.
+
+        Parameters
+        ----------
+        emitters : list
+            The emitting countries.
+
+        read_decay_coefs : bool, optional
+            If True, check the decay coefficients file. Default: True.
+
+        Returns
+        -------
+         : list
+            Paths to the changed source files.
+        """
+        source_paths = get_source_paths(self.n_particles_prz, emitters,
+                                        read_decay_coefs)
+        current = stat_sources(source_paths)
+        recorded = self.header['sources']
+
+        return [source_paths[name] for name in source_paths
+                if recorded.get(name) is None or
+                current[name] != recorded[name]]
+
+    def get_array(self, name):
+        """ Return a read-only view of the array `name`
+        """
+        info = self.header['arrays'][name]
+        dtype = np.dtype(info['dtype'])
+        n_bytes = int(np.prod(info['shape'])) * dtype.itemsize
+        start = info['offset']
+        return self.data[start:start + n_bytes].view(dtype).reshape(info['shape'])
+
+    def get_weights(self, emitter):
+        """ Return particle weights for `emitter`
+        """
+        return self.get_array(f'weights/{emitter}')
+
+    def get_n_groups(self, emitter):
+        """ Return the number of release zones (groups) for `emitter`
+        """
+        return self.header['emitters'][emitter]['n_groups']
+
+    def get_decay_classes(self, emitter):
+        """ Return the decay class of each particle released by `emitter`
+        """
+        return np.tile(np.arange(self.n_particles_prz, dtype=np.int16),
+                       self.get_n_groups(emitter))
+
+    @property
+    def decay_rates(self):
+        return self.get_array('decay_rates')
+
+    def get_decay_coefficients_table(self):
+        """ Return the decay coefficients as a table indexed by day number
+
+        The table has the same layout as the one returned by
+        `utils.get_weights`.
+        """
+        columns = [f'k{idx+1}' for idx in range(self.n_particles_prz)]
+        return pandas.DataFrame(self.get_array('decay_coefficients'),
+                                columns=columns,
+                                index=pandas.Index(self.get_array('day_numbers'),
+                                                   name='Day number'))
+
+
+@functools.lru_cache(maxsize=None)
+def open_weights_store(n_particles_prz):
+    """ Open the weights store for a particle configuration
+
+    Stores are cached, so repeated calls do not reread the header.
+
+    Returns
+    -------
+     : WeightsStore
+        The store, or None if it has not been built.
+    """
+    file_name = get_weights_store_path(n_particles_prz)
+    if not os.path.isfile(file_name):
+        return None
+
+    return WeightsStore(file_name)
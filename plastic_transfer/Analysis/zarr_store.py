@@ -0,0 +1,481 @@
+""" Zarr storage for connectivity and stock outputs
+
+An alternative to the netCDF outputs written by `compute_connectivity_metrics.py`
+and `compute_plastic_stock_in_eezs.py`. Rather than one file per job, all
+outputs are held in a small number of Zarr stores, which several jobs can
+write to at once provided they write to disjoint chunks.
+
+Connectivity stores
+-------------------
+There is one store per scenario and emitting country. Each receiving region
+has an array of flags with dimensions (release, time, particles), where the
+release dimension runs over all monthly releases. Chunks span a single
+release, so each job (which processes one release) writes to its own chunks.
+Within a release, chunks span a block of days and a block of particles, which
+keeps both daily snapshots and particle time series cheap to read. Times
+after the end of a run are filled with -1.
+
+Stock store
+-----------
+A single store holds daily stocks in an array with dimensions (year, month,
+day, receiving region, emitting country). Each chunk spans the days of one
+month for one receiving region, which is exactly what one stock job
+computes. Days that do not exist (e.g. 31 February) are NaN.
+
+Notes
+-----
+Zarr is an optional dependency; it is only needed if Zarr output is
+requested.
+"""
+import datetime
+from calendar import monthrange
+
+import numpy as np
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+from shared import na_countries, eez_names, connectivity_netcdf_names
+
+
+# Default chunk sizes along the time and particle dimensions of the
+# connectivity arrays
+connectivity_time_chunk_size = 32
+connectivity_particle_chunk_size = 8192
+
+# Fill value for times after the end of a run
+connectivity_fill_value = -1
+
+
+def _check_zarr():
+    if zarr is None:
+        raise ImportError('Zarr output requires the zarr package, which '
+                          'could not be imported.')
+
+
+def _require_array(group, name, shape, chunks, dtype, fill_value):
+    # `require_array` replaced `require_dataset` in zarr v3
+    require = getattr(group, 'require_array', None)
+    if require is None:
+        require = group.require_dataset
+
+    return require(name, shape=shape, chunks=chunks, dtype=dtype,
+                   fill_value=fill_value)
+
+
+def get_connectivity_var_name(region):
+    """ Return the name of the flag variable for receiving region `region`
+    """
+    return f'is_present_in_waters_of_{connectivity_netcdf_names[region]}'
+
+
+def get_release_dates(first_year, last_year, release_day=1, release_hour=12):
+    """ Return the dates of all monthly releases between two years
+
+    Parameters
+    ----------
+    first_year, last_year : int
+        The first and last release years (inclusive).
+
+    release_day : int, optional
+        Day of the month on which particles were released. Default: 1.
+
+    release_hour : int, optional
+        Hour of the day at which particles were released. Default: 12.
+
+    Returns
+    -------
+     : list
+        List of datetime.datetime objects.
+    """
+    return [datetime.datetime(year, month, release_day, release_hour)
+            for year in range(first_year, last_year + 1)
+            for month in range(1, 13)]
+
+
+def require_connectivity_store(store_path, release_dates, n_times,
+                               n_particles, regions=None,
+                               time_chunk_size=connectivity_time_chunk_size,
+                               particle_chunk_size=connectivity_particle_chunk_size):
+    """ Create or open the connectivity store for one emitting country
+
+    Creating the store is idempotent, so any job may call this function.
+    To avoid races while the metadata is first written, it is best to
+    call it once before launching many jobs.
+
+    Parameters
+    ----------
+    store_path : str
+        Path to the store.
+
+    release_dates : list
+        The dates of all releases, in order.
+
+    n_times : int
+        The maximum number of time points in a release.
+
+    n_particles : int
+        The number of particles in each release.
+
+    regions : list, optional
+        The receiving regions. Default: all regions in
+        `shared.connectivity_netcdf_names`.
+
+    time_chunk_size : int, optional
+        Chunk size along the time dimension.
+
+    particle_chunk_size : int, optional
+        Chunk size along the particle dimension.
+
+    Returns
+    -------
+     : zarr.Group
+        The store.
+    """
+    _check_zarr()
+
+    if regions is None:
+        regions = list(connectivity_netcdf_names.keys())
+
+    group = zarr.open_group(store_path, mode='a')
+
+    release_date_strs = [date.isoformat() for date in release_dates]
+    if 'release_dates' in group.attrs:
+        if list(group.attrs['release_dates']) != release_date_strs:
+            raise RuntimeError(f'Store {store_path} was created with '
+                               f'different release dates')
+    else:
+        group.attrs['release_dates'] = release_date_strs
+
+    n_releases = len(release_dates)
+    shape = (n_releases, n_times, n_particles)
+    chunks = (1, min(time_chunk_size, n_times),
+              min(particle_chunk_size, n_particles))
+
+    for region in regions:
+        var = _require_array(group, get_connectivity_var_name(region), shape,
+                             chunks, np.int8, connectivity_fill_value)
+        if 'long_name' not in var.attrs:
+            var.attrs.update({'units': 'n/a',
+                              'long_name': 'Binary flag indicating presence '
+                                           '(=1) and absence (=0)'})
+
+    # Time in seconds since 1990-01-01 00:00:00, NaN after the end of a run
+    _require_array(group, 'time', (n_releases, n_times),
+                   (1, n_times), np.float64, np.nan)
+
+    return group
+
+
+def get_release_index(group, release_date):
+    """ Return the index of the release made on `release_date`
+    """
+    return [datetime.datetime.fromisoformat(date_str) for date_str in
+            group.attrs['release_dates']].index(release_date)
+
+
+class ConnectivityReader(object):
+    """ Lazily indexed view of connectivity flags across all releases
+
+    Indexing returns flags with dimensions (release, time, particles).
+    Only the chunks that are needed are read.
+
+    Parameters
+    ----------
+    store_path : str
+        Path to the store.
+
+    region : str
+        The receiving region.
+    """
+
+    def __init__(self, store_path, region):
+        _check_zarr()
+
+        self.group = zarr.open_group(store_path, mode='r')
+        self.region = region
+        self.array = self.group[get_connectivity_var_name(region)]
+        self.release_dates = [datetime.datetime.fromisoformat(date_str)
+                              for date_str in self.group.attrs['release_dates']]
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    def __getitem__(self, key):
+        return self.array[key]
+
+    def get_release(self, release_date):
+        """ Return the flags array for a single release
+
+        The returned array is itself lazily indexed.
+        """
+        return ReleaseView(self.array, self.release_dates.index(release_date))
+
+
+class ReleaseView(object):
+    """ Lazily indexed (time, particles) view onto one release
+    """
+
+    def __init__(self, array, release_idx):
+        self.array = array
+        self.release_idx = release_idx
+
+    @property
+    def shape(self):
+        return self.array.shape[1:]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        return self.array[(self.release_idx,) + key]
+
+
+class ZarrConnectivityOutput(object):
+    """ Write connectivity flags for one release to a connectivity store
+
+    Provides the same interface as the netCDF output used by
+    `compute_connectivity_metrics.py`. Whether or not each region has been
+    completed is recorded in a small array with one chunk per release, so
+    jobs processing different releases never write to the same chunk.
+
+    Parameters
+    ----------
+    store_path : str
+        Path to the store.
+
+    release_dates : list
+        The dates of all releases held in the store.
+
+    release_date : datetime.datetime
+        The date of the release being written.
+
+    dates : list
+        The output dates of the release.
+
+    n_particles : int
+        The number of particles in the release.
+
+    max_n_times : int
+        The maximum number of time points in any release.
+
+    time_chunk_size, particle_chunk_size : int, optional
+        Chunk sizes along the time and particle dimensions.
+    """
+
+    def __init__(self, store_path, release_dates, release_date, dates,
+                 n_particles, max_n_times,
+                 time_chunk_size=connectivity_time_chunk_size,
+                 particle_chunk_size=connectivity_particle_chunk_size):
+        self.store_path = store_path
+        self.group = require_connectivity_store(store_path, release_dates,
+                                                max_n_times, n_particles,
+                                                time_chunk_size=time_chunk_size,
+                                                particle_chunk_size=particle_chunk_size)
+        self.release_idx = get_release_index(self.group, release_date)
+        self.regions = list(connectivity_netcdf_names.keys())
+
+        _require_array(self.group, 'complete',
+                       (len(release_dates), len(self.regions)),
+                       (1, len(self.regions)), np.int8, 0)
+
+        # Time in seconds since 1990-01-01 00:00:00
+        reference_date = datetime.datetime(1990, 1, 1)
+        times = np.array([(date - reference_date).total_seconds()
+                          for date in dates])
+        self.group['time'][self.release_idx, :len(times)] = times
+
+    def _get_region_idx(self, var_name):
+        return [get_connectivity_var_name(region)
+                for region in self.regions].index(var_name)
+
+    def is_complete(self, var_name):
+        return bool(self.group['complete'][self.release_idx,
+                                           self._get_region_idx(var_name)])
+
+    def start_variable(self, var_name, var_attrs):
+        # Arrays and their attributes are created with the store. They are
+        # not modified here, as other jobs may be writing to the same arrays.
+        pass
+
+    def write_block(self, var_name, block, start):
+        self.group[var_name][self.release_idx, start:start + block.shape[0], :] = block
+
+    def mark_complete(self, var_name):
+        complete = self.group['complete'][self.release_idx, :]
+        complete[self._get_region_idx(var_name)] = 1
+        self.group['complete'][self.release_idx, :] = complete
+
+    def close(self):
+        print(f'\nFinished writing to store {self.store_path}')
+
+
+def require_stock_store(store_path, years, regions=None, emitters=None):
+    """ Create or open the stock store
+
+    Parameters
+    ----------
+    store_path : str
+        Path to the store.
+
+    years : list
+        The years for which stocks may be computed.
+
+    regions : list, optional
+        The receiving regions. Default: all regions in `shared.eez_names`.
+
+    emitters : list, optional
+        The emitting countries. Default: `shared.na_countries`.
+
+    Returns
+    -------
+     : zarr.Group
+        The store.
+    """
+    _check_zarr()
+
+    if regions is None:
+        regions = list(eez_names.keys())
+
+    if emitters is None:
+        emitters = list(na_countries)
+
+    group = zarr.open_group(store_path, mode='a')
+
+    for name, values in [('years', list(years)), ('regions', list(regions)),
+                         ('emitters', list(emitters))]:
+        if name in group.attrs:
+            if list(group.attrs[name]) != values:
+                raise RuntimeError(f'Store {store_path} was created with '
+                                   f'different {name}')
+        else:
+            group.attrs[name] = values
+
+    shape = (len(years), 12, 31, len(regions), len(emitters))
+    chunks = (1, 1, 31, 1, len(emitters))
+    _require_array(group, 'stock', shape, chunks, np.float64, np.nan)
+
+    return group
+
+
+def write_stock(group, region, year, month, pdf):
+    """ Write one month of daily stocks for one receiving region
+
+    Parameters
+    ----------
+    group : zarr.Group
+        The stock store.
+
+    region : str
+        The receiving region.
+
+    year, month : int
+        The year and month.
+
+    pdf : pandas.DataFrame
+        Daily stocks, with one column per emitting country, as computed by
+        `compute_plastic_stock_in_eezs.py`. Missing emitters are saved as
+        NaN.
+    """
+    year_idx = list(group.attrs['years']).index(year)
+    region_idx = list(group.attrs['regions']).index(region)
+    emitters = list(group.attrs['emitters'])
+
+    stock = np.full((31, len(emitters)), np.nan)
+    for emitter_idx, emitter in enumerate(emitters):
+        if emitter in pdf.columns:
+            stock[:len(pdf), emitter_idx] = pdf[emitter].values
+
+    group['stock'][year_idx, month - 1, :, region_idx, :] = stock
+
+
+def read_stock(store_path, region, year):
+    """ Read daily stocks for a receiving region and year
+
+    Parameters
+    ----------
+    store_path : str
+        Path to the stock store.
+
+    region : str
+        The receiving region.
+
+    year : int
+        The year.
+
+    Returns
+    -------
+    dates : list
+        The dates of days that exist in the calendar.
+
+    stock : 2D NumPy array
+        Stocks with dimensions (day, emitting country).
+
+    emitters : list
+        The emitting countries.
+    """
+    _check_zarr()
+
+    group = zarr.open_group(store_path, mode='r')
+    year_idx = list(group.attrs['years']).index(year)
+    region_idx = list(group.attrs['regions']).index(region)
+
+    data = group['stock'][year_idx, :, :, region_idx, :]
+
+    dates = []
+    rows = []
+    for month in range(1, 13):
+        for day in range(1, 32):
+            try:
+                dates.append(datetime.datetime(year, month, day))
+            except ValueError:
+                continue
+            rows.append(data[month - 1, day - 1, :])
+
+    return dates, np.array(rows), list(group.attrs['emitters'])
+
+
+def read_stock_month(store_path, region, year, month):
+    """ Read one month of daily stocks for a receiving region
+
+    Parameters
+    ----------
+    store_path : str
+        Path to the stock store.
+
+    region : str
+        The receiving region.
+
+    year, month : int
+        The year and month.
+
+    Returns
+    -------
+    stock : 2D NumPy array
+        Stocks with dimensions (day, emitting country), or None if the
+        month has not been written.
+
+    emitters : list
+        The emitting countries.
+    """
+    _check_zarr()
+
+    group = zarr.open_group(store_path, mode='r')
+    emitters = list(group.attrs['emitters'])
+    if year not in group.attrs['years']:
+        return None, emitters
+
+    year_idx = list(group.attrs['years']).index(year)
+    region_idx = list(group.attrs['regions']).index(region)
+
+    n_days = monthrange(year, month)[1]
+    stock = group['stock'][year_idx, month - 1, :n_days, region_idx, :]
+
+    # Each month is written in a single chunk, so a month that has been
+    # written has at least one value
+    if np.all(np.isnan(stock)):
+        return None, emitters
+
+    return stock, emitters